@@ -0,0 +1,23 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.core.management.base import BaseCommand
+
+from okupy.accounts.models import LDAPUserMirror
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = ('Refresh the SQL mirror of the public LDAP attributes used '
+            'by the lists')
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', default=False,
+                    help='Rebuild the whole mirror, removing deleted users'),
+    )
+
+    def handle(self, *args, **options):
+        if options['full']:
+            count = LDAPUserMirror.rebuild()
+        else:
+            count = LDAPUserMirror.refresh()
+        self.stdout.write('%d users mirrored' % count)
@@ -0,0 +1,49 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from okupy.common.ldap_sync import TimestampPoller, SYNCREPL_UNSUPPORTED
+
+from optparse import make_option
+
+import ldap
+import logging
+import time
+
+logger = logging.getLogger('okupy')
+
+
+class Command(BaseCommand):
+    help = ('Follow the changes of the LDAP directory, and publish them '
+            'to the cache layers')
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', action='store_true', default=False,
+                    help='Poll modifyTimestamp instead of using syncrepl'),
+        make_option('--interval', type='int', default=30,
+                    help='Seconds between polls and reconnects'),
+        make_option('--base-dn', dest='base_dn', default=None,
+                    help='Subtree to follow (default: the user base DN)'),
+    )
+
+    def handle(self, *args, **options):
+        uri = settings.AUTH_LDAP_SERVER_URI
+        base_dn = options['base_dn'] or settings.AUTH_LDAP_USER_BASE_DN
+        interval = options['interval']
+        poll = options['poll']
+
+        while True:
+            try:
+                if poll:
+                    TimestampPoller(uri, interval).run(base_dn)
+                else:
+                    # needs python-ldap's syncrepl support and pyasn1
+                    from okupy.common.ldap_syncrepl import SyncreplClient
+                    SyncreplClient(uri).run(base_dn)
+            except SYNCREPL_UNSUPPORTED as error:
+                logger.warning('syncrepl not supported by %s (%s), polling '
+                               'modifyTimestamp instead' % (uri, error))
+                poll = True
+            except ldap.SERVER_DOWN as error:
+                logger.warning('Lost the LDAP connection: %s' % error)
+                time.sleep(interval)
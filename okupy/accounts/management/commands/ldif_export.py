@@ -0,0 +1,40 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from okupy.common.ldap_bulk import bulk_connection, export_ldif, Progress
+
+from optparse import make_option
+
+import sys
+
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = 'Write the LDAP users as LDIF to file, or to standard output'
+    option_list = BaseCommand.option_list + (
+        make_option('--base-dn', dest='base_dn', default=None,
+                    help='Subtree to export (default: the user base DN)'),
+        make_option('--filter', dest='filterstr', default='(objectClass=*)',
+                    help='LDAP filter of the exported entries'),
+        make_option('--page-size', dest='page_size', type='int', default=500,
+                    help='Number of entries fetched per search page'),
+        make_option('--progress', type='int', default=1000,
+                    help='Report progress every N entries (0 disables it)'),
+    )
+
+    def handle(self, *args, **options):
+        base_dn = options['base_dn'] or settings.AUTH_LDAP_USER_BASE_DN
+        out = open(args[0], 'w') if args else sys.stdout
+        # keep the LDIF on stdout clean
+        progress = Progress(self.stderr, options['progress'])
+        conn = bulk_connection()
+        try:
+            export_ldif(conn, out, base_dn, options['filterstr'],
+                        options['page_size'], progress)
+        finally:
+            conn.unbind_s()
+            if out is not sys.stdout:
+                out.close()
+        progress.report()
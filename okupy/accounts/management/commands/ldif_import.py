@@ -0,0 +1,44 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from okupy.common.ldap_bulk import (bulk_connection, import_ldif,
+                                    BulkWriter, Progress)
+
+from optparse import make_option
+
+import sys
+
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = 'Add the entries of an LDIF file, or standard input, to LDAP'
+    option_list = BaseCommand.option_list + (
+        make_option('--update', action='store_true', default=False,
+                    help='Replace the attributes of existing entries'),
+        make_option('--in-flight', dest='in_flight', type='int', default=8,
+                    help='Number of writes waiting for the server at once'),
+        make_option('--progress', type='int', default=1000,
+                    help='Report progress every N entries (0 disables it)'),
+    )
+
+    def handle(self, *args, **options):
+        stream = open(args[0]) if args else sys.stdin
+        progress = Progress(self.stdout, options['progress'])
+        conn = bulk_connection(settings.AUTH_LDAP_ADMIN_BIND_DN,
+                               settings.AUTH_LDAP_ADMIN_BIND_PASSWORD)
+        writer = BulkWriter(conn, options['in_flight'], options['update'],
+                            progress)
+        try:
+            import_ldif(stream, writer)
+        finally:
+            conn.unbind_s()
+            if stream is not sys.stdin:
+                stream.close()
+        progress.report()
+
+        for dn, error in writer.errors:
+            self.stderr.write('%s: %s' % (dn, error))
+        if writer.errors:
+            raise CommandError('%d entries failed' % len(writer.errors))
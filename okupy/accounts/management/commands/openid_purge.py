@@ -0,0 +1,25 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from okupy.accounts.openid_store import DjangoDBOpenIDStore
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired OpenID nonces and associations'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=None,
+                    help='Number of rows deleted at once (default: %d)'
+                    % settings.OPENID_PURGE_BATCH_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        store = DjangoDBOpenIDStore()
+        nonces = store.cleanupNonces(options['batch_size'])
+        assocs = store.cleanupAssociations(options['batch_size'])
+        self.stdout.write('Removed %d nonces and %d associations'
+                          % (nonces, assocs))
@@ -1,14 +1,25 @@
 # vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
 
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import (models, transaction, IntegrityError, connections,
+                       router)
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.forms.models import model_to_dict
 from ldapdb.models.fields import (CharField, IntegerField, ListField,
                                   FloatField, DateField)
 import ldapdb.models
 
 from okupy.common.fields import ACLField
+from okupy.common.ldap_sync import directory_changed
+from okupy.common.managers import ACLManager
 from okupy.crypto.models import EncryptedPKModel
 
+import hashlib
+import ldap
+import ldap.dn
+
 
 class Queue(EncryptedPKModel):
     username = models.CharField(max_length=100, unique=True)
@@ -85,15 +96,209 @@ class LDAPUser(ldapdb.models.Model):
     is_infra = ACLField(db_column='gentooACL')
     is_retired = ACLField(db_column='gentooACL')
 
+    objects = ACLManager()
+
+    def __unicode__(self):
+        return self.username
+
+
+class UIDNumberCounter(models.Model):
+    """
+    A counter that hands out uidNumbers for new LDAP accounts.
+
+    It is a single row holding the next free uidNumber. Reservations
+    increment it atomically, so concurrent activations never get
+    the same number and we don't have to scan the directory for
+    the highest one.
+    """
+
+    next_uid = models.IntegerField()
+
+    @classmethod
+    @transaction.commit_on_success
+    def reserve(cls, count=1):
+        """
+        Reserve a block of count consecutive uidNumbers.
+
+        Returns the first number in the block. If the counter does
+        not exist yet, it is seeded from the highest uidNumber found
+        in LDAP.
+        """
+
+        # update first, so the row is locked till the end
+        # of the transaction and the read below is consistent
+        updated = cls.objects.filter(pk=1).update(
+            next_uid=models.F('next_uid') + count)
+        if not updated:
+            try:
+                first = LDAPUser.objects.latest('uid').uid + 1
+            except LDAPUser.DoesNotExist:
+                first = 1
+            sid = transaction.savepoint()
+            try:
+                cls.objects.create(pk=1, next_uid=first + count)
+            except IntegrityError:
+                # someone else seeded it in the meantime
+                transaction.savepoint_rollback(sid)
+                cls.objects.filter(pk=1).update(
+                    next_uid=models.F('next_uid') + count)
+            else:
+                transaction.savepoint_commit(sid)
+                return first
+        return cls.objects.get(pk=1).next_uid - count
+
+
+class LDAPUserMirror(models.Model):
+    """
+    SQL copy of the public attributes of LDAPUser, read by the public
+    lists instead of LDAP.
+
+    It is refreshed incrementally, by the modifyTimestamp of the entries
+    (refresh()), on the changes published by the ldap_sync consumer,
+    and rebuilt completely by rebuild(), which is the only way to notice
+    the deleted entries without ldap_sync.
+    """
+
+    username = models.CharField(max_length=100, primary_key=True)
+    full_name = models.CharField(max_length=255, blank=True)
+    location = models.CharField(max_length=255, blank=True)
+    roles = models.TextField(blank=True)
+    # the gentooACL values, one per line
+    ACL = models.TextField(blank=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    # the groups of the public lists
+    is_developer = models.BooleanField(default=False, db_index=True)
+    is_retired = models.BooleanField(default=False, db_index=True)
+    is_foundation = models.BooleanField(default=False, db_index=True)
+    # modifyTimestamp of the entry
+    modified = models.CharField(max_length=32, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ('username',)
+
     def __unicode__(self):
         return self.username
 
+    @classmethod
+    def from_ldapuser(cls, user, modified=''):
+        return cls(
+            username=user.username,
+            full_name=user.full_name or '',
+            location=user.location or '',
+            roles=user.roles or '',
+            ACL='\n'.join(user.ACL),
+            latitude=user.latitude,
+            longitude=user.longitude,
+            is_developer=user.is_developer,
+            is_retired=user.is_retired,
+            is_foundation=user.is_foundation,
+            modified=modified,
+        )
+
+    @classmethod
+    @transaction.commit_on_success
+    def rebuild(cls):
+        """
+        Replace the mirror with the current contents of LDAP.
+        """
+        modified = cls._timestamps()
+        mirrored = [cls.from_ldapuser(user, modified.get(user.username, ''))
+                    for user in LDAPUser.objects.all()]
+        cls.objects.all().delete()
+        cls.objects.bulk_create(mirrored)
+        return len(mirrored)
+
+    @classmethod
+    def _timestamps(cls, filterstr=''):
+        """
+        Return a dict mapping the usernames of the entries matching
+        filterstr to their modifyTimestamp.
+        """
+        conn = connections[router.db_for_read(LDAPUser)]
+        attr = settings.AUTH_LDAP_USER_ATTR
+        results = conn.search_s(
+            LDAPUser.base_dn, ldap.SCOPE_SUBTREE,
+            '(&(%s=*)%s)' % (attr, filterstr), [attr, 'modifyTimestamp'])
+        return dict((attrs[attr][0], attrs.get('modifyTimestamp', [''])[0])
+                    for dn, attrs in results)
+
+    @classmethod
+    def _changed_since(cls, timestamp):
+        """
+        Return a dict mapping the usernames of entries modified since
+        timestamp to their modifyTimestamp.
+        """
+        return cls._timestamps('(modifyTimestamp>=%s)' % timestamp)
+
+    @classmethod
+    @transaction.commit_on_success
+    def _update(cls, changed):
+        usernames = sorted(changed)
+        batch_size = settings.LDAP_MIRROR_BATCH_SIZE
+        count = 0
+        for start in xrange(0, len(usernames), batch_size):
+            batch = usernames[start:start + batch_size]
+            users = LDAPUser.objects.filter(username__in=batch)
+            mirrored = [cls.from_ldapuser(user, changed[user.username])
+                        for user in users]
+            cls.objects.filter(username__in=batch).delete()
+            cls.objects.bulk_create(mirrored)
+            count += len(mirrored)
+        return count
+
+    @classmethod
+    def refresh(cls):
+        """
+        Update the entries modified since the last refresh. Rebuilds
+        the mirror if it is empty.
+        """
+        timestamp = cls.objects.aggregate(
+            models.Max('modified'))['modified__max']
+        if not timestamp:
+            return cls.rebuild()
+        changed = cls._changed_since(timestamp)
+        if not changed:
+            return 0
+        return cls._update(changed)
+
+    @classmethod
+    def refresh_user(cls, username, modified=''):
+        """
+        Update the single entry of username, or remove it if it
+        no longer exists in LDAP.
+        """
+        return cls._update({username: modified})
+
+
+@receiver(directory_changed)
+def update_ldapuser_mirror(sender, change, dn, attrs, **kwargs):
+    """
+    Keep LDAPUserMirror up to date with the changes published
+    by the ldap_sync consumer.
+    """
+    if change == 'refresh':
+        LDAPUserMirror.rebuild()
+        return
+    try:
+        rdn = ldap.dn.str2dn(dn)[0][0]
+    except ldap.DECODING_ERROR:
+        return
+    if (rdn[0] != settings.AUTH_LDAP_USER_ATTR
+            or not dn.endswith(LDAPUser.base_dn)):
+        return
+    if change == 'delete':
+        LDAPUserMirror.objects.filter(username=rdn[1]).delete()
+    else:
+        modified = (attrs or {}).get('modifyTimestamp', [''])[0]
+        LDAPUserMirror.refresh_user(rdn[1], modified)
+
 
 # Models for OpenID data store
 
 class OpenID_Nonce(models.Model):
     server_uri = models.URLField(max_length=2048)
-    ts = models.DateTimeField()
+    ts = models.DateTimeField(db_index=True)
     salt = models.CharField(max_length=40)
 
     class Meta:
@@ -106,7 +311,7 @@ class OpenID_Association(models.Model):
     # TODO: BinaryField in newer versions of django
     secret = models.CharField(max_length=128)
     issued = models.DateTimeField()
-    expires = models.DateTimeField()
+    expires = models.DateTimeField(db_index=True)
     assoc_type = models.CharField(max_length=64)
 
     class Meta:
@@ -137,3 +342,40 @@ class OpenID_Attributes(models.Model):
 
     class Meta:
         unique_together = ('trust_root', 'uid')
+
+    @staticmethod
+    def _prefs_key(uid, trust_root):
+        digest = hashlib.sha1(
+            (u'%s\0%s' % (uid, trust_root)).encode('utf8')).hexdigest()
+        return 'okupy.openid_attributes.%s' % digest
+
+    def prefs(self):
+        """ Return the choices of the preferences as a dict """
+        return model_to_dict(self, exclude=('id', 'uid', 'trust_root'))
+
+    @classmethod
+    def auto_auth_prefs(cls, uid, trust_root):
+        """
+        Return prefs() of the preferences of uid for trust_root if they
+        are always_auth, None otherwise. The outcome is cached for
+        settings.OPENID_PREFS_TTL seconds, or till the preferences are
+        saved or deleted.
+        """
+        key = cls._prefs_key(uid, trust_root)
+        prefs = cache.get(key)
+        if prefs is None:
+            try:
+                pref = cls.objects.get(uid=uid, trust_root=trust_root)
+            except cls.DoesNotExist:
+                pref = None
+            # an empty dict stands for 'ask the user'
+            prefs = pref.prefs() if pref and pref.always_auth else {}
+            cache.set(key, prefs, settings.OPENID_PREFS_TTL)
+        return prefs or None
+
+
+@receiver(post_save, sender=OpenID_Attributes)
+@receiver(post_delete, sender=OpenID_Attributes)
+def invalidate_openid_prefs(sender, instance, **kwargs):
+    cache.delete(OpenID_Attributes._prefs_key(instance.uid,
+                                              instance.trust_root))
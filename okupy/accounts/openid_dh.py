@@ -0,0 +1,136 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Pool of Diffie-Hellman key pairs for OpenID associate requests.
+
+Generating the server key pair is a modular exponentiation. The pool
+keeps settings.OPENID_DH_POOL_SIZE pairs for the default modulus and
+generator, which nearly all relying parties use, generated ahead by
+a background thread. Every pair is used for a single association.
+"""
+
+from django.conf import settings
+
+from openid import cryptutil
+from openid.dh import DiffieHellman
+from openid.message import OPENID_NS
+from openid.server.server import (AssociateRequest, Decoder,
+                                  DiffieHellmanSHA1ServerSession,
+                                  DiffieHellmanSHA256ServerSession,
+                                  ProtocolError, Server)
+
+import Queue
+import threading
+
+
+class DHKeyPool(object):
+    """
+    Queue of DiffieHellman.fromDefaults() key pairs, refilled by
+    a thread started on the first use. When it runs dry, the pairs
+    are generated on the spot.
+    """
+
+    def __init__(self, size=None):
+        self.size = settings.OPENID_DH_POOL_SIZE if size is None else size
+        self._queue = Queue.Queue(self.size)
+        self._lock = threading.Lock()
+        self._started = False
+        # pairs taken from the pool and generated on the spot
+        self.hits = 0
+        self.misses = 0
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._started = True
+
+    def _work(self):
+        while True:
+            # blocks while the pool is full
+            self._queue.put(DiffieHellman.fromDefaults())
+
+    def fill(self):
+        """
+        Fill the pool in the calling thread.
+        """
+        while not self._queue.full():
+            try:
+                self._queue.put_nowait(DiffieHellman.fromDefaults())
+            except Queue.Full:
+                break
+
+    def get(self):
+        """
+        Return an unused DiffieHellman key pair with the default
+        modulus and generator.
+        """
+        if not self.size:
+            return DiffieHellman.fromDefaults()
+        if not self._started:
+            self._start()
+        try:
+            dh = self._queue.get_nowait()
+        except Queue.Empty:
+            self.misses += 1
+            return DiffieHellman.fromDefaults()
+        self.hits += 1
+        return dh
+
+
+pool = DHKeyPool()
+
+
+class PooledDHMixin(object):
+    """
+    Takes the key pair of DH sessions with the default modulus and
+    generator from the pool.
+    """
+
+    pool = pool
+
+    @classmethod
+    def fromMessage(cls, message):
+        if (message.getArg(OPENID_NS, 'dh_modulus') is not None
+                or message.getArg(OPENID_NS, 'dh_gen') is not None):
+            return super(PooledDHMixin, cls).fromMessage(message)
+
+        consumer_pubkey = message.getArg(OPENID_NS, 'dh_consumer_public')
+        if consumer_pubkey is None:
+            raise ProtocolError(message, 'Public key for %s session not '
+                                'found in message %s' % (cls.session_type,
+                                                         message))
+        return cls(cls.pool.get(), cryptutil.base64ToLong(consumer_pubkey))
+
+
+class PooledDHSHA1ServerSession(PooledDHMixin,
+                                DiffieHellmanSHA1ServerSession):
+    pass
+
+
+class PooledDHSHA256ServerSession(PooledDHMixin,
+                                  DiffieHellmanSHA256ServerSession):
+    pass
+
+
+class PooledAssociateRequest(AssociateRequest):
+    session_classes = dict(AssociateRequest.session_classes, **{
+        'DH-SHA1': PooledDHSHA1ServerSession,
+        'DH-SHA256': PooledDHSHA256ServerSession,
+    })
+
+
+class PooledDecoder(Decoder):
+    _handlers = dict(Decoder._handlers,
+                     associate=PooledAssociateRequest.fromMessage)
+
+
+class PooledDHServer(Server):
+    """
+    OpenID Server answering associate requests with the pool.
+    """
+
+    decoderClass = PooledDecoder
@@ -0,0 +1,288 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+HTTP fetcher of python-openid keeping connections to relying parties
+alive between fetches, installed by install().
+
+The fetches are recorded into the FetchStats collector of the current
+thread, if there is one. LDAPStatsMiddleware starts one for every
+request.
+"""
+
+from django.conf import settings
+
+from openid.fetchers import HTTPFetcher, HTTPResponse, USER_AGENT
+
+import collections
+import httplib
+import logging
+import openid.fetchers
+import socket
+import ssl
+import threading
+import time
+import urlparse
+
+logger = logging.getLogger('okupy')
+
+REDIRECTS = (301, 302, 303, 307)
+MAX_REDIRECTS = 10
+
+_local = threading.local()
+
+
+class FetchStats(object):
+    """
+    Totals of the OpenID fetches done by a single thread.
+    """
+
+    def __init__(self):
+        self.fetches = 0
+        self.errors = 0
+        # fetches done over a kept alive connection
+        self.reused = 0
+        self.duration = 0.0
+        self.max_duration = 0.0
+
+    def add(self, duration, reused, error):
+        self.fetches += 1
+        self.errors += bool(error)
+        self.reused += bool(reused)
+        self.duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+    def summary(self):
+        average = self.duration / self.fetches if self.fetches else 0.0
+        return ('%d OpenID fetches, %d errors, %d reused connections, '
+                'avg %.1fms, max %.1fms' % (
+                    self.fetches, self.errors, self.reused, average * 1000,
+                    self.max_duration * 1000))
+
+    def server_timing(self):
+        """
+        Return the totals as a Server-Timing header metric.
+        """
+        return 'openid;dur=%.1f;desc="%d fetches"' % (self.duration * 1000,
+                                                      self.fetches)
+
+
+def start():
+    """
+    Start collecting the OpenID fetches of the current thread.
+    """
+    _local.stats = FetchStats()
+    return _local.stats
+
+
+def stop():
+    """
+    Stop collecting and return the collected FetchStats, or None
+    if collecting was not started.
+    """
+    stats = current()
+    _local.stats = None
+    return stats
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+class PooledHTTPFetcher(HTTPFetcher):
+    """
+    Fetcher keeping up to pool_size idle connections per host
+    (and so their TLS sessions) for the next fetches, and up to
+    max_idle in total, closing those of the least recently used hosts
+    first. Connections idle for more than idle_timeout seconds are
+    not reused.
+
+    Connecting times out after connect_timeout seconds, and waiting
+    for data after read_timeout. Like the fetchers of python-openid,
+    response bodies are cut after max_bytes.
+    """
+
+    def __init__(self, pool_size=4, connect_timeout=5, read_timeout=10,
+                 max_bytes=1024 * 1024, max_idle=64, idle_timeout=60):
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> [(release time, idle connection)],
+        # the least recently used host first
+        self._idle = collections.OrderedDict()
+        self._idle_count = 0
+        self._ssl_context = None
+        if hasattr(ssl, 'create_default_context'):
+            self._ssl_context = ssl.create_default_context()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            kwargs = {}
+            if self._ssl_context is not None:
+                kwargs['context'] = self._ssl_context
+            conn = httplib.HTTPSConnection(
+                host, port, timeout=self.connect_timeout, **kwargs)
+        else:
+            conn = httplib.HTTPConnection(host, port,
+                                          timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _acquire(self, key):
+        """
+        Return an idle connection to key and True, or a new one
+        and False. Closes the expired idle connections to key.
+        """
+        conn, expired = None, []
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                oldest = time.time() - self.idle_timeout
+                while idle and idle[0][0] < oldest:
+                    expired.append(idle.pop(0)[1])
+                if idle:
+                    conn = idle.pop()[1]
+                    self._idle_count -= 1
+                if not idle:
+                    del self._idle[key]
+                self._idle_count -= len(expired)
+        for old in expired:
+            old.close()
+        if conn is not None:
+            return conn, True
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        evicted = []
+        with self._lock:
+            idle = self._idle.pop(key, [])
+            # (re)inserted as the most recently used host
+            self._idle[key] = idle
+            if len(idle) < self.pool_size and self.max_idle > 0:
+                idle.append((time.time(), conn))
+                self._idle_count += 1
+                while self._idle_count > self.max_idle:
+                    lru_key, lru = next(self._idle.iteritems())
+                    evicted.append(lru.pop(0)[1])
+                    self._idle_count -= 1
+                    if not lru:
+                        del self._idle[lru_key]
+            else:
+                evicted.append(conn)
+                if not idle:
+                    del self._idle[key]
+        for old in evicted:
+            old.close()
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, collections.OrderedDict()
+            self._idle_count = 0
+        for conns in idle.values():
+            for released, conn in conns:
+                conn.close()
+
+    def _request(self, key, method, path, body, headers):
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except (httplib.BadStatusLine, socket.error) as error:
+            conn.close()
+            if not reused or isinstance(error, socket.timeout):
+                raise
+            # the server closed the kept alive connection, try a new one
+            conn, reused = self._connect(key), False
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+
+        try:
+            data = response.read(self.max_bytes)
+        except Exception:
+            conn.close()
+            raise
+        # a cut body leaves the rest of the response on the connection
+        if response.isclosed() and not response.will_close:
+            self._release(key, conn)
+        else:
+            conn.close()
+        return response, data, reused
+
+    def _fetch(self, url, body, headers):
+        method = 'GET' if body is None else 'POST'
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError('Bad URL scheme: %r' % (url,))
+            key = (parts.scheme, parts.hostname, parts.port
+                   or (443 if parts.scheme == 'https' else 80))
+            path = urlparse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+
+            response, data, reused = self._request(key, method, path, body,
+                                                   headers)
+            location = response.getheader('location')
+            if response.status not in REDIRECTS or not location:
+                return HTTPResponse(url, response.status,
+                                    dict(response.getheaders()), data), reused
+
+            url = urlparse.urljoin(url, location)
+            if response.status != 307:
+                method, body = 'GET', None
+        raise httplib.HTTPException('Too many redirects: %s' % url)
+
+    def fetch(self, url, body=None, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        if body is not None:
+            headers.setdefault('Content-Type',
+                               'application/x-www-form-urlencoded')
+
+        stats = current()
+        started = time.time()
+        try:
+            resp, reused = self._fetch(url, body, headers)
+        except Exception as error:
+            duration = time.time() - started
+            if stats is not None:
+                stats.add(duration, False, True)
+            logger.debug('OpenID fetch of %s failed after %.1fms: %r'
+                         % (url, duration * 1000, error))
+            raise
+        duration = time.time() - started
+        if stats is not None:
+            stats.add(duration, reused, False)
+        logger.debug('OpenID fetch of %s: %d, %d bytes, %.1fms%s'
+                     % (url, resp.status, len(resp.body), duration * 1000,
+                        ' (reused)' if reused else ''))
+        return resp
+
+
+def install():
+    """
+    Make python-openid use a PooledHTTPFetcher configured by settings,
+    unless settings.OPENID_FETCH_POOL_SIZE is 0. Returns the fetcher.
+    """
+    if not settings.OPENID_FETCH_POOL_SIZE:
+        return None
+    fetcher = PooledHTTPFetcher(
+        pool_size=settings.OPENID_FETCH_POOL_SIZE,
+        connect_timeout=settings.OPENID_FETCH_CONNECT_TIMEOUT,
+        read_timeout=settings.OPENID_FETCH_READ_TIMEOUT,
+        max_bytes=settings.OPENID_FETCH_MAX_BYTES,
+        max_idle=settings.OPENID_FETCH_MAX_IDLE,
+        idle_timeout=settings.OPENID_FETCH_IDLE_TIMEOUT)
+    openid.fetchers.setDefaultFetcher(fetcher, wrap_exceptions=True)
+    return fetcher
@@ -0,0 +1,152 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Checks of OpenID relying parties.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from openid.server.trustroot import verifyReturnTo
+
+from okupy.accounts import openid_fetcher
+
+import openid.fetchers
+import openid.yadis.discover
+
+import Queue
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger('okupy')
+
+# outcomes of verify_return_to()
+VERIFIED = 'verified'
+UNTRUSTED = 'untrusted'
+DISCOVERY_FAILURE = 'discovery_failure'
+HTTP_FAILURE = 'http_failure'
+
+
+def _return_to_key(trust_root, return_to):
+    # the values come from requests, and can be non-ASCII unicode
+    data = '\0'.join(unicode(p).encode('utf8')
+                     for p in (trust_root, return_to))
+    digest = hashlib.sha1(data).hexdigest()
+    return 'okupy.openid_rp.return_to.%s' % digest
+
+
+def check_return_to(trust_root, return_to):
+    """
+    Verify return_to against the relying party discovery of trust_root,
+    without the cache. Returns one of the outcomes.
+    """
+    try:
+        if verifyReturnTo(trust_root, return_to):
+            return VERIFIED
+        return UNTRUSTED
+    except openid.yadis.discover.DiscoveryFailure:
+        return DISCOVERY_FAILURE
+    except openid.fetchers.HTTPFetchingError:
+        return HTTP_FAILURE
+
+
+def _verify(trust_root, return_to):
+    key = _return_to_key(trust_root, return_to)
+    outcome = cache.get(key)
+    if outcome is None:
+        outcome = check_return_to(trust_root, return_to)
+        cache.set(key, outcome, settings.OPENID_RETURN_TO_TTL[outcome])
+    return outcome
+
+
+def verify_return_to(oreq):
+    """
+    Verify the return_to of the CheckIDRequest, like
+    oreq.returnToVerified(), and cache the outcome for
+    settings.OPENID_RETURN_TO_TTL[outcome] seconds.
+
+    If the verification was prefetched and is still running
+    in this process, its outcome is waited for.
+    """
+    prefetcher.wait(oreq.trust_root, oreq.return_to)
+    return _verify(oreq.trust_root, oreq.return_to)
+
+
+class DiscoveryPrefetcher(object):
+    """
+    Verifies return_to URLs in background threads, so that
+    the relying party discovery runs while the user logs in.
+    The outcomes end up in the cache used by verify_return_to().
+
+    It runs settings.OPENID_PREFETCH_WORKERS threads, started
+    on the first use. Requests that don't fit in the queue are
+    dropped, and verified when needed instead.
+    """
+
+    def __init__(self, queue_size=100):
+        self._queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        # key -> Event set when the verification is done
+        self._pending = {}
+        self._started = False
+
+    def _start(self):
+        # called with the lock held
+        for i in range(settings.OPENID_PREFETCH_WORKERS):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+        self._started = True
+
+    def _done(self, key):
+        with self._lock:
+            event = self._pending.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def submit(self, trust_root, return_to):
+        """
+        Start verifying return_to, unless the outcome is known.
+        """
+        if not settings.OPENID_PREFETCH_WORKERS:
+            return
+        key = _return_to_key(trust_root, return_to)
+        if cache.get(key) is not None:
+            return
+        with self._lock:
+            if key in self._pending:
+                return
+            if not self._started:
+                self._start()
+            self._pending[key] = threading.Event()
+        try:
+            self._queue.put_nowait((key, trust_root, return_to))
+        except Queue.Full:
+            self._done(key)
+
+    def wait(self, trust_root, return_to):
+        """
+        Wait at most settings.OPENID_PREFETCH_WAIT seconds for
+        the prefetch of return_to, if it is running.
+        """
+        event = self._pending.get(_return_to_key(trust_root, return_to))
+        if event is not None:
+            event.wait(settings.OPENID_PREFETCH_WAIT)
+
+    def _work(self):
+        while True:
+            key, trust_root, return_to = self._queue.get()
+            try:
+                _verify(trust_root, return_to)
+            except Exception as error:
+                logger.error('Prefetching discovery of %s failed: %s'
+                             % (trust_root, error))
+            finally:
+                self._done(key)
+
+
+prefetcher = DiscoveryPrefetcher()
+
+# the fetcher of python-openid, None when it's left to the default one
+fetcher = openid_fetcher.install()
@@ -3,9 +3,18 @@
 import base64
 import calendar
 import datetime
+import hashlib
+import logging
+import struct
+import threading
+import time
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.db import IntegrityError
 from django.utils import timezone
+from django.utils.importlib import import_module
 
 from openid.store.interface import OpenIDStore
 from openid.association import Association
@@ -13,6 +22,76 @@ from openid.store import nonce
 
 from okupy.accounts import models as db_models
 
+logger = logging.getLogger('okupy')
+
+
+def get_openid_store():
+    """
+    Get an instance of the OpenIDStore class named
+    by settings.OPENID_STORE.
+    """
+    module, attr = settings.OPENID_STORE.rsplit('.', 1)
+    try:
+        store_class = getattr(import_module(module), attr)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured(
+            'Error importing OpenID store %s: %s' % (settings.OPENID_STORE, e))
+    store = store_class()
+    if settings.OPENID_PURGE_INTERVAL is not None:
+        purge_scheduler.start(store)
+    return store
+
+
+def purge(queryset, batch_size):
+    """
+    Delete the objects of queryset, batch_size of them at a time,
+    so that the tables aren't locked for long. Returns the number
+    of deleted objects.
+    """
+    model = queryset.model
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        model.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+
+
+class PurgeScheduler(object):
+    """
+    Calls the cleanup methods of an OpenIDStore every
+    settings.OPENID_PURGE_INTERVAL seconds, in a background thread
+    of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, store):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(store,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, store):
+        while True:
+            time.sleep(settings.OPENID_PURGE_INTERVAL)
+            try:
+                nonces = store.cleanupNonces()
+                assocs = store.cleanupAssociations()
+            except Exception as error:
+                logger.error('Purging the OpenID store failed: %s' % error)
+            else:
+                logger.info('Purged %d OpenID nonces and %d associations'
+                            % (nonces, assocs))
+
+
+purge_scheduler = PurgeScheduler()
+
 
 class DjangoDBOpenIDStore(OpenIDStore):
 
@@ -65,11 +144,11 @@ class DjangoDBOpenIDStore(OpenIDStore):
         assert(server_uri is not None)
         assert(handle is not None)
 
-        self._db_getAssocs(server_uri, handle)
-
-        # determining whether something was deleted is a waste of time
-        # and django doesn't give us explicit 'affected rows'
-        return True
+        objs = self._db_getAssocs(server_uri, handle)
+        # django doesn't give us explicit 'affected rows'
+        existed = objs.exists()
+        objs.delete()
+        return existed
 
     def useNonce(self, server_uri, ts, salt):
         nonce_dt = datetime.datetime.utcfromtimestamp(ts)
@@ -89,14 +168,221 @@ class DjangoDBOpenIDStore(OpenIDStore):
             return False
         return True
 
-    def cleanupNonces(self):
+    def cleanupNonces(self, batch_size=None):
         skew_td = datetime.timedelta(seconds=nonce.SKEW)
         expire_dt = timezone.now() - skew_td
 
-        db_models.OpenID_Nonce.objects.filter(ts__lt=expire_dt).delete()
+        return purge(
+            db_models.OpenID_Nonce.objects.filter(ts__lt=expire_dt),
+            batch_size or settings.OPENID_PURGE_BATCH_SIZE)
+
+    def cleanupAssociations(self, batch_size=None):
+        return purge(
+            db_models.OpenID_Association.objects.filter(
+                expires__lt=timezone.now()),
+            batch_size or settings.OPENID_PURGE_BATCH_SIZE)
+
+
+class CacheOpenIDStore(OpenIDStore):
+    """
+    OpenIDStore keeping the associations and nonces in the cache,
+    so that OpenID requests don't write to the database.
+
+    Nonces are used atomically with cache.add(), and expire once they
+    are out of the allowed nonce.SKEW. Associations expire with their
+    lifetime. The handles of the associations of each server_uri are
+    indexed, so that the latest one can be found.
+    """
+
+    prefix = 'okupy.openid_store.'
+
+    def _key(self, kind, *parts):
+        # memcached keys can't be long or contain whitespace
+        digest = hashlib.sha1(
+            '\0'.join(unicode(p).encode('utf8') for p in parts)).hexdigest()
+        return '%s%s.%s' % (self.prefix, kind, digest)
+
+    def _index_key(self, server_uri):
+        return self._key('handles', server_uri)
+
+    def _assoc_key(self, server_uri, handle):
+        return self._key('assoc', server_uri, handle)
+
+    def storeAssociation(self, server_uri, assoc):
+        lifetime = assoc.expiresIn
+        if lifetime <= 0:
+            return
+        cache.set(self._assoc_key(server_uri, assoc.handle),
+                  assoc.serialize(), lifetime)
+
+        index_key = self._index_key(server_uri)
+        index = cache.get(index_key, {})
+        now = time.time()
+        # drop the expired handles while at it
+        index = dict((h, e) for h, e in index.items() if e > now)
+        index[assoc.handle] = assoc.issued + assoc.lifetime
+        cache.set(index_key, index, int(max(index.values()) - now) + 1)
+
+    def getAssociation(self, server_uri, handle=None):
+        assert(server_uri is not None)
+
+        if handle is not None:
+            handles = [handle]
+        else:
+            handles = cache.get(self._index_key(server_uri), {}).keys()
+        if not handles:
+            return None
+
+        keys = dict((self._assoc_key(server_uri, h), h) for h in handles)
+        found = cache.get_many(keys.keys())
+        assocs = [Association.deserialize(v) for v in found.values()]
+        assocs = [a for a in assocs if a.expiresIn > 0]
+        if not assocs:
+            return None
+        return max(assocs, key=lambda a: a.issued)
+
+    def removeAssociation(self, server_uri, handle):
+        assert(server_uri is not None)
+        assert(handle is not None)
+
+        key = self._assoc_key(server_uri, handle)
+        existed = cache.get(key) is not None
+        cache.delete(key)
+        return existed
+
+    def useNonce(self, server_uri, ts, salt):
+        # the nonce is valid till ts + SKEW, it must not be
+        # forgotten before
+        ttl = int(ts + nonce.SKEW - time.time()) + 1
+        if abs(ts - time.time()) > nonce.SKEW or ttl <= 0:
+            return False
+        return cache.add(self._key('nonce', server_uri, ts, salt), True, ttl)
+
+    def cleanupNonces(self):
+        # they expire on their own
         return 0
 
     def cleanupAssociations(self):
-        db_models.OpenID_Association.objects.filter(
-            expires__lt=timezone.now()).delete()
         return 0
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of SHA-1 digests, using 4-byte slices of the digest
+    as the hashes.
+    """
+
+    def __init__(self, bits, hashes=4):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    def _positions(self, digest):
+        for i in range(self.hashes):
+            yield struct.unpack_from('>I', digest, i * 4)[0] % self.bits
+
+    def add(self, digest):
+        for p in self._positions(digest):
+            self.array[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, digest):
+        return all(self.array[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(digest))
+
+
+class NonceFilter(object):
+    """
+    In-memory record of the used nonces, for replay detection.
+
+    Nonces are hashed into buckets by their timestamp, each
+    nonce.SKEW wide. Nonces are only accepted within nonce.SKEW
+    from now, so only the buckets of the last 2 * nonce.SKEW are
+    needed; older ones are dropped as a whole.
+
+    With bloom_bits, each bucket has a Bloom filter of that size
+    in front of the exact set, which then is only searched for
+    the nonces the filter has seen already.
+    """
+
+    def __init__(self, width=nonce.SKEW, bloom_bits=None):
+        self.width = width
+        self.bloom_bits = bloom_bits
+        # bucket number -> (BloomFilter or None, set of digests)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _rotate(self, now):
+        oldest = int((now - self.width) // self.width)
+        for index in [i for i in self._buckets if i < oldest]:
+            del self._buckets[index]
+
+    def use(self, server_uri, ts, salt, now=None):
+        """
+        Record the nonce. Returns False if it was used already,
+        or is out of the allowed skew.
+        """
+        if now is None:
+            now = time.time()
+        if abs(ts - now) > self.width:
+            return False
+
+        key = '\0'.join((server_uri.encode('utf8'), repr(ts),
+                          salt.encode('utf8')))
+        digest = hashlib.sha1(key).digest()
+        index = int(ts // self.width)
+        with self._lock:
+            self._rotate(now)
+            bucket = self._buckets.get(index)
+            if bucket is None:
+                bloom = (BloomFilter(self.bloom_bits)
+                         if self.bloom_bits else None)
+                bucket = self._buckets[index] = (bloom, set())
+            bloom, seen = bucket
+            if (bloom is None or digest in bloom) and digest in seen:
+                return False
+            seen.add(digest)
+            if bloom is not None:
+                bloom.add(digest)
+        return True
+
+    def __len__(self):
+        return sum(len(seen) for bloom, seen in self._buckets.values())
+
+
+_nonce_filter = None
+_nonce_filter_lock = threading.Lock()
+
+
+def get_nonce_filter():
+    """ Get the NonceFilter of the process """
+    global _nonce_filter
+    with _nonce_filter_lock:
+        if _nonce_filter is None:
+            _nonce_filter = NonceFilter(
+                bloom_bits=settings.OPENID_NONCE_BLOOM_BITS)
+        return _nonce_filter
+
+
+class LocalNonceMixin(object):
+    """
+    Keeps the used nonces in the memory of the process (NonceFilter),
+    instead of the store.
+
+    Replays are only caught if they reach the same process, so this
+    is only safe when a single process serves the OpenID endpoint.
+    """
+
+    def useNonce(self, server_uri, ts, salt):
+        return get_nonce_filter().use(server_uri, ts, salt)
+
+    def cleanupNonces(self, *args, **kwargs):
+        # the filter drops the old buckets itself
+        return 0
+
+
+class LocalNonceDBOpenIDStore(LocalNonceMixin, DjangoDBOpenIDStore):
+    pass
+
+
+class LocalNonceCacheOpenIDStore(LocalNonceMixin, CacheOpenIDStore):
+    pass
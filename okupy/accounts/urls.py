@@ -7,6 +7,7 @@ accounts_urlpatterns = patterns(
     '',
     url(r'^$', v.index, name="index"),
     url(r'^login/$', v.login),
+    url(r'^login/tokens/$', v.login_tokens),
     url(r'^ssl-auth/$', v.ssl_auth),
     url(r'^logout/$', v.logout, name="logout"),
     url(r'^devlist/$', v.lists, {'acc_list': 'devlist'},
@@ -28,5 +29,6 @@ accounts_urlpatterns = patterns(
     url(r'^otp-qrcode.png$', v.otp_qrcode),
     url(r'^endpoint/$', v.openid_endpoint),
     url(r'^id/(.*)/$', v.user_page),
+    url(r'^xrds/$', v.openid_xrds),
     url(r'^auth-site/$', v.openid_auth_site),
 )
@@ -4,22 +4,27 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import (login as _login, logout as _logout,
                                  authenticate)
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
 from django.db import IntegrityError
-from django.forms.models import model_to_dict
 from django.http import (HttpResponse, HttpResponseForbidden,
                          HttpResponseBadRequest)
 from django.views.decorators.cache import cache_page
 from django.shortcuts import redirect, render
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.html import format_html
+from django.utils.http import urlencode
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import condition, require_POST
 from django_otp.decorators import otp_required
 
 from openid.extensions.ax import FetchRequest, FetchResponse
 from openid.extensions.sreg import SRegRequest, SRegResponse
-from openid.server.server import (Server, ProtocolError, EncodingError,
+from openid.message import IDENTIFIER_SELECT
+from openid.server.server import (ProtocolError, EncodingError,
                                   CheckIDRequest, ENCODE_URL,
                                   ENCODE_KVFORM, ENCODE_HTML_FORM)
 from passlib.hash import ldap_md5_crypt
@@ -32,11 +37,15 @@ from okupy.accounts.forms import (LoginForm, OpenIDLoginForm, SSLCertLoginForm,
                                   ContactSettingsForm, EmailSettingsForm,
                                   GentooAccountSettingsForm,
                                   PasswordSettingsForm)
-from okupy.accounts.models import LDAPUser, OpenID_Attributes, Queue
-from okupy.accounts.openid_store import DjangoDBOpenIDStore
+from okupy.accounts.models import (LDAPUser, LDAPUserMirror,
+                                   OpenID_Attributes, Queue)
+from okupy.accounts import openid_rp
+from okupy.accounts.openid_dh import PooledDHServer
+from okupy.accounts.openid_store import get_openid_store
 from okupy.common.ldap_helpers import (get_bound_ldapuser,
                                        set_secondary_password,
-                                       remove_secondary_password)
+                                       remove_secondary_password,
+                                       uid_allocator)
 from okupy.common.decorators import strong_auth_required, anonymous_required
 from okupy.common.log import log_extra_data
 from okupy.crypto.ciphers import sessionrefcipher
@@ -45,15 +54,13 @@ from okupy.otp import init_otp
 from okupy.otp.sotp.models import SOTPDevice
 from okupy.otp.totp.models import TOTPDevice
 
-# the following two are for exceptions
-import openid.yadis.discover
-import openid.fetchers
 import django_otp
 import hashlib
 import io
 import ldap
 import logging
 import qrcode
+import threading
 
 logger = logging.getLogger('okupy')
 logger_mail = logging.getLogger('mail_okupy')
@@ -61,7 +68,7 @@ logger_mail = logging.getLogger('mail_okupy')
 
 @cache_page(60 * 20)
 def lists(request, acc_list):
-    devlist = LDAPUser.objects.all()
+    devlist = LDAPUserMirror.objects.all()
     if acc_list == 'devlist':
         devlist = devlist.filter(is_developer=True)
     elif acc_list == 'former-devlist':
@@ -82,7 +89,7 @@ def index(request):
 def login(request):
     """ The login page """
     user = None
-    oreq = request.session.get('openid_request', None)
+    oreq = load_openid_request(request)
     # this can be POST or GET, and can be null or empty
     next = request.REQUEST.get('next') or reverse(index)
     is_otp = False
@@ -163,6 +170,9 @@ def login(request):
         # prepare devices, and see if OTP is enabled
         init_otp(request)
         set_secondary_password(request=request, password=password)
+        if oreq:
+            # discover the RP while the user goes through OTP
+            openid_rp.prefetcher.submit(oreq.trust_root, oreq.return_to)
     if request.user.is_authenticated():
         if (strong_auth_req
                 and not 'secondary_password' in request.session):
@@ -177,13 +187,18 @@ def login(request):
     if login_form is None:
         login_form = login_form_class()
 
+    ssl_auth_form = None
+    ssl_auth_uri = None
+    ssh_auth_command = None
     if is_otp or strong_auth_req:
-        ssl_auth_form = None
-        ssl_auth_uri = None
-        ssh_auth_command = None
+        auth_tokens = False
+        encrypted_id = None
     else:
-        encrypted_id = sessionrefcipher.encrypt(request.session)
-
+        # creating the token saves the session, so it is done by
+        # login_tokens() when asked for, and only reused here
+        auth_tokens = True
+        encrypted_id = request.session.get('encrypted_id')
+    if encrypted_id is not None:
         # TODO: it fails when:
         # 1. site is accessed via IP (auth.127.0.0.1),
         # 2. HTTP used on non-standard port (https://...:8000).
@@ -214,10 +229,22 @@ def login(request):
         'ssl_auth_uri': ssl_auth_uri,
         'ssl_auth_form': ssl_auth_form,
         'ssh_auth_command': ssh_auth_command,
+        'auth_tokens': auth_tokens,
         'is_otp': is_otp,
     })
 
 
+@require_POST
+def login_tokens(request):
+    """
+    Create the token for SSL certificate and SSH authentication, and
+    go back to the login page showing them.
+    """
+    sessionrefcipher.encrypt(request.session)
+    next = request.POST.get('next') or reverse(index)
+    return redirect('%s?%s' % (reverse(login), urlencode({'next': next})))
+
+
 @csrf_exempt
 @require_POST
 def ssl_auth(request):
@@ -340,11 +367,8 @@ def activate(request, token):
             logger.critical(error, extra=log_extra_data(request))
             logger_mail.exception(error)
             raise OkupyError("Can't contact the database")
-        # get max uidNumber
         try:
-            uidnumber = LDAPUser.objects.latest('uid').uid + 1
-        except LDAPUser.DoesNotExist:
-            uidnumber = 1
+            uidnumber = uid_allocator.allocate()
         except Exception as error:
             logger.critical(error, extra=log_extra_data(request))
             logger_mail.exception(error)
@@ -737,9 +761,51 @@ def endpoint_url(request):
     return request.build_absolute_uri(reverse(openid_endpoint))
 
 
+# (endpoint URL, store class) -> Server, shared by the threads
+# of the process
+_openid_servers = {}
+_openid_servers_lock = threading.Lock()
+# bounds the servers built for bogus Host headers
+MAX_OPENID_SERVERS = 16
+
+
 def get_openid_server(request):
-    store = DjangoDBOpenIDStore()
-    return Server(store, endpoint_url(request))
+    """
+    Get the OpenID Server of the endpoint the request came to.
+    One is built per endpoint URL and process; the stores keep no
+    per-thread state, so it is safe to share between threads.
+    """
+    url = endpoint_url(request)
+    key = (url, settings.OPENID_STORE)
+    srv = _openid_servers.get(key)
+    if srv is None:
+        with _openid_servers_lock:
+            srv = _openid_servers.get(key)
+            if srv is None:
+                srv = PooledDHServer(get_openid_store(), url)
+                if len(_openid_servers) < MAX_OPENID_SERVERS:
+                    _openid_servers[key] = srv
+    return srv
+
+
+def save_openid_request(request, oreq):
+    """
+    Keep the pending CheckIDRequest in the session, as the arguments
+    of its message, which are much smaller than the pickled object.
+    """
+    request.session['openid_request'] = oreq.message.toPostArgs()
+
+
+def load_openid_request(request):
+    """
+    Rebuild the CheckIDRequest kept in the session, or return None
+    if there is none.
+    """
+    args = request.session.get('openid_request')
+    if args is None or isinstance(args, CheckIDRequest):
+        # sessions from before the requests were kept as arguments
+        return args
+    return get_openid_server(request).decodeRequest(args)
 
 
 def render_openid_response(request, oresp, srv=None):
@@ -788,12 +854,16 @@ def openid_endpoint(request):
         return render(request, 'openid_endpoint.html')
 
     if isinstance(oreq, CheckIDRequest):
-        # immediate requests not supported yet, so immediately
-        # reject them.
+        # immediate requests can't ask the user, so they are answered
+        # only for sites the user always authenticates to
         if oreq.immediate:
-            oresp = oreq.answer(False)
+            oresp = openid_immediate_answer(request, oreq)
         else:
-            request.session['openid_request'] = oreq
+            save_openid_request(request, oreq)
+            # discover the RP while the user is asked; not for anonymous
+            # requests, which would let anyone make us fetch any URL
+            if request.user.is_authenticated():
+                openid_rp.prefetcher.submit(oreq.trust_root, oreq.return_to)
             return redirect(openid_auth_site)
     else:
         oresp = srv.handleRequest(oreq)
@@ -801,10 +871,78 @@ def openid_endpoint(request):
     return render_openid_response(request, oresp, srv)
 
 
+XRDS_CONTENT_TYPE = 'application/xrds+xml'
+
+
+def openid_document(request, kind):
+    """
+    Return the body and ETag of the discovery document of the endpoint
+    the request came to, kind being 'xrds' or 'html'. The documents are
+    cached for settings.OPENID_DOCUMENT_MAX_AGE seconds.
+    """
+    url = endpoint_url(request)
+    key = 'okupy.openid_document.%s.%s' % (kind, hashlib.sha1(url).hexdigest())
+    doc = cache.get(key)
+    if doc is None:
+        if kind == 'xrds':
+            body = render_to_string('openid-xrds.xml', {'endpoint_uri': url})
+        else:
+            # the page of the anonymous user, which is the same for all
+            body = render_to_string('user-page.html', {'endpoint_uri': url},
+                                    RequestContext(request))
+        body = body.encode('utf8')
+        doc = (body, hashlib.sha1(body).hexdigest())
+        cache.set(key, doc, settings.OPENID_DOCUMENT_MAX_AGE)
+    return doc
+
+
+def identity_document_kind(request):
+    """
+    Return the kind of the shared document the request gets from
+    user_page, or None if the page has to be rendered for the user.
+    """
+    if XRDS_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+        return 'xrds'
+    if not request.user.is_authenticated():
+        return 'html'
+    return None
+
+
+def document_response(request, kind):
+    body, etag = openid_document(request, kind)
+    content_type = (XRDS_CONTENT_TYPE if kind == 'xrds'
+                    else 'text/html; charset=utf-8')
+    response = HttpResponse(body, content_type=content_type)
+    patch_cache_control(response, max_age=settings.OPENID_DOCUMENT_MAX_AGE)
+    return response
+
+
+def user_page_etag(request, username):
+    kind = identity_document_kind(request)
+    if kind is None:
+        return None
+    return openid_document(request, kind)[1]
+
+
+@condition(etag_func=user_page_etag)
 def user_page(request, username):
-    return render(request, 'user-page.html', {
-        'endpoint_uri': endpoint_url(request),
-    })
+    kind = identity_document_kind(request)
+    if kind is None:
+        response = render(request, 'user-page.html', {
+            'endpoint_uri': endpoint_url(request),
+        })
+    else:
+        response = document_response(request, kind)
+    response['X-XRDS-Location'] = request.build_absolute_uri(
+        reverse(openid_xrds))
+    patch_vary_headers(response, ('Accept', 'Cookie'))
+    return response
+
+
+@condition(etag_func=lambda request: openid_document(request, 'xrds')[1])
+def openid_xrds(request):
+    """ The Yadis document of the identities of the endpoint """
+    return document_response(request, 'xrds')
 
 
 openid_ax_attribute_mapping = {
@@ -823,16 +961,19 @@ openid_ax_attribute_mapping = {
 }
 
 
-@otp_required
-def openid_auth_site(request):
-    try:
-        oreq = request.session['openid_request']
-    except KeyError:
-        return render(request, 'openid-auth-site.html', {
-            'error': 'No OpenID request associated. The request may have \
-            expired.',
-        }, status=400)
+return_to_messages = {
+    openid_rp.VERIFIED: 'Return-To valid and trusted',
+    openid_rp.UNTRUSTED: 'Return-To untrusted',
+    openid_rp.DISCOVERY_FAILURE: 'Unable to verify trust (Yadis unsupported)',
+    openid_rp.HTTP_FAILURE: 'Unable to verify trust (HTTP error)',
+}
 
+
+def openid_requested_data(oreq, ldap_user):
+    """
+    Return the SReg and AX requests of oreq, and the values
+    of the requested attributes that ldap_user has.
+    """
     sreg = SRegRequest.fromOpenIDRequest(oreq)
     ax = FetchRequest.fromOpenIDRequest(oreq)
 
@@ -843,7 +984,6 @@ def openid_auth_site(request):
             if k:
                 sreg_fields.add(k)
 
-    ldap_user = LDAPUser.objects.get(username=request.user.username)
     if sreg_fields:
         sreg_data = {
             'nickname': ldap_user.username,
@@ -857,75 +997,146 @@ def openid_auth_site(request):
                 del sreg_data[k]
     else:
         sreg_data = {}
-    sreg_fields = sreg_data.keys()
+    return sreg, ax, sreg_data
+
 
-    # Read preferences from the db.
+def openid_release(sreg_data, choices):
+    """
+    Drop the attributes that choices don't send from sreg_data,
+    and pick the chosen values of the multi-valued ones. Returns
+    the picked values, by their which_* choice.
+    """
+    picked = {}
+    for fn, send in choices.items():
+        if fn not in sreg_data:
+            pass
+        elif not send:
+            del sreg_data[fn]
+        elif isinstance(sreg_data[fn], list):
+            form_key = 'which_%s' % fn
+            val = choices[form_key]
+            if val not in sreg_data[fn]:
+                raise NotImplementedError(
+                    'Changing choices not implemented yet')
+            sreg_data[fn] = val
+            picked[form_key] = val
+    return picked
+
+
+def openid_identity(request):
+    """ Return the identity URL of the logged in user """
+    return request.build_absolute_uri(
+        reverse(user_page, args=(request.user.username,)))
+
+
+def openid_accept(request, oreq, sreg, ax, sreg_data):
+    """
+    Answer oreq positively for the logged in user, sending sreg_data
+    through SReg and AX.
+    """
+    oresp = oreq.answer(True, identity=openid_identity(request))
+
+    sreg_resp = SRegResponse.extractResponse(sreg, sreg_data)
+    oresp.addExtension(sreg_resp)
+
+    if ax:
+        ax_resp = FetchResponse(ax)
+        for uri in ax.requested_attributes:
+            k = openid_ax_attribute_mapping.get(uri)
+            if k and k in sreg_data:
+                ax_resp.addValue(uri, sreg_data[k])
+        oresp.addExtension(ax_resp)
+    return oresp
+
+
+def openid_immediate_answer(request, oreq):
+    """
+    Answer a checkid_immediate request without user interaction:
+    positively if the user is logged in, OTP-verified and always
+    authenticates to the site, negatively otherwise.
+    """
+    user = request.user
+    if not (user.is_authenticated() and user.is_verified()):
+        return oreq.answer(False)
+    if oreq.identity not in (IDENTIFIER_SELECT, openid_identity(request)):
+        # asked about another identity, which only its owner can confirm
+        return oreq.answer(False)
+
+    ldap_user = LDAPUser.objects.get(username=user.username)
+    prefs = OpenID_Attributes.auto_auth_prefs(ldap_user.uid, oreq.trust_root)
+    if prefs is None:
+        return oreq.answer(False)
+
+    sreg, ax, sreg_data = openid_requested_data(oreq, ldap_user)
     try:
-        saved_pref = OpenID_Attributes.objects.get(
-            uid=ldap_user.uid,
-            trust_root=oreq.trust_root,
-        )
-    except OpenID_Attributes.DoesNotExist:
+        openid_release(sreg_data, prefs)
+    except NotImplementedError:
+        # the saved choice is gone, the user has to choose again
+        return oreq.answer(False)
+    return openid_accept(request, oreq, sreg, ax, sreg_data)
+
+
+@otp_required
+def openid_auth_site(request):
+    oreq = load_openid_request(request)
+    if oreq is None:
+        return render(request, 'openid-auth-site.html', {
+            'error': 'No OpenID request associated. The request may have \
+            expired.',
+        }, status=400)
+
+    ldap_user = LDAPUser.objects.get(username=request.user.username)
+    sreg, ax, sreg_data = openid_requested_data(oreq, ldap_user)
+    sreg_fields = sreg_data.keys()
+
+    # Read the preferences of always authenticated sites from the cache,
+    # and the other ones from the db.
+    auto_prefs = OpenID_Attributes.auto_auth_prefs(ldap_user.uid,
+                                                   oreq.trust_root)
+    auto_auth = auto_prefs is not None
+    if auto_auth:
         saved_pref = None
-        auto_auth = False
     else:
-        auto_auth = saved_pref.always_auth
+        try:
+            saved_pref = OpenID_Attributes.objects.get(
+                uid=ldap_user.uid,
+                trust_root=oreq.trust_root,
+            )
+        except OpenID_Attributes.DoesNotExist:
+            saved_pref = None
 
     if auto_auth or request.POST:
         if auto_auth:
-            # TODO: can we do this nicer?
-            form_inp = model_to_dict(saved_pref)
+            # the saved preferences were valid when saved
+            choices = auto_prefs
         else:
-            form_inp = request.POST
-        form = SiteAuthForm(form_inp, instance=saved_pref)
-        # can it be invalid somehow?
-        assert(form.is_valid())
-        attrs = form.save(commit=False)
-
-        # nullify fields that were not requested
-        for fn in form.cleaned_data:
-            if fn in ('always_auth',):
-                pass
-            elif hasattr(attrs, fn) and fn not in sreg_fields:
-                setattr(attrs, fn, None)
+            form = SiteAuthForm(request.POST, instance=saved_pref)
+            # can it be invalid somehow?
+            assert(form.is_valid())
+            attrs = form.save(commit=False)
+            choices = form.cleaned_data
+
+            # nullify fields that were not requested
+            for fn in form.cleaned_data:
+                if fn in ('always_auth',):
+                    pass
+                elif hasattr(attrs, fn) and fn not in sreg_fields:
+                    setattr(attrs, fn, None)
 
         if auto_auth or 'accept' in request.POST:
             # prepare sreg response
-            for fn, send in form.cleaned_data.items():
-                if fn not in sreg_data:
-                    pass
-                elif not send:
-                    del sreg_data[fn]
-                elif isinstance(sreg_data[fn], list):
-                    form_key = 'which_%s' % fn
-                    val = form.cleaned_data[form_key]
-                    if val not in sreg_data[fn]:
-                        raise NotImplementedError(
-                            'Changing choices not implemented yet')
-                    sreg_data[fn] = val
-                    if not auto_auth:
-                        setattr(attrs, form_key, val)
+            picked = openid_release(sreg_data, choices)
 
             if not auto_auth:
                 # save prefs in the db
                 # (if auto_auth, then nothing changed)
+                for form_key, val in picked.items():
+                    setattr(attrs, form_key, val)
                 attrs.uid = ldap_user.uid
                 attrs.trust_root = oreq.trust_root
                 attrs.save()
 
-            oresp = oreq.answer(True, identity=request.build_absolute_uri(
-                reverse(user_page, args=(request.user.username,))))
-
-            sreg_resp = SRegResponse.extractResponse(sreg, sreg_data)
-            oresp.addExtension(sreg_resp)
-
-            if ax:
-                ax_resp = FetchResponse(ax)
-                for uri in ax.requested_attributes:
-                    k = openid_ax_attribute_mapping.get(uri)
-                    if k and k in sreg_data:
-                        ax_resp.addValue(uri, sreg_data[k])
-                oresp.addExtension(ax_resp)
+            oresp = openid_accept(request, oreq, sreg, ax, sreg_data)
         elif 'reject' in request.POST:
             oresp = oreq.answer(False)
         else:
@@ -957,20 +1168,10 @@ def openid_auth_site(request):
                                        + " value='{0}' />",
                                        sreg_data[f])
 
-    try:
-        # TODO: cache it
-        if oreq.returnToVerified():
-            tr_valid = 'Return-To valid and trusted'
-        else:
-            tr_valid = 'Return-To untrusted'
-    except openid.yadis.discover.DiscoveryFailure:
-        tr_valid = 'Unable to verify trust (Yadis unsupported)'
-    except openid.fetchers.HTTPFetchingError:
-        tr_valid = 'Unable to verify trust (HTTP error)'
-
     return render(request, 'openid-auth-site.html', {
         'openid_request': oreq,
-        'return_to_valid': tr_valid,
+        'return_to_valid': return_to_messages[
+            openid_rp.verify_return_to(oreq)],
         'form': form,
         'sreg': sreg_fields,
         'sreg_form': sreg_form,
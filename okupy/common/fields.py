@@ -5,15 +5,49 @@ from django.db.models import fields
 from ldapdb import escape_ldap_filter
 
 
+class ACLFieldDescriptor(object):
+    """
+    Attribute of an ACLField on model instances. Set to the gentooACL
+    list by ldapdb, it keeps whether the entry is in the group of the
+    field; the list is parsed into a set once per instance, and shared
+    by its ACLFields.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__dict__.get(self.field.attname)
+
+    def __set__(self, instance, value):
+        if isinstance(value, list):
+            parsed = instance.__dict__.get('_parsed_acl')
+            if parsed is None or parsed[0] is not value:
+                parsed = (value, frozenset(value))
+                instance.__dict__['_parsed_acl'] = parsed
+            value = self.field.group in parsed[1]
+        instance.__dict__[self.field.attname] = value
+
+
 class ACLField(fields.Field):
-    def _group(self):
-        return self.name.split('_')[1] + '.group'
+    """
+    Boolean field telling whether the entry is in the ACL group named
+    after the field (e.g. is_developer -> developer.group).
+
+    All ACLFields of a model share the same LDAP attribute, which
+    from_ldap() passes on as it is; ACLFieldDescriptor parses it once
+    for each loaded entry.
+    """
+
+    def contribute_to_class(self, cls, name):
+        super(ACLField, self).contribute_to_class(cls, name)
+        self.group = name.split('_')[1] + '.group'
+        setattr(cls, self.attname, ACLFieldDescriptor(self))
 
     def from_ldap(self, value, connection):
-        if self._group() in value:
-            return True
-        else:
-            return False
+        return value
 
     def get_db_prep_lookup(self, lookup_type, value,
                            connection, prepared=False):
@@ -29,8 +63,8 @@ class ACLField(fields.Field):
             raise TypeError("Invalid value")
         if lookup_type == 'exact':
             if value:
-                return escape_ldap_filter(self._group())
+                return escape_ldap_filter(self.group)
             else:
                 raise NotImplementedError(
-                    "Negative lookups on ACLField are not yet implemented")
+                    "Negative lookups on ACLField need ACLQuerySet")
         raise TypeError("ACLField has invalid lookup: %s" % lookup_type)
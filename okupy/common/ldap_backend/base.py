@@ -0,0 +1,267 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+LDAP database backend for okupy.
+
+It extends the ldapdb backend with sending the read-only queries
+of the service account to read replicas, a circuit breaker
+for the primary server, and recording of the operations
+for okupy.common.ldap_backend.stats.
+"""
+
+from django.conf import settings
+
+from ldapdb.backends.ldap import base as ldapdb_base
+
+from okupy.common.ldap_backend import stats
+from okupy.common.ldap_backend.breaker import CircuitBreaker, SERVER_ERRORS
+
+import ldap
+import logging
+import threading
+import time
+
+logger = logging.getLogger('okupy')
+
+
+class ReplicaPool(object):
+    """
+    A set of LDAP read replicas, shared by all connections
+    of the process.
+
+    Replicas are picked round-robin. The ones that fail are ejected,
+    and all of them are health-checked in the background at most
+    every settings.AUTH_LDAP_REPLICA_RETRY seconds. Healthy ones
+    are put back into rotation then.
+    """
+
+    def __init__(self, uris, settings_dict):
+        self.uris = tuple(uris)
+        self.settings_dict = settings_dict
+        self._lock = threading.Lock()
+        self._next = 0
+        self._ejected = set()
+        self._last_check = time.time()
+        self._checking = False
+
+    def choose(self):
+        """
+        Return the URI of the next healthy replica, or None if all
+        of them are ejected.
+        """
+        with self._lock:
+            self._schedule_check()
+            for i in range(len(self.uris)):
+                uri = self.uris[(self._next + i) % len(self.uris)]
+                if uri not in self._ejected:
+                    self._next = (self._next + i + 1) % len(self.uris)
+                    return uri
+        return None
+
+    def eject(self, uri, error=None):
+        """
+        Take the replica out of rotation till the next health check.
+        """
+        with self._lock:
+            if uri not in self._ejected:
+                logger.warning('Ejecting LDAP replica %s: %s' % (uri, error))
+                self._ejected.add(uri)
+
+    def _schedule_check(self):
+        # called with the lock held
+        interval = settings.AUTH_LDAP_REPLICA_RETRY
+        if self._checking or time.time() - self._last_check < interval:
+            return
+        self._checking = True
+        t = threading.Thread(target=self.check)
+        t.daemon = True
+        t.start()
+
+    def probe(self, uri):
+        """
+        Check whether the replica accepts binds and answers searches.
+        """
+        conn = connect(uri, self.settings_dict)
+        try:
+            conn.search_s(settings.AUTH_LDAP_USER_BASE_DN, ldap.SCOPE_BASE)
+        finally:
+            conn.unbind_s()
+
+    def check(self):
+        """
+        Health-check all replicas, ejecting the failing ones
+        and restoring the healthy ones.
+        """
+        try:
+            for uri in self.uris:
+                try:
+                    self.probe(uri)
+                except ldap.LDAPError as e:
+                    self.eject(uri, e)
+                else:
+                    with self._lock:
+                        if uri in self._ejected:
+                            logger.info('Restoring LDAP replica %s' % uri)
+                            self._ejected.discard(uri)
+        finally:
+            with self._lock:
+                self._last_check = time.time()
+                self._checking = False
+
+
+_replica_pools = {}
+_replica_pools_lock = threading.Lock()
+
+
+def get_replica_pool(uris, settings_dict):
+    """
+    Get the process-wide ReplicaPool for the given replica URIs.
+    """
+    key = tuple(uris)
+    with _replica_pools_lock:
+        if key not in _replica_pools:
+            _replica_pools[key] = ReplicaPool(uris, settings_dict)
+        return _replica_pools[key]
+
+
+def connect(uri, settings_dict):
+    """
+    Open an LDAP connection to uri, bound like the one described
+    by settings_dict.
+    """
+    conn = ldap.initialize(uri)
+    for opt, value in settings_dict.get('CONNECTION_OPTIONS', {}).items():
+        conn.set_option(opt, value)
+    if settings_dict.get('TLS', False):
+        conn.start_tls_s()
+    conn.simple_bind_s(settings_dict['USER'], settings_dict['PASSWORD'])
+    return conn
+
+
+class DatabaseWrapper(ldapdb_base.DatabaseWrapper):
+    """
+    ldapdb connection that sends the searches of the service account
+    to the replicas listed in settings_dict['REPLICAS'].
+
+    Writes, and connections bound as users (bind_as()), always use
+    the primary server. So do searches for settings.AUTH_LDAP_REPLICA_LAG
+    seconds after a write done through this connection, to let
+    the replicas catch up.
+
+    All operations on the primary server go through its CircuitBreaker.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.breaker = CircuitBreaker(self.settings_dict['NAME'])
+        self._replica_connections = {}
+        self._read_uri = None
+        self._primary_until = 0
+
+    @property
+    def replica_pool(self):
+        uris = self.settings_dict.get('REPLICAS')
+        if (not uris
+                or self.settings_dict['USER'] != settings.AUTH_LDAP_BIND_DN):
+            return None
+        return get_replica_pool(uris, self.settings_dict)
+
+    def _replica_connection(self, uri):
+        conn = self._replica_connections.get(uri)
+        if conn is None:
+            with stats.record('bind', self.settings_dict['USER']):
+                conn = connect(uri, self.settings_dict)
+            self._replica_connections[uri] = conn
+        return conn
+
+    def _drop_replica_connection(self, uri):
+        conn = self._replica_connections.pop(uri, None)
+        if conn is not None:
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+    def _cursor(self):
+        if self._read_uri is not None:
+            return ldapdb_base.DatabaseCursor(
+                self._replica_connection(self._read_uri))
+        if self.connection is None:
+            with stats.record('bind', self.settings_dict['USER']):
+                return super(DatabaseWrapper, self)._cursor()
+        return super(DatabaseWrapper, self)._cursor()
+
+    def close(self):
+        for uri in list(self._replica_connections):
+            self._drop_replica_connection(uri)
+        super(DatabaseWrapper, self).close()
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, *args, **kwargs):
+        with stats.record('search', base, filterstr, attrlist) as op:
+            results = self._search_s(base, scope, filterstr, attrlist,
+                                     *args, **kwargs)
+            op.set_results(results)
+        return results
+
+    def _search_s(self, *args, **kwargs):
+        pool = self.replica_pool
+        if pool is not None and time.time() >= self._primary_until:
+            # try each replica once at most, then fall back to primary
+            for i in range(len(pool.uris)):
+                uri = pool.choose()
+                if uri is None:
+                    break
+                self._read_uri = uri
+                try:
+                    return super(DatabaseWrapper, self).search_s(
+                        *args, **kwargs)
+                except SERVER_ERRORS as e:
+                    self._drop_replica_connection(uri)
+                    pool.eject(uri, e)
+                finally:
+                    self._read_uri = None
+        return self._call_primary(
+            super(DatabaseWrapper, self).search_s, *args, **kwargs)
+
+    def _call_primary(self, func, *args, **kwargs):
+        with self.breaker.guard():
+            try:
+                return func(*args, **kwargs)
+            except SERVER_ERRORS:
+                # reconnect next time
+                self.connection = None
+                raise
+
+    def _wrote(self):
+        self._primary_until = time.time() + settings.AUTH_LDAP_REPLICA_LAG
+
+    def add_s(self, dn, modlist, *args, **kwargs):
+        self._wrote()
+        with stats.record('add', dn) as op:
+            op.set_request(dn, modlist)
+            return self._call_primary(
+                super(DatabaseWrapper, self).add_s, dn, modlist,
+                *args, **kwargs)
+
+    def delete_s(self, dn, *args, **kwargs):
+        self._wrote()
+        with stats.record('delete', dn) as op:
+            op.set_request(dn)
+            return self._call_primary(
+                super(DatabaseWrapper, self).delete_s, dn, *args, **kwargs)
+
+    def modify_s(self, dn, modlist, *args, **kwargs):
+        self._wrote()
+        with stats.record('modify', dn) as op:
+            op.set_request(dn, modlist)
+            return self._call_primary(
+                super(DatabaseWrapper, self).modify_s, dn, modlist,
+                *args, **kwargs)
+
+    def rename_s(self, dn, *args, **kwargs):
+        self._wrote()
+        with stats.record('rename', dn) as op:
+            op.set_request(dn)
+            return self._call_primary(
+                super(DatabaseWrapper, self).rename_s, dn, *args, **kwargs)
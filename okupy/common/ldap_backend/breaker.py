@@ -0,0 +1,126 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.cache import cache
+
+from contextlib import contextmanager
+
+import ldap
+import logging
+import time
+
+logger = logging.getLogger('okupy')
+
+# errors telling that the server is unreachable or overloaded
+SERVER_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR,
+                 ldap.UNAVAILABLE, ldap.BUSY)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for an LDAP server, with the state kept in the cache
+    so that it is shared by all workers.
+
+    Operations that fail with one of SERVER_ERRORS, or take longer
+    than settings.AUTH_LDAP_BREAKER_LATENCY seconds, are counted.
+    When settings.AUTH_LDAP_BREAKER_THRESHOLD of them happen within
+    settings.AUTH_LDAP_BREAKER_RESET seconds, the breaker opens,
+    and all operations fail immediately with ldap.SERVER_DOWN.
+
+    After settings.AUTH_LDAP_BREAKER_RESET seconds, the breaker is
+    half-open: a single operation is let through. If it succeeds,
+    the breaker closes. Otherwise, it opens again.
+
+    Setting settings.AUTH_LDAP_BREAKER_THRESHOLD to None disables it.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        prefix = 'okupy.ldap_breaker.%s.' % uri
+        self.failures_key = prefix + 'failures'
+        self.open_key = prefix + 'open_until'
+        self.trial_key = prefix + 'trial'
+
+    @property
+    def enabled(self):
+        return settings.AUTH_LDAP_BREAKER_THRESHOLD is not None
+
+    def is_open(self):
+        """
+        Check whether operations are currently rejected.
+        """
+        open_until = cache.get(self.open_key)
+        return open_until is not None and time.time() < open_until
+
+    def _reject(self):
+        raise ldap.SERVER_DOWN({
+            'desc': "Can't contact LDAP server",
+            'info': 'circuit breaker open for %s' % self.uri,
+        })
+
+    def _before(self):
+        """
+        Check the state before an operation. Returns True if
+        the operation is the half-open trial.
+        """
+        open_until = cache.get(self.open_key)
+        if open_until is None:
+            return False
+        if time.time() < open_until:
+            self._reject()
+        # half-open, only one worker gets to try
+        if not cache.add(self.trial_key, True,
+                         settings.AUTH_LDAP_BREAKER_RESET):
+            self._reject()
+        return True
+
+    def _open(self):
+        logger.error('Opening LDAP circuit breaker for %s' % self.uri)
+        reset = settings.AUTH_LDAP_BREAKER_RESET
+        cache.set(self.open_key, time.time() + reset, reset * 10)
+        cache.delete_many([self.failures_key, self.trial_key])
+
+    def _close(self):
+        logger.info('Closing LDAP circuit breaker for %s' % self.uri)
+        cache.delete_many([self.open_key, self.failures_key,
+                           self.trial_key])
+
+    def _failure(self, trial):
+        if trial:
+            self._open()
+            return
+        cache.add(self.failures_key, 0, settings.AUTH_LDAP_BREAKER_RESET)
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            # expired in the meantime
+            failures = 1
+        if failures >= settings.AUTH_LDAP_BREAKER_THRESHOLD:
+            self._open()
+
+    @contextmanager
+    def guard(self):
+        """
+        Context manager wrapping a single operation on the server.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        trial = self._before()
+        start = time.time()
+        try:
+            yield
+        except SERVER_ERRORS:
+            self._failure(trial)
+            raise
+        except Exception:
+            # the server did answer
+            if trial:
+                self._close()
+            raise
+        if time.time() - start > settings.AUTH_LDAP_BREAKER_LATENCY:
+            logger.warning('Slow LDAP operation on %s' % self.uri)
+            self._failure(trial)
+        elif trial:
+            self._close()
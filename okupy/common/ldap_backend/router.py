@@ -0,0 +1,19 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+
+import ldapdb.router
+
+
+class Router(ldapdb.router.Router):
+    """
+    ldapdb router that recognizes okupy's LDAP backend as well.
+    """
+
+    def __init__(self):
+        super(Router, self).__init__()
+        if self.ldap_alias is None:
+            for alias, settings_dict in settings.DATABASES.items():
+                if settings_dict['ENGINE'] == 'okupy.common.ldap_backend':
+                    self.ldap_alias = alias
+                    break
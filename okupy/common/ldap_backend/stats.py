@@ -0,0 +1,177 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Per-request statistics of LDAP operations.
+
+The backend records its operations into the collector of the current
+thread, if there is one. LDAPStatsMiddleware starts one for every
+request.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import threading
+import time
+
+_local = threading.local()
+
+
+def _size(values):
+    """
+    Estimate the number of bytes in an LDAP value, or a list, tuple
+    or dict of them.
+    """
+    if values is None:
+        return 0
+    if isinstance(values, basestring):
+        return len(values)
+    if isinstance(values, dict):
+        return sum(len(k) + _size(v) for k, v in values.items())
+    if isinstance(values, (list, tuple)):
+        return sum(_size(v) for v in values)
+    return 0
+
+
+class LDAPOperation(object):
+    """
+    A single operation on the LDAP server.
+    """
+
+    def __init__(self, op, base='', filterstr='', attrlist=None):
+        self.op = op
+        self.base = base
+        self.filterstr = filterstr
+        # 0 means all attributes
+        self.attrs = len(attrlist) if attrlist else 0
+        self.results = 0
+        self.size = 0
+        self.duration = 0.0
+        self.error = None
+        # done as part of another operation, e.g. bind before search
+        self.nested = False
+
+    def set_results(self, results):
+        """
+        Store the count and size of search results.
+        """
+        self.results = len(results)
+        self.size = sum(len(dn or '') + _size(attrs)
+                        for dn, attrs in results)
+
+    def set_request(self, dn, modlist=None):
+        """
+        Store the size of a write request.
+        """
+        self.results = 1
+        # (attr, values) for add, (op, attr, values) for modify
+        self.size = len(dn) + sum(_size(mod[-2:]) for mod in modlist or ())
+
+    def __str__(self):
+        error = ' error=%s' % self.error if self.error else ''
+        return '%s base=%s filter=%s attrs=%d results=%d bytes=%d %.1fms%s' % (
+            self.op, self.base, self.filterstr, self.attrs, self.results,
+            self.size, self.duration * 1000, error)
+
+
+class _NullOperation(object):
+    def set_results(self, results):
+        pass
+
+    def set_request(self, dn, modlist=None):
+        pass
+
+
+_null_operation = _NullOperation()
+
+
+class LDAPStats(object):
+    """
+    Collector of the LDAP operations done by a single thread.
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.depth = 0
+
+    @property
+    def duration(self):
+        return sum(op.duration for op in self.ops if not op.nested)
+
+    @property
+    def size(self):
+        return sum(op.size for op in self.ops)
+
+    @property
+    def results(self):
+        return sum(op.results for op in self.ops)
+
+    def counts(self):
+        """
+        Return the number of operations of each type.
+        """
+        counts = OrderedDict()
+        for op in self.ops:
+            counts[op.op] = counts.get(op.op, 0) + 1
+        return counts
+
+    def summary(self):
+        return '%d LDAP operations (%s), %d results, %d bytes, %.1fms' % (
+            len(self.ops),
+            ', '.join('%s: %d' % i for i in self.counts().items()),
+            self.results, self.size, self.duration * 1000)
+
+    def server_timing(self):
+        """
+        Return the totals as a Server-Timing header metric.
+        """
+        return 'ldap;dur=%.1f;desc="%d ops"' % (self.duration * 1000,
+                                                len(self.ops))
+
+
+def start():
+    """
+    Start collecting the LDAP operations of the current thread.
+    """
+    _local.stats = LDAPStats()
+    return _local.stats
+
+
+def stop():
+    """
+    Stop collecting and return the collected LDAPStats, or None
+    if collecting was not started.
+    """
+    stats = current()
+    _local.stats = None
+    return stats
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def record(op, base='', filterstr='', attrlist=None):
+    """
+    Context manager recording a single operation. It yields
+    an LDAPOperation that the results can be stored in.
+    """
+    stats = current()
+    if stats is None:
+        yield _null_operation
+        return
+
+    operation = LDAPOperation(op, base, filterstr, attrlist)
+    operation.nested = stats.depth > 0
+    stats.depth += 1
+    started = time.time()
+    try:
+        yield operation
+    except Exception as e:
+        operation.error = e.__class__.__name__
+        raise
+    finally:
+        operation.duration = time.time() - started
+        stats.depth -= 1
+        stats.ops.append(operation)
@@ -0,0 +1,167 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Streaming bulk transfer of LDAP entries, used by the ldif_export
+and ldif_import management commands.
+
+Nothing here holds the whole directory in memory: searches are paged,
+and writes are sent asynchronously with a bounded number of them
+in flight.
+"""
+
+from django.db import connections, router
+
+from collections import OrderedDict
+from ldap.controls import SimplePagedResultsControl
+
+from okupy.accounts.models import LDAPUser
+from okupy.common.ldap_backend.base import connect
+
+import ldap
+import ldap.modlist
+import ldif
+import time
+
+
+def bulk_connection(user=None, password=None):
+    """
+    Open a new connection to the LDAP server of LDAPUser, bound
+    as the service account or the given user.
+    """
+    settings_dict = connections[router.db_for_read(LDAPUser)].settings_dict
+    if user is not None:
+        settings_dict = dict(settings_dict, USER=user, PASSWORD=password)
+    return connect(settings_dict['NAME'], settings_dict)
+
+
+def paged_search(conn, base_dn, scope=ldap.SCOPE_SUBTREE,
+                 filterstr='(objectClass=*)', attrlist=None, page_size=500):
+    """
+    Generator of the (dn, attrs) results of a search, fetched
+    page_size entries at a time (RFC 2696).
+    """
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = conn.search_ext(base_dn, scope, filterstr, attrlist,
+                                serverctrls=[control])
+        rtype, results, rmsgid, controls = conn.result3(msgid)
+        for dn, attrs in results:
+            # skip referrals
+            if dn is not None:
+                yield dn, attrs
+        cookie = None
+        for c in controls:
+            if c.controlType == SimplePagedResultsControl.controlType:
+                cookie = c.cookie
+        if not cookie:
+            break
+        control.cookie = cookie
+
+
+class Progress(object):
+    """
+    Prints the number of processed entries and the throughput
+    every `every` entries.
+    """
+
+    def __init__(self, out, every=1000):
+        self.out = out
+        self.every = every
+        self.count = 0
+        self.started = time.time()
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.count / elapsed if elapsed else 0.0
+
+    def step(self):
+        self.count += 1
+        if self.every and self.count % self.every == 0:
+            self.report()
+
+    def report(self):
+        self.out.write('%d entries, %.0f entries/s\n' % (self.count,
+                                                        self.rate))
+
+
+def export_ldif(conn, out, base_dn, filterstr='(objectClass=*)',
+                page_size=500, progress=None):
+    """
+    Write the entries found under base_dn to out as LDIF.
+    """
+    writer = ldif.LDIFWriter(out)
+    for dn, attrs in paged_search(conn, base_dn, filterstr=filterstr,
+                                  page_size=page_size):
+        writer.unparse(dn, attrs)
+        if progress is not None:
+            progress.step()
+
+
+class BulkWriter(object):
+    """
+    Sends adds asynchronously, keeping at most in_flight of them
+    waiting for the server's answer.
+
+    With update, entries that already exist are modified to match,
+    replacing the values of all the attributes given.
+    """
+
+    def __init__(self, conn, in_flight=8, update=False, progress=None):
+        self.conn = conn
+        self.in_flight = in_flight
+        self.update = update
+        self.progress = progress
+        # msgid -> (dn, entry, whether it is the add), oldest first
+        self.pending = OrderedDict()
+        self.errors = []
+
+    def _wait(self):
+        msgid, (dn, entry, adding) = self.pending.popitem(last=False)
+        try:
+            self.conn.result(msgid)
+        except ldap.ALREADY_EXISTS as e:
+            if not (adding and self.update):
+                self.errors.append((dn, e))
+                return
+            modlist = [(ldap.MOD_REPLACE, attr, values)
+                       for attr, values in entry.items()]
+            self._send(dn, entry, False,
+                       self.conn.modify_ext(dn, modlist))
+            return
+        except ldap.LDAPError as e:
+            self.errors.append((dn, e))
+            return
+        if self.progress is not None:
+            self.progress.step()
+
+    def _send(self, dn, entry, adding, msgid):
+        self.pending[msgid] = (dn, entry, adding)
+        while len(self.pending) > self.in_flight:
+            self._wait()
+
+    def add(self, dn, entry):
+        self._send(dn, entry, True,
+                   self.conn.add_ext(dn, ldap.modlist.addModlist(entry)))
+
+    def flush(self):
+        while self.pending:
+            self._wait()
+
+
+class _BulkLDIFParser(ldif.LDIFParser):
+    def __init__(self, stream, writer):
+        ldif.LDIFParser.__init__(self, stream)
+        self.writer = writer
+
+    def handle(self, dn, entry):
+        self.writer.add(dn, entry)
+
+
+def import_ldif(stream, writer):
+    """
+    Add the entries of the LDIF read from stream through writer,
+    one at a time.
+    """
+    _BulkLDIFParser(stream, writer).parse()
+    writer.flush()
@@ -1,13 +1,17 @@
 # vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
 
+from django.conf import settings
+
 from base64 import b64encode
 from Crypto import Random
 from passlib.hash import ldap_md5_crypt
 
 from okupy import OkupyError
-from okupy.accounts.models import LDAPUser
+from okupy.accounts.models import LDAPUser, UIDNumberCounter
 from okupy.crypto.ciphers import cipher
 
+import threading
+
 
 def get_bound_ldapuser(request, password=None, username=None):
     """
@@ -77,3 +81,36 @@ def remove_secondary_password(request):
                     # ignore unknown hashes
                     pass
         user.save()
+
+
+class UIDNumberAllocator(object):
+    """
+    Hands out uidNumbers for new accounts.
+
+    Numbers are reserved from UIDNumberCounter in blocks
+    of settings.AUTH_LDAP_UID_BLOCK_SIZE, and the block is kept
+    in the process. Therefore, most allocations don't touch
+    the database, and none of them depend on the directory size.
+    Numbers left in the block when the process exits are lost.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self):
+        """
+        Return a new, unique uidNumber.
+        """
+        with self._lock:
+            if self._next >= self._end:
+                block_size = settings.AUTH_LDAP_UID_BLOCK_SIZE
+                self._next = UIDNumberCounter.reserve(block_size)
+                self._end = self._next + block_size
+            uidnumber = self._next
+            self._next += 1
+        return uidnumber
+
+
+uid_allocator = UIDNumberAllocator()
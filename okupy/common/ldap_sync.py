@@ -0,0 +1,144 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Following the changes of the LDAP directory, including the ones
+done outside okupy (e.g. with ldapmodify).
+
+The changes are read by a long-running consumer (the ldap_sync
+management command), using RFC 4533 syncrepl when the server supports
+it (okupy.common.ldap_syncrepl, which needs python-ldap's syncrepl
+support and pyasn1), and polling modifyTimestamp otherwise. Each change
+is published by sending the directory_changed signal, and by bumping
+the directory generation in the shared cache.
+
+Cache layers subscribe by connecting to directory_changed, and
+deleting the entries of the shared cache that the change affects
+(all of them for a 'refresh').
+Per-process caches, which the consumer can't reach, compare
+directory_generation() with the one they were filled at instead.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal
+
+import datetime
+import ldap
+import logging
+import time
+
+logger = logging.getLogger('okupy')
+
+# sent with change ('add', 'modify' or 'delete'), the dn of the entry
+# and its attributes (None for deletes); or with change 'refresh' and
+# no dn, when entries may have changed without being published
+directory_changed = Signal(providing_args=['change', 'dn', 'attrs'])
+
+GENERATION_KEY = 'okupy.ldap_sync.generation'
+COOKIE_KEY = 'okupy.ldap_sync.cookie'
+TIMESTAMP_KEY = 'okupy.ldap_sync.timestamp'
+# entryUUID -> dn of the entries seen by syncrepl
+UUID_KEY = 'okupy.ldap_sync.uuid.%s'
+# long enough for the sync state to outlive any restart
+KEEP = 365 * 24 * 3600
+
+# errors of servers that don't support syncrepl
+SYNCREPL_UNSUPPORTED = (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                        ldap.PROTOCOL_ERROR, ldap.UNWILLING_TO_PERFORM)
+
+
+def directory_generation():
+    """
+    Return a number that changes whenever a change of the directory
+    is published.
+    """
+    return cache.get(GENERATION_KEY, 0)
+
+
+def publish(sender, change, dn, attrs=None):
+    """
+    Publish a change of the directory entry dn.
+    """
+    logger.debug('Directory change: %s %s' % (change, dn))
+    if not cache.add(GENERATION_KEY, 1, KEEP):
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, 1, KEEP)
+    directory_changed.send(sender=sender, change=change, dn=dn, attrs=attrs)
+
+
+def setup_connection(conn):
+    """ Set the options of conn and bind it like the LDAP backend """
+    for opt, value in settings.AUTH_LDAP_CONNECTION_OPTIONS.items():
+        conn.set_option(opt, value)
+    if settings.AUTH_LDAP_START_TLS:
+        conn.start_tls_s()
+    conn.simple_bind_s(settings.AUTH_LDAP_BIND_DN,
+                       settings.AUTH_LDAP_BIND_PASSWORD)
+    return conn
+
+
+class TimestampPoller(object):
+    """
+    Fallback consumer, searching for entries with modifyTimestamp
+    newer than the last one seen every interval seconds.
+
+    It publishes all changes as 'modify'. Deletes can't be seen this
+    way, so the cache layers still have to expect entries to vanish.
+    """
+
+    def __init__(self, uri, interval=30):
+        self.uri = uri
+        self.interval = interval
+        self.conn = None
+        # dns published with the last timestamp, which >= returns again
+        self.seen = set()
+
+    def _timestamp(self):
+        timestamp = cache.get(TIMESTAMP_KEY)
+        if timestamp is None:
+            # start from now, there is nothing cached from before
+            timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%SZ')
+            cache.set(TIMESTAMP_KEY, timestamp, KEEP)
+        return timestamp
+
+    def poll(self, base_dn, filterstr='(objectClass=*)'):
+        """
+        Publish the changes since the last poll, and return their number.
+        """
+        if self.conn is None:
+            self.conn = setup_connection(ldap.initialize(self.uri))
+        timestamp = self._timestamp()
+        results = self.conn.search_s(
+            base_dn, ldap.SCOPE_SUBTREE,
+            '(&%s(modifyTimestamp>=%s))' % (filterstr, timestamp),
+            ['*', 'modifyTimestamp'])
+        newest = timestamp
+        count = 0
+        for dn, attrs in sorted(results, key=self._modified):
+            modified = self._modified((dn, attrs)) or timestamp
+            if modified < timestamp or (modified == timestamp
+                                        and dn in self.seen):
+                continue
+            if modified > newest:
+                newest = modified
+                self.seen = set()
+            self.seen.add(dn)
+            publish(self.__class__, 'modify', dn, attrs)
+            count += 1
+        cache.set(TIMESTAMP_KEY, newest, KEEP)
+        return count
+
+    @staticmethod
+    def _modified(result):
+        return result[1].get('modifyTimestamp', [None])[0]
+
+    def run(self, base_dn, filterstr='(objectClass=*)'):
+        while True:
+            try:
+                self.poll(base_dn, filterstr)
+            except ldap.SERVER_DOWN:
+                self.conn = None
+                raise
+            time.sleep(self.interval)
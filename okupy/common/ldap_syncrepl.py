@@ -0,0 +1,123 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+RFC 4533 syncrepl consumer of the ldap_sync management command, see
+okupy.common.ldap_sync. It is kept apart since it needs python-ldap's
+syncrepl support and pyasn1, which the rest of okupy doesn't.
+"""
+
+from django.core.cache import cache
+
+from ldap.ldapobject import ReconnectLDAPObject
+from ldap.syncrepl import SyncreplConsumer
+
+from okupy.common.ldap_sync import (COOKIE_KEY, KEEP, UUID_KEY, publish,
+                                    setup_connection)
+
+import ldap
+import logging
+
+logger = logging.getLogger('okupy')
+
+
+class SyncreplClient(ReconnectLDAPObject, SyncreplConsumer):
+    """
+    Consumer of the RFC 4533 refreshAndPersist mode. The sync cookie
+    is kept in the cache, so that a restarted consumer only receives
+    the changes it missed.
+
+    Deletes only carry the entryUUIDs, so the dns of the entries are
+    kept in the cache next to the cookie, for the deletes received
+    after a restart.
+
+    When the server can't replay the deletes since the cookie, it
+    presents all the remaining entries instead. The known entries that
+    were not presented are published as deleted; a consumer that
+    started from a cookie doesn't know all the entries, so it publishes
+    a 'refresh' for the cache layers to reload everything.
+    """
+
+    def __init__(self, uri, **kwargs):
+        ReconnectLDAPObject.__init__(self, uri, **kwargs)
+        # entryUUID -> dn of the entries seen by this process
+        self.uuids = {}
+        # without a cookie, the initial refresh sends all entries,
+        # which are not changes
+        self.publishing = False
+        # whether self.uuids has all the entries (no cookie at start)
+        self.complete = False
+        # entryUUIDs presented during the refresh
+        self.presented = set()
+        self.refreshing = True
+
+    def syncrepl_get_cookie(self):
+        return cache.get(COOKIE_KEY)
+
+    def syncrepl_set_cookie(self, cookie):
+        cache.set(COOKIE_KEY, cookie, KEEP)
+
+    def _get_dn(self, uuid):
+        dn = self.uuids.get(uuid)
+        if dn is None:
+            dn = cache.get(UUID_KEY % uuid)
+        return dn
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+        known_dn = self._get_dn(uuid)
+        change = 'add' if known_dn is None else 'modify'
+        if known_dn != dn:
+            cache.set(UUID_KEY % uuid, dn, KEEP)
+        self.uuids[uuid] = dn
+        if self.refreshing:
+            self.presented.add(uuid)
+        if self.publishing:
+            publish(self.__class__, change, dn, attributes)
+
+    def syncrepl_delete(self, uuids):
+        for uuid in uuids:
+            dn = self._get_dn(uuid)
+            if dn is None:
+                logger.warning('LDAP sync: delete of unknown entry %s, '
+                               'rebuild the mirrors to drop it' % uuid)
+                continue
+            self.uuids.pop(uuid, None)
+            cache.delete(UUID_KEY % uuid)
+            publish(self.__class__, 'delete', dn)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        if uuids is None:
+            # without refreshDeletes, the entries that were not
+            # presented were deleted
+            if not refreshDeletes:
+                self._delete_not_presented()
+        elif refreshDeletes:
+            self.syncrepl_delete(uuids)
+        else:
+            self.presented.update(uuids)
+
+    def _delete_not_presented(self):
+        self.syncrepl_delete(set(self.uuids) - self.presented)
+        if not self.complete:
+            logger.warning('LDAP sync: entries deleted since the last '
+                           'cookie are unknown, publishing a refresh')
+            publish(self.__class__, 'refresh', None)
+
+    def syncrepl_refreshdone(self):
+        logger.info('LDAP sync: initial refresh done, %d entries'
+                    % len(self.uuids))
+        self.publishing = True
+        self.refreshing = False
+        self.presented = set()
+
+    def run(self, base_dn, filterstr='(objectClass=*)'):
+        """
+        Follow the changes till the connection is lost.
+        """
+        setup_connection(self)
+        self.publishing = self.syncrepl_get_cookie() is not None
+        self.complete = not self.publishing
+        msgid = self.syncrepl_search(base_dn, ldap.SCOPE_SUBTREE,
+                                     mode='refreshAndPersist',
+                                     filterstr=filterstr)
+        while self.syncrepl_poll(msgid=msgid, all=1):
+            pass
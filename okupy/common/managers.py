@@ -0,0 +1,78 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.db.models import Manager, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.utils.tree import Node
+
+from okupy.common.fields import ACLField
+
+
+class ACLQuerySet(QuerySet):
+    """
+    QuerySet that compiles ACL lookups into LDAP filters.
+
+    ldapdb can only express positive ACLField lookups. This rewrites
+    the remaining ones into expressions it can handle, so that
+    the filtering is done by the directory:
+
+    * is_x=False becomes ~Q(is_x=True), i.e. (!(gentooACL=x.group)),
+    * ACL__in=[groups] becomes an OR of ACL__contains lookups,
+      i.e. (|(gentooACL=a.group)(gentooACL=b.group)); with no groups,
+      filter() matches nothing and exclude() excludes nothing, like
+      __in lookups of other fields.
+
+    Both can be combined with other lookups and Q objects.
+    """
+
+    def _compile_acl_lookup(self, lookup, value):
+        name = lookup.split('__')[0]
+        if lookup == 'ACL__in':
+            if not value:
+                # handled by _filter_or_exclude() outside of Q objects
+                raise ValueError('ACL__in with no groups can not be used '
+                                 'in Q objects')
+            q = Q(*[('ACL__contains', group) for group in value])
+            q.connector = Q.OR
+            return q
+        elif lookup in (name, name + '__exact') and value is False:
+            try:
+                field = self.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                pass
+            else:
+                if isinstance(field, ACLField):
+                    return ~Q(**{name: True})
+        return None
+
+    def _compile_acl_node(self, node):
+        compiled = Q()
+        compiled.connector = node.connector
+        compiled.negated = node.negated
+        for child in node.children:
+            if isinstance(child, Node):
+                child = self._compile_acl_node(child)
+            else:
+                child = self._compile_acl_lookup(*child) or child
+            compiled.children.append(child)
+        return compiled
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        if 'ACL__in' in kwargs and not kwargs['ACL__in']:
+            if negate:
+                return self._clone()
+            return self.none()
+        if args or kwargs:
+            args = (self._compile_acl_node(Q(*args, **kwargs)),)
+            kwargs = {}
+        return super(ACLQuerySet, self)._filter_or_exclude(
+            negate, *args, **kwargs)
+
+
+class ACLManager(Manager):
+    """
+    Manager for models with ACLFields, see ACLQuerySet.
+    """
+
+    def get_query_set(self):
+        return ACLQuerySet(self.model, using=self._db)
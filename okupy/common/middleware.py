@@ -0,0 +1,55 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+
+from okupy.accounts import openid_fetcher
+from okupy.common.ldap_backend import stats
+from okupy.common.log import log_extra_data
+
+import logging
+
+logger = logging.getLogger('okupy')
+
+
+class LDAPStatsMiddleware(object):
+    """
+    Record the LDAP operations and OpenID fetches done while handling
+    the request, and log their totals. With settings.AUTH_LDAP_SERVER_TIMING
+    and settings.OPENID_FETCH_SERVER_TIMING, the totals are sent
+    in the Server-Timing header as well.
+
+    It should be the first middleware, to see the operations done
+    by the other ones.
+    """
+
+    def process_request(self, request):
+        stats.start()
+        openid_fetcher.start()
+
+    def process_response(self, request, response):
+        collected = stats.stop()
+        fetches = openid_fetcher.stop()
+        timings = []
+
+        if collected is not None and collected.ops:
+            logger.info('%s %s: %s' % (request.method, request.path,
+                                       collected.summary()),
+                        extra=log_extra_data(request))
+            for op in collected.ops:
+                logger.debug(str(op), extra=log_extra_data(request))
+            if settings.AUTH_LDAP_SERVER_TIMING:
+                timings.append(collected.server_timing())
+
+        if fetches is not None and fetches.fetches:
+            logger.info('%s %s: %s' % (request.method, request.path,
+                                       fetches.summary()),
+                        extra=log_extra_data(request))
+            if settings.OPENID_FETCH_SERVER_TIMING:
+                timings.append(fetches.server_timing())
+
+        if timings:
+            timing = ', '.join(timings)
+            if response.has_header('Server-Timing'):
+                timing = '%s, %s' % (response['Server-Timing'], timing)
+            response['Server-Timing'] = timing
+        return response
@@ -0,0 +1,242 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Session engine keeping the sessions in the cache in a compact binary
+form, instead of pickling them.
+
+Only the types sessions need can be stored: None, bool, int, long,
+float, str, unicode, lists, tuples, sets and dicts of them, datetimes
+and the messages of django.contrib.messages. Anything else fails
+loudly when the session is saved.
+
+Empty sessions are not saved, so anonymous requests that only read
+the session don't write to the cache.
+
+With settings.SESSION_SIZE_STATS, the sizes of the saved sessions and
+of each of their keys are logged and summed up in session_sizes.
+"""
+
+from django.conf import settings
+from django.contrib.messages.storage.base import Message
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.cache import (
+    SessionStore as CacheSessionStore)
+from django.utils import timezone
+from django.utils.safestring import SafeBytes, SafeText, mark_safe
+
+from openid.server.server import CheckIDRequest
+
+import datetime
+import logging
+import marshal
+import threading
+
+logger = logging.getLogger('okupy')
+
+# the first byte of the serialized sessions, for changes of the format
+FORMAT = '\x01'
+# marshal version 2 (python 2.5+) stores floats in binary
+MARSHAL_VERSION = 2
+
+# types marshal stores as they are
+_PLAIN = frozenset((type(None), bool, int, long, float, str, unicode))
+
+
+def _pack_datetime(value):
+    aware = timezone.is_aware(value)
+    if aware:
+        value = value.astimezone(timezone.utc)
+    return [value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond, aware]
+
+
+def _unpack_datetime(args):
+    value = datetime.datetime(*args[:7])
+    if args[7]:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+# type -> (tag, pack, unpack), the values are stored as (tag, packed);
+# tuples are tagged as well, so they can't be confused with those
+_TAGGED = {
+    tuple: ('t', list, tuple),
+    set: ('s', list, set),
+    frozenset: ('f', list, frozenset),
+    SafeText: ('S', unicode, mark_safe),
+    SafeBytes: ('B', str, mark_safe),
+    datetime.datetime: ('d', _pack_datetime, _unpack_datetime),
+    Message: ('m', lambda m: [m.level, m.message, m.extra_tags],
+              lambda args: Message(*args)),
+}
+_UNPACK = dict((tag, unpack) for tag, pack, unpack in _TAGGED.values())
+
+
+def _pack(value):
+    kind = type(value)
+    if kind in _PLAIN:
+        return value
+    if kind is list:
+        return [_pack(v) for v in value]
+    if kind is dict:
+        for k in value:
+            if type(k) not in _PLAIN:
+                raise TypeError('%s keys can not be stored in the session'
+                                % type(k).__name__)
+        return dict((k, _pack(v)) for k, v in value.items())
+    try:
+        tag, pack, unpack = _TAGGED[kind]
+    except KeyError:
+        raise TypeError('%s values can not be stored in the session'
+                        % kind.__name__)
+    return (tag, _pack(pack(value)))
+
+
+def _unpack(value):
+    kind = type(value)
+    if kind is list:
+        return [_unpack(v) for v in value]
+    if kind is dict:
+        return dict((k, _unpack(v)) for k, v in value.items())
+    if kind is tuple:
+        tag, packed = value
+        return _UNPACK[tag](_unpack(packed))
+    return value
+
+
+def dumps(value):
+    """
+    Serialize value, raising TypeError if it holds types that
+    can't be stored.
+    """
+    return FORMAT + marshal.dumps(_pack(value), MARSHAL_VERSION)
+
+
+def loads(data):
+    """
+    Deserialize the value serialized by dumps(), raising ValueError
+    if data is not one.
+    """
+    if not data.startswith(FORMAT):
+        raise ValueError('Unknown session format')
+    try:
+        return _unpack(marshal.loads(data[len(FORMAT):]))
+    except (EOFError, TypeError, KeyError) as e:
+        raise ValueError('Invalid session data: %s' % e)
+
+
+def upgrade(session):
+    """
+    Make a session stored by Django's cache backend storable: pending
+    OpenID requests are kept as their arguments, like
+    save_openid_request() does, and the other values that can't be
+    stored are dropped.
+    """
+    for key, value in session.items():
+        if (isinstance(value, CheckIDRequest)
+                and value.message is not None):
+            session[key] = value.message.toPostArgs()
+            continue
+        try:
+            _pack(value)
+        except TypeError as e:
+            logger.warning('Dropping %s of a legacy session: %s' % (key, e))
+            del session[key]
+    return session
+
+
+class SessionSizes(object):
+    """
+    Totals of the sizes of the saved sessions, and of their keys.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.saves = 0
+        self.size = 0
+        self.max_size = 0
+        # key -> [saves, total size, max size]
+        self.keys = {}
+
+    def add(self, size, key_sizes):
+        with self._lock:
+            self.saves += 1
+            self.size += size
+            self.max_size = max(self.max_size, size)
+            for key, key_size in key_sizes.items():
+                sizes = self.keys.setdefault(key, [0, 0, 0])
+                sizes[0] += 1
+                sizes[1] += key_size
+                sizes[2] = max(sizes[2], key_size)
+
+    def summary(self):
+        with self._lock:
+            lines = ['%d sessions saved, avg %d bytes, max %d bytes' % (
+                self.saves, self.size / self.saves if self.saves else 0,
+                self.max_size)]
+            for key, (saves, size, max_size) in sorted(
+                    self.keys.items(), key=lambda i: -i[1][1]):
+                lines.append('  %s: %d saves, avg %d bytes, max %d bytes'
+                             % (key, saves, size / saves, max_size))
+        return '\n'.join(lines)
+
+
+session_sizes = SessionSizes()
+
+
+def key_sizes(session):
+    """
+    Return the serialized size of each key of the session dict.
+    """
+    return dict((k, len(marshal.dumps(_pack(v), MARSHAL_VERSION)))
+                for k, v in session.items())
+
+
+class SessionStore(CacheSessionStore):
+    """
+    Cache session store, keeping the sessions serialized by dumps().
+    Sessions stored as dicts by Django's cache backend are read too,
+    see upgrade().
+
+    Unlike Django's cache backend, missing sessions are not saved
+    empty when loaded, but only once they are modified.
+    """
+
+    def load(self):
+        if self.session_key is None:
+            return {}
+        try:
+            data = self._cache.get(self.cache_key, None)
+        except Exception:
+            # the cache is down, like in Django's cache backend
+            data = None
+        if isinstance(data, dict):
+            return upgrade(data)
+        if data is not None:
+            try:
+                return loads(data)
+            except ValueError as e:
+                logger.warning('Dropping invalid session: %s' % e)
+        # expired or unknown, a new key is created when saving
+        self._session_key = None
+        return {}
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        session = self._get_session(no_load=must_create)
+        data = dumps(session)
+        if settings.SESSION_SIZE_STATS:
+            sizes = key_sizes(session)
+            session_sizes.add(len(data), sizes)
+            logger.debug('Session saved, %d bytes (%s)' % (
+                len(data), ', '.join('%s: %d' % i
+                                     for i in sorted(sizes.items()))))
+
+        if must_create:
+            func = self._cache.add
+        else:
+            func = self._cache.set
+        result = func(self.cache_key, data, self.get_expiry_age())
+        if must_create and not result:
+            raise CreateError
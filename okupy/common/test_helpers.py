@@ -3,15 +3,25 @@
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.messages.middleware import MessageMiddleware
-from django.contrib.sessions.backends.cache import SessionStore
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.db import DatabaseError
 from django.test import TestCase, RequestFactory
 from django.utils.functional import curry
 
+from mockldap import MockLdap
+from openid.consumer.consumer import (DiffieHellmanSHA1ConsumerSession,
+                                      DiffieHellmanSHA256ConsumerSession)
+from openid.message import OPENID2_NS
+
+from okupy.common.sessions import SessionStore
 from okupy.tests import vars
+from okupy.tests.directory import generate_directory
 
+import BaseHTTPServer
+import SocketServer
 import mock
+import threading
+import time
 
 
 """
@@ -51,6 +61,125 @@ def ldap_users(username=None, all=False, clean=False,
     return result
 
 
+_synthetic_directories = {}
+
+
+def synthetic_directory(size, seed=0):
+    """
+    Retrieve the fake LDAP directory with size synthetic users added
+    to it (see okupy.tests.directory). The directories are cached,
+    so they must not be modified.
+    """
+    key = (size, seed)
+    if key not in _synthetic_directories:
+        directory = vars.DIRECTORY.copy()
+        directory.update(generate_directory(size, seed))
+        _synthetic_directories[key] = directory
+    return _synthetic_directories[key]
+
+
+def synthetic_mockldap(size, seed=0):
+    """ Get MockLdap serving synthetic_directory(size, seed) """
+    return MockLdap(synthetic_directory(size, seed))
+
+
+RP_XRDS = """<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    <Service>
+      <Type>http://specs.openid.net/auth/2.0/return_to</Type>
+      <URI>%s</URI>
+    </Service>
+  </XRD>
+</xrds:XRDS>
+"""
+
+
+class StubRelyingParty(object):
+    """
+    Local HTTP server acting as an OpenID relying party, publishing
+    its return_to URL through Yadis. It counts the connections
+    and requests it gets, and can answer slowly (delay) or with
+    an error (status).
+    """
+
+    def __init__(self, delay=0, status=200):
+        self.delay = delay
+        self.status = status
+        self.connections = 0
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                stub.connections += 1
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.delay)
+                if stub.status != 200:
+                    self.send_error(stub.status)
+                    return
+                body = RP_XRDS % stub.return_to
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xrds+xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        # threaded, as kept alive connections hold their thread
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # clients dropping kept alive connections
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.trust_root = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.return_to = self.trust_root + 'return'
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+CONSUMER_SESSIONS = {
+    'DH-SHA1': (DiffieHellmanSHA1ConsumerSession, 'HMAC-SHA1'),
+    'DH-SHA256': (DiffieHellmanSHA256ConsumerSession, 'HMAC-SHA256'),
+}
+
+
+def associate_query(session_type='DH-SHA1'):
+    """
+    Build the query of an OpenID 2 associate request, like a relying
+    party does. Returns it with the consumer session, which can
+    extract the secret from the response.
+    """
+    session_class, assoc_type = CONSUMER_SESSIONS[session_type]
+    session = session_class()
+    query = {
+        'openid.ns': OPENID2_NS,
+        'openid.mode': 'associate',
+        'openid.assoc_type': assoc_type,
+        'openid.session_type': session_type,
+    }
+    for k, v in session.getRequest().items():
+        query['openid.' + k] = v
+    return query, session
+
+
 def set_search_seed(value=None, attr='uid', neg=False):
     """ Create the filterstr of the search_s seed part of the mocked
     ldap object """
@@ -1,7 +1,7 @@
 # vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
 
 from django.conf import settings
-from django.contrib.sessions.backends.cache import SessionStore
+from django.utils.importlib import import_module
 
 from Crypto.Cipher.AES import AESCipher
 from Crypto.Hash.SHA256 import SHA256Hash
@@ -98,8 +98,8 @@ class SessionRefCipher(object):
 
         if 'encrypted_id' not in session:
             # .cache_key is a very good property since it ensures
-            # that the cache is actually created, and works from first
-            # request
+            # that the session key is actually created, and works from
+            # first request (the session is saved below)
             session_id = session.cache_key
 
             # since it always starts with the backend module name
@@ -138,7 +138,8 @@ class SessionRefCipher(object):
         else:
             session_id = session_id[self.random_prefix_bytes:]
             session_id = ub64encode(session_id)
-            session = SessionStore(session_key=session_id)
+            engine = import_module(settings.SESSION_ENGINE)
+            session = engine.SessionStore(session_key=session_id)
             if session.get('encrypted_id') == eid:
                 # circular import
                 from .models import RevokedToken
@@ -0,0 +1,120 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Generator of synthetic LDAP directories, in the vars.DIRECTORY format,
+for testing with many users. Use the loaders in okupy.common.test_helpers.
+"""
+
+from django.conf import settings
+
+import base64
+import datetime
+import random
+import struct
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace',
+               'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy',
+               'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter', 'Zoe']
+LAST_NAMES = ['Adams', 'Barker', 'Clark', 'Davis', 'Evans', 'Fisher',
+              'Green', 'Harris', 'Irving', 'Jones', 'King', 'Lewis', 'Moore',
+              'Nelson', 'Owens', 'Parker', 'Quinn', 'Smith', 'Turner', 'Young']
+ROLES = ['kde', 'qt', 'gnome', 'kernel', 'security', 'toolchain', 'python',
+         'perl', 'java', 'ruby', 'x11', 'games', 'docs', 'infra', 'council',
+         'arm', 'ppc', 'hppa', 'mips', 'sparc']
+# additional groups, with the probability of a developer having them
+GROUPS = [('staff.group', 0.1), ('docs.group', 0.05), ('council.group', 0.02),
+          ('trustee.group', 0.02), ('overlays.group', 0.2),
+          ('planet.group', 0.3), ('wiki.group', 0.1), ('forums.group', 0.05),
+          ('security.group', 0.03), ('recruiter.group', 0.02),
+          ('undertaker.group', 0.01), ('pr.group', 0.02),
+          ('infra.group', 0.03)]
+
+# modifyTimestamp of the first user, the next ones were modified later
+EPOCH = datetime.datetime(2013, 6, 1)
+
+# '{CRYPT}' hash of 'ldaptest', like alice's one
+PASSWORD = '{CRYPT}$1$lO/RU6zz$2fJCOwurxBtCqdImkoLQo1'
+
+
+def _ssh_string(data):
+    return struct.pack('>I', len(data)) + data
+
+
+def ssh_rsa_key(rng, comment=''):
+    """
+    Return a well-formed (but useless) RSA public key in OpenSSH format.
+    """
+    modulus = '\x00' + ('%0512x' % rng.getrandbits(2048)).decode('hex')
+    blob = (_ssh_string('ssh-rsa') + _ssh_string('\x01\x00\x01')
+            + _ssh_string(modulus))
+    key = 'ssh-rsa ' + base64.b64encode(blob)
+    return key + ' ' + comment if comment else key
+
+
+def generate_user(rng, index, base_dn=None):
+    """
+    Return the (dn, attrs) of the synthetic user number index.
+
+    About 30% of the users are developers, 10% retired developers
+    and 15% foundation members. They have 1-3 mail addresses
+    and 0-3 SSH keys.
+    """
+    base_dn = base_dn or settings.AUTH_LDAP_USER_BASE_DN
+    username = 'user%06d' % index
+    first_name = rng.choice(FIRST_NAMES)
+    last_name = rng.choice(LAST_NAMES)
+
+    kind = rng.random()
+    developer = kind < 0.3
+    retired = 0.3 <= kind < 0.4
+
+    acl = ['user.group']
+    object_class = list(settings.AUTH_LDAP_USER_OBJECTCLASS)
+    if developer:
+        acl.append('developer.group')
+        acl.extend(g for g, p in GROUPS if rng.random() < p)
+        object_class += settings.AUTH_LDAP_DEV_OBJECTCLASS
+    elif retired:
+        acl.append('retired.group')
+    if rng.random() < 0.15:
+        acl.append('foundation.group')
+
+    attrs = {
+        'uid': [username],
+        'userPassword': [PASSWORD],
+        'objectClass': object_class,
+        'uidNumber': [str(2000 + index)],
+        'gidNumber': ['100'],
+        'givenName': [first_name],
+        'sn': [last_name],
+        'cn': ['%s %s' % (first_name, last_name)],
+        'mail': ['%s@test.com' % username] + [
+            '%s.%d@example.com' % (username, i)
+            for i in range(rng.randint(0, 2))],
+        'gentooLocation': ['City%d, Country%d' % (rng.randint(1, 500),
+                                                  rng.randint(1, 100))],
+        'lat': ['%.4f' % rng.uniform(-90, 90)],
+        'lon': ['%.4f' % rng.uniform(-180, 180)],
+        'gentooACL': acl,
+        'sshPublicKey': [ssh_rsa_key(rng, '%s@test.com' % username)
+                         for i in range(rng.randint(0, 3))],
+        'modifyTimestamp': [(EPOCH + datetime.timedelta(minutes=index))
+                            .strftime('%Y%m%d%H%M%SZ')],
+    }
+    if developer or retired:
+        attrs['gentooRoles'] = [', '.join(rng.sample(ROLES,
+                                                     rng.randint(1, 3)))]
+    if not attrs['sshPublicKey']:
+        del attrs['sshPublicKey']
+
+    dn = '%s=%s,%s' % (settings.AUTH_LDAP_USER_ATTR, username, base_dn)
+    return dn, attrs
+
+
+def generate_directory(size, seed=0, base_dn=None):
+    """
+    Return a dict of size synthetic users, the same ones for the same
+    seed.
+    """
+    rng = random.Random(seed)
+    return dict(generate_user(rng, i, base_dn) for i in range(size))
@@ -0,0 +1,88 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import Client
+from mockldap import MockLdap
+
+from okupy.tests import vars
+
+
+class IdentityDocumentsIntegrationTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+        cache.clear()
+
+    def test_user_page_links_endpoint(self):
+        response = self.client.get('/id/alice/')
+        self.assertContains(
+            response, '<link rel="openid2.provider" '
+            'href="http://testserver/endpoint/" />')
+        self.assertEqual(response['X-XRDS-Location'],
+                         'http://testserver/xrds/')
+
+    def test_user_page_has_etag_and_max_age(self):
+        response = self.client.get('/id/alice/')
+        self.assertTrue(response.has_header('ETag'))
+        self.assertIn('max-age=%d' % settings.OPENID_DOCUMENT_MAX_AGE,
+                      response['Cache-Control'])
+        self.assertIn('Accept', response['Vary'])
+
+    def test_user_page_is_shared_between_users(self):
+        alice = self.client.get('/id/alice/')
+        bob = self.client.get('/id/bob/')
+        self.assertEqual(alice['ETag'], bob['ETag'])
+        self.assertEqual(alice.content, bob.content)
+
+    def test_matching_etag_gets_not_modified(self):
+        etag = self.client.get('/id/alice/')['ETag']
+        response = self.client.get('/id/alice/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+    def test_other_etag_gets_document(self):
+        response = self.client.get('/id/alice/', HTTP_IF_NONE_MATCH='"x"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_yadis_request_gets_xrds(self):
+        response = self.client.get('/id/alice/',
+                                   HTTP_ACCEPT='application/xrds+xml')
+        self.assertEqual(response['Content-Type'], 'application/xrds+xml')
+        self.assertContains(response,
+                            '<URI>http://testserver/endpoint/</URI>')
+        self.assertContains(response,
+                            'http://specs.openid.net/auth/2.0/signon')
+
+    def test_xrds_document(self):
+        response = self.client.get('/xrds/')
+        self.assertEqual(response['Content-Type'], 'application/xrds+xml')
+        etag = response['ETag']
+        response = self.client.get('/xrds/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_documents_are_per_endpoint(self):
+        response = self.client.get('/xrds/', HTTP_HOST='other.example.com')
+        self.assertContains(response,
+                            '<URI>http://other.example.com/endpoint/</URI>')
+
+    def test_logged_in_user_page_is_not_shared(self):
+        self.client.post('/login/', vars.LOGIN_ALICE)
+        response = self.client.get('/id/alice/')
+        self.assertFalse(response.has_header('ETag'))
+        self.assertContains(response, 'Logout')
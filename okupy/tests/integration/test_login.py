@@ -32,6 +32,28 @@ class LoginIntegrationTests(TestCase):
         self.assertTemplateUsed(response, 'base.html')
         self.assertTemplateUsed(response, 'login.html')
 
+    def test_login_page_does_not_save_session(self):
+        response = self.client.get('/login/')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        self.assertNotContains(response, 'ssh ')
+        self.assertContains(response, 'action="/login/tokens/"')
+
+    def test_login_tokens_are_created_on_request(self):
+        response = self.client.post('/login/tokens/', {'next': '/otp-setup/'})
+        self.assertRedirects(response, '/login/?next=%2Fotp-setup%2F')
+        response = self.client.get('/login/?next=/otp-setup/')
+        self.assertContains(response, 'ssh auth+')
+        self.assertContains(response, 'name="session"')
+        self.assertNotContains(response, 'action="/login/tokens/"')
+
+    def test_login_tokens_are_reused(self):
+        self.client.post('/login/tokens/')
+        first = self.client.get('/login/')
+        second = self.client.get('/login/')
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, second.cookies)
+        self.assertEqual(first.context['ssh_auth_command'],
+                         second.context['ssh_auth_command'])
+
     def test_correct_user_post_login_redirect(self):
         account = vars.LOGIN_ALICE.copy()
         account['next'] = ''
@@ -0,0 +1,8 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Benchmarks, in bench_*.py files so that the regular test run doesn't
+collect them. Run them with:
+
+    bin/runtests -p 'bench_*.py' okupy.tests.performance
+"""
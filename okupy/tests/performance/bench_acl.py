@@ -0,0 +1,55 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Microbenchmark of loading the ACLFields of LDAPUser entries.
+"""
+
+from unittest import TestCase
+
+from okupy.accounts.models import LDAPUser
+from okupy.common.fields import ACLField
+
+import random
+import timeit
+
+
+ENTRIES = 2000
+
+
+def legacy_from_ldap(field, value):
+    """ ACLField.from_ldap() before the ACL list was parsed once """
+    return (field.name.split('_')[1] + '.group') in value
+
+
+class ACLFieldBenchmark(TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.fields = [f for f in LDAPUser._meta.fields
+                       if isinstance(f, ACLField)]
+        groups = [f.group for f in self.fields]
+        self.entries = [rng.sample(groups, rng.randint(1, 4))
+                        for i in range(ENTRIES)]
+
+    def load(self, from_ldap):
+        """ Set the ACLFields of a bare LDAPUser per entry, like ldapdb """
+        loaded = []
+        for acl in self.entries:
+            user = LDAPUser.__new__(LDAPUser)
+            for f in self.fields:
+                setattr(user, f.attname, from_ldap(f, acl))
+            loaded.append([getattr(user, f.attname) for f in self.fields])
+        return loaded
+
+    def load_legacy(self):
+        return self.load(legacy_from_ldap)
+
+    def load_parsed(self):
+        return self.load(lambda f, acl: f.from_ldap(acl, None))
+
+    def test_acl_loading(self):
+        self.assertEqual(self.load_legacy(), self.load_parsed())
+
+        legacy = min(timeit.repeat(self.load_legacy, number=5, repeat=5))
+        parsed = min(timeit.repeat(self.load_parsed, number=5, repeat=5))
+        print('\nACLFields of %d entries: %.2f ms legacy, %.2f ms parsed'
+              % (ENTRIES, legacy * 200, parsed * 200))
@@ -0,0 +1,49 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Benchmark of the public lists and their SQL mirror on a synthetic
+directory.
+"""
+
+from django.conf import settings
+from django.test import TestCase
+
+from okupy.accounts.models import LDAPUserMirror
+from okupy.accounts.views import lists
+from okupy.common.test_helpers import synthetic_mockldap, set_request
+
+import time
+
+
+USERS = 10000
+
+
+class ListsBenchmark(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = synthetic_mockldap(USERS)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_lists(self):
+        start = time.time()
+        LDAPUserMirror.rebuild()
+        rebuild = time.time() - start
+
+        start = time.time()
+        for acc_list in ('devlist', 'former-devlist', 'foundation-members'):
+            lists(set_request(uri='/%s' % acc_list), acc_list)
+        render = time.time() - start
+
+        print('\n%d users: mirror rebuilt in %.2f s, lists rendered '
+              'in %.2f s' % (USERS, rebuild, render))
@@ -0,0 +1,209 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Throughput benchmark of the OpenID provider, driven by a relying party
+played by the test client, with StubRelyingParty publishing its
+return_to URL. Logged in synthetic users go through:
+
+- associate (DH-SHA256),
+- checkid_setup, asking them on the first login and answered
+  automatically for their always_auth preferences on the next one,
+- checkid_immediate,
+- check_authentication of a stateless (dumb mode) assertion.
+
+For each step, the requests/s, latency percentiles and SQL/LDAP
+queries per request are printed. Nothing leaves the machine.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.client import Client
+
+from collections import OrderedDict
+from openid.message import IDENTIFIER_SELECT, OPENID2_NS
+from openid import kvform
+from urllib import urlencode
+
+from okupy.common.ldap_backend import stats
+from okupy.common.test_helpers import (StubRelyingParty, associate_query,
+                                       synthetic_mockldap)
+from okupy.tests.directory import generate_directory
+
+import mock
+import time
+import urlparse
+
+
+USERS = 50
+# the password of the synthetic users
+PASSWORD = 'ldaptest'
+SREG_NS = 'http://openid.net/extensions/sreg/1.1'
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class Measurements(object):
+    """
+    Latency, SQL and LDAP queries of the requests of each step.
+    """
+
+    def __init__(self):
+        # step -> [(duration, SQL queries, LDAP operations)]
+        self.steps = OrderedDict()
+
+    def add(self, step, duration, sql, ldap):
+        self.steps.setdefault(step, []).append((duration, sql, ldap))
+
+    def report(self):
+        lines = ['%-24s %6s %8s %8s %8s %8s %6s %6s' % (
+            'step', 'reqs', 'req/s', 'avg ms', 'p50 ms', 'p95 ms',
+            'SQL', 'LDAP')]
+        for step, samples in self.steps.items():
+            durations = sorted(d for d, s, l in samples)
+            total = sum(durations)
+            lines.append('%-24s %6d %8.1f %8.2f %8.2f %8.2f %6.1f %6.1f' % (
+                step, len(samples), len(samples) / total if total else 0,
+                total / len(samples) * 1000,
+                percentile(durations, 0.5) * 1000,
+                percentile(durations, 0.95) * 1000,
+                float(sum(s for d, s, l in samples)) / len(samples),
+                float(sum(l for d, s, l in samples)) / len(samples)))
+        return '\n'.join(lines)
+
+
+class OpenIDEndpointBenchmark(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = synthetic_mockldap(USERS)
+        cls.rp = StubRelyingParty()
+        cls.rp.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.rp.stop()
+        del cls.mockldap
+
+    def setUp(self):
+        cache.clear()
+        self.mockldap.start()
+        self.measurements = Measurements()
+        self.ldap_stats = []
+        real_stop = stats.stop
+
+        # LDAPStatsMiddleware collects the operations of each request
+        def stop():
+            collected = real_stop()
+            self.ldap_stats.append(collected)
+            return collected
+        patcher = mock.patch.object(stats, 'stop', stop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        connection.use_debug_cursor = True
+
+    def tearDown(self):
+        connection.use_debug_cursor = None
+        self.mockldap.stop()
+        cache.clear()
+
+    def request(self, step, client, method, path, data=None):
+        """
+        Do a request with client and measure it as step.
+        """
+        sql = len(connection.queries)
+        del self.ldap_stats[:]
+        start = time.time()
+        response = getattr(client, method)(path, data or {})
+        duration = time.time() - start
+        ldap = sum(len(s.ops) for s in self.ldap_stats if s is not None)
+        self.measurements.add(step, duration, len(connection.queries) - sql,
+                              ldap)
+        return response
+
+    def checkid(self, assoc_handle=None, mode='checkid_setup'):
+        query = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': mode,
+            'openid.identity': IDENTIFIER_SELECT,
+            'openid.claimed_id': IDENTIFIER_SELECT,
+            'openid.return_to': self.rp.return_to,
+            'openid.realm': self.rp.trust_root,
+            'openid.ns.sreg': SREG_NS,
+            'openid.sreg.required': 'nickname,email',
+        }
+        if assoc_handle is not None:
+            query['openid.assoc_handle'] = assoc_handle
+        return '/endpoint/?' + urlencode(query)
+
+    def assertion(self, response):
+        """ Return the arguments the response sends to the RP """
+        self.assertEqual(response.status_code, 302)
+        location = response['Location']
+        self.assertTrue(location.startswith(self.rp.return_to), location)
+        return dict(urlparse.parse_qsl(urlparse.urlsplit(location).query))
+
+    def flow(self, username, email):
+        client = Client()
+        response = client.post('/login/', {'username': username,
+                                           'password': PASSWORD})
+        self.assertEqual(response.status_code, 302)
+
+        response = self.request('associate', client, 'post', '/endpoint/',
+                                associate_query('DH-SHA256')[0])
+        assoc_handle = kvform.kvToDict(response.content)['assoc_handle']
+
+        # first login, the user is asked
+        response = self.request('checkid_setup', client, 'get',
+                                self.checkid(assoc_handle))
+        self.assertEqual(response.status_code, 302)
+        response = self.request('auth_site (ask)', client, 'get',
+                                '/auth-site/')
+        self.assertEqual(response.status_code, 200)
+        response = self.request('auth_site (accept)', client, 'post',
+                                '/auth-site/', {
+                                    'nickname': 'on',
+                                    'email': 'on',
+                                    'which_email': email,
+                                    'always_auth': 'on',
+                                    'accept': 'Accept',
+                                })
+        self.assertEqual(self.assertion(response)['openid.mode'], 'id_res')
+
+        # next logins are answered automatically
+        response = self.request('checkid_setup', client, 'get',
+                                self.checkid(assoc_handle))
+        response = self.request('auth_site (always)', client, 'get',
+                                '/auth-site/')
+        self.assertEqual(self.assertion(response)['openid.mode'], 'id_res')
+
+        response = self.request('checkid_immediate', client, 'get',
+                                self.checkid(assoc_handle,
+                                             'checkid_immediate'))
+        self.assertEqual(self.assertion(response)['openid.mode'], 'id_res')
+
+        # stateless relying party, verifying the assertion
+        self.request('checkid_setup', client, 'get', self.checkid())
+        response = self.request('auth_site (always)', client, 'get',
+                                '/auth-site/')
+        args = self.assertion(response)
+        args['openid.mode'] = 'check_authentication'
+        response = self.request('check_authentication', Client(), 'post',
+                                '/endpoint/', args)
+        self.assertEqual(kvform.kvToDict(response.content)['is_valid'],
+                         'true')
+
+    def test_openid_endpoint(self):
+        users = sorted(generate_directory(USERS).values(),
+                       key=lambda attrs: attrs['uid'][0])
+        start = time.time()
+        for attrs in users:
+            self.flow(attrs['uid'][0], attrs['mail'][0])
+        duration = time.time() - start
+
+        print('\n%d OpenID flows in %.2f s (%.1f flows/s), store %s:\n%s'
+              % (USERS, duration, USERS / duration,
+                 settings.OPENID_STORE.rsplit('.', 1)[1],
+                 self.measurements.report()))
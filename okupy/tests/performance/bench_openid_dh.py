@@ -0,0 +1,59 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Benchmark of OpenID associate requests, with the server key pairs
+generated on request and taken from a filled DHKeyPool.
+"""
+
+from unittest import TestCase
+
+from openid.server.server import Server
+from openid.store.memstore import MemoryStore
+
+from okupy.accounts.openid_dh import DHKeyPool, PooledDHMixin, PooledDHServer
+from okupy.common.test_helpers import associate_query
+
+import mock
+import os
+import time
+
+
+REQUESTS = 200
+
+
+class AssociateBenchmark(TestCase):
+    def setUp(self):
+        # the consumer side is not measured
+        self.queries = [associate_query(t)[0]
+                        for t in ('DH-SHA1', 'DH-SHA256')
+                        for i in range(REQUESTS // 2)]
+
+    def run_associate(self, srv):
+        latencies = []
+        cpu = os.times()[0]
+        for query in self.queries:
+            start = time.time()
+            oreq = srv.decodeRequest(query)
+            srv.encodeResponse(srv.handleRequest(oreq))
+            latencies.append(time.time() - start)
+        cpu = os.times()[0] - cpu
+        latencies.sort()
+        return (sum(latencies) / len(latencies),
+                latencies[int(len(latencies) * 0.95)], cpu)
+
+    def test_associate(self):
+        plain = self.run_associate(Server(MemoryStore(), 'http://op/'))
+
+        pool = DHKeyPool(REQUESTS)
+        pool.fill()
+        # the background thread would refill the pool while measuring
+        with mock.patch.object(pool, '_start'):
+            with mock.patch.object(PooledDHMixin, 'pool', pool):
+                pooled = self.run_associate(
+                    PooledDHServer(MemoryStore(), 'http://op/'))
+
+        print('\n%d associate requests:' % REQUESTS)
+        for name, (avg, p95, cpu) in (('on request', plain),
+                                      ('pooled', pooled)):
+            print('  %-10s avg %.2f ms, p95 %.2f ms, %.2f s CPU'
+                  % (name, avg * 1000, p95 * 1000, cpu))
@@ -0,0 +1,69 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Size of the session holding a pending OpenID request, pickled
+and kept as its arguments, and the time taken to load it back.
+"""
+
+from django.test import TestCase, RequestFactory
+
+from openid.message import IDENTIFIER_SELECT, OPENID2_NS
+
+from okupy.accounts.views import (get_openid_server, load_openid_request,
+                                  save_openid_request)
+from okupy.common.sessions import SessionStore
+
+import timeit
+
+
+LOADS = 1000
+
+# a checkid_setup request like the ones of real relying parties
+QUERY = {
+    'openid.ns': OPENID2_NS,
+    'openid.mode': 'checkid_setup',
+    'openid.identity': IDENTIFIER_SELECT,
+    'openid.claimed_id': IDENTIFIER_SELECT,
+    'openid.return_to': 'https://rp.example.com/openid/return'
+                        '?janrain_nonce=2013-06-01T00%3A00%3A00ZabcdEF',
+    'openid.realm': 'https://rp.example.com/',
+    'openid.assoc_handle': '{HMAC-SHA256}{51a9b2c1}{q2zGxw==}',
+    'openid.ns.sreg': 'http://openid.net/extensions/sreg/1.1',
+    'openid.sreg.required': 'nickname,email,fullname',
+    'openid.ns.ax': 'http://openid.net/srv/ax/1.0',
+    'openid.ax.mode': 'fetch_request',
+    'openid.ax.type.email': 'http://axschema.org/contact/email',
+    'openid.ax.required': 'email',
+}
+
+
+class OpenIDSessionBenchmark(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/endpoint/')
+        self.request.session = SessionStore()
+        self.oreq = get_openid_server(self.request).decodeRequest(QUERY)
+
+    def measure(self):
+        session = self.request.session
+        # loading goes through the encoded session, like in a request
+        data = session.encode(session._session)
+
+        def load():
+            self.request.session = SessionStore()
+            self.request.session._session_cache = session.decode(data)
+            load_openid_request(self.request)
+        duration = timeit.timeit(load, number=LOADS) / LOADS
+        self.request.session = session
+        return len(data), duration
+
+    def test_session_size(self):
+        self.request.session['openid_request'] = self.oreq
+        pickled = self.measure()
+        save_openid_request(self.request, self.oreq)
+        args = self.measure()
+
+        print('\nsession with a pending OpenID request:')
+        for name, (size, duration) in (('pickled', pickled),
+                                       ('arguments', args)):
+            print('  %-10s %5d bytes, loaded in %.3f ms'
+                  % (name, size, duration * 1000))
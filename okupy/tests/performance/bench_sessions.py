@@ -0,0 +1,66 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+"""
+Size of typical sessions, and the time taken to serialize and load
+them, pickled like Django does and in the compact form of
+okupy.common.sessions.
+"""
+
+from django.contrib.messages.storage.base import Message
+from django.test import TestCase
+from django.utils.safestring import mark_safe
+
+from okupy.common import sessions
+
+import cPickle
+import timeit
+
+
+ROUNDS = 10000
+
+AUTHENTICATED = {
+    '_auth_user_id': 1000,
+    '_auth_user_backend': 'okupy.common.auth.LDAPAuthBackend',
+    'otp_device_id': 'otp_totp.totpdevice/1000',
+    'secondary_password': 'x' * 88,
+    'encrypted_id': 'y' * 43,
+}
+
+PENDING_OPENID = dict(AUTHENTICATED, auto_logout=True, openid_request={
+    u'openid.ns': u'http://specs.openid.net/auth/2.0',
+    u'openid.mode': u'checkid_setup',
+    u'openid.identity':
+        u'http://specs.openid.net/auth/2.0/identifier_select',
+    u'openid.claimed_id':
+        u'http://specs.openid.net/auth/2.0/identifier_select',
+    u'openid.return_to': u'https://rp.example.com/openid/return'
+                         u'?janrain_nonce=2013-06-01T00%3A00%3A00ZabcdEF',
+    u'openid.realm': u'https://rp.example.com/',
+    u'openid.assoc_handle': u'{HMAC-SHA256}{51a9b2c1}{q2zGxw==}',
+    u'openid.ns.sreg': u'http://openid.net/extensions/sreg/1.1',
+    u'openid.sreg.required': u'nickname,email,fullname',
+})
+
+WITH_MESSAGE = dict(AUTHENTICATED, _messages=[
+    Message(25, mark_safe(u'Your account has been activated'))])
+
+
+class SessionSerializerBenchmark(TestCase):
+    def measure(self, dumps, loads, session):
+        data = dumps(session)
+        dump = timeit.timeit(lambda: dumps(session), number=ROUNDS)
+        load = timeit.timeit(lambda: loads(data), number=ROUNDS)
+        return len(data), dump / ROUNDS, load / ROUNDS
+
+    def test_session_sizes(self):
+        print('\nsession sizes:')
+        for name, session in (('authenticated', AUTHENTICATED),
+                              ('pending OpenID', PENDING_OPENID),
+                              ('with a message', WITH_MESSAGE)):
+            for serializer, dumps, loads in (
+                    ('pickle', lambda v: cPickle.dumps(v, 2), cPickle.loads),
+                    ('compact', sessions.dumps, sessions.loads)):
+                size, dump, load = self.measure(dumps, loads, session)
+                print('  %-15s %-8s %5d bytes, dumped in %.1f us, '
+                      'loaded in %.1f us'
+                      % (name, serializer, size, dump * 1e6, load * 1e6))
@@ -19,8 +19,10 @@ LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_URL = '/logout/'
 
-SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
+SESSION_ENGINE = 'okupy.common.sessions'
 SESSION_COOKIE_AGE = 900
+# Log the size of each saved session and of its keys
+SESSION_SIZE_STATS = False
 
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
@@ -32,6 +34,7 @@ AUTHENTICATION_BACKENDS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'okupy.common.middleware.LDAPStatsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -121,6 +124,81 @@ AUTH_LDAP_USER_OBJECTCLASS = ['top', 'person', 'organizationalPerson',
 # additional objectClasses that are used by developers
 AUTH_LDAP_DEV_OBJECTCLASS = ['developerAccount']
 
+# Number of uidNumbers each worker reserves at once for new accounts
+AUTH_LDAP_UID_BLOCK_SIZE = 1
+
+# Read-only replicas used for searches of the service account
+AUTH_LDAP_REPLICA_URIS = ()
+# Interval (in seconds) of replica health checks
+AUTH_LDAP_REPLICA_RETRY = 30
+# Time (in seconds) searches stay on the primary server after a write
+AUTH_LDAP_REPLICA_LAG = 5
+
+# LDAP circuit breaker: number of failed or slow operations within
+# AUTH_LDAP_BREAKER_RESET seconds that make all workers fail fast
+# for AUTH_LDAP_BREAKER_RESET seconds (None disables it)
+AUTH_LDAP_BREAKER_THRESHOLD = None
+# Time (in seconds) after which an operation counts as failed
+AUTH_LDAP_BREAKER_LATENCY = 5
+AUTH_LDAP_BREAKER_RESET = 30
+
+# Send the time spent on LDAP operations in the Server-Timing header
+AUTH_LDAP_SERVER_TIMING = False
+
+# Number of users updated at once in the SQL mirror of the public lists,
+# keeping the LDAP filters and SQL queries short
+LDAP_MIRROR_BATCH_SIZE = 500
+
+# OpenID store, DjangoDBOpenIDStore keeps the associations and nonces
+# in the database, CacheOpenIDStore in the cache
+OPENID_STORE = 'okupy.accounts.openid_store.DjangoDBOpenIDStore'
+# Interval (in seconds) of purging expired nonces and associations
+# in the background (None disables it, use the openid_purge command then)
+OPENID_PURGE_INTERVAL = None
+# Number of rows deleted at once while purging
+OPENID_PURGE_BATCH_SIZE = 1000
+# Size (in bits) of the Bloom filters of the LocalNonce*OpenIDStores,
+# None to use the exact sets only
+OPENID_NONCE_BLOOM_BITS = None
+# Time (in seconds) the outcomes of relying party return_to verification
+# are cached for
+OPENID_RETURN_TO_TTL = {
+    'verified': 3600,
+    'untrusted': 600,
+    'discovery_failure': 600,
+    'http_failure': 60,
+}
+# Number of threads verifying return_to in the background, as soon as
+# the OpenID request arrives (0 disables it)
+OPENID_PREFETCH_WORKERS = 0
+# Time (in seconds) to wait for a running background verification
+OPENID_PREFETCH_WAIT = 10
+# Number of idle keep-alive connections kept per relying party host
+# for OpenID discovery (0 uses the default fetcher of python-openid)
+OPENID_FETCH_POOL_SIZE = 4
+# Total number of idle connections kept, those of the least recently
+# used hosts are closed first
+OPENID_FETCH_MAX_IDLE = 64
+# Time (in seconds) after which idle connections are not reused
+OPENID_FETCH_IDLE_TIMEOUT = 60
+# Timeouts (in seconds) of connecting to relying parties, and of waiting
+# for their data
+OPENID_FETCH_CONNECT_TIMEOUT = 5
+OPENID_FETCH_READ_TIMEOUT = 10
+# Size (in bytes) after which the fetched documents are cut
+OPENID_FETCH_MAX_BYTES = 1024 * 1024
+# Send the time spent on OpenID fetches in the Server-Timing header
+OPENID_FETCH_SERVER_TIMING = False
+# Number of Diffie-Hellman key pairs generated ahead for associate
+# requests by a background thread (0 generates them on request)
+OPENID_DH_POOL_SIZE = 0
+# Time (in seconds) the OpenID attribute preferences of always
+# authenticated sites are cached for
+OPENID_PREFS_TTL = 3600
+# Time (in seconds) the OpenID discovery documents are cached for,
+# on the server and by the clients
+OPENID_DOCUMENT_MAX_AGE = 3600
+
 # DEBUG Options: Select "True" for development use, "False" for production use
 DEBUG = False
 TEMPLATE_DEBUG = DEBUG
@@ -278,15 +356,16 @@ TEMPLATE_CONTEXT_PROCESSORS += (
 
 # django-ldapdb settings
 DATABASES['ldap'] = {
-    'ENGINE': 'ldapdb.backends.ldap',
+    'ENGINE': 'okupy.common.ldap_backend',
     'NAME': AUTH_LDAP_SERVER_URI,
+    'REPLICAS': AUTH_LDAP_REPLICA_URIS,
     'USER': AUTH_LDAP_BIND_DN,
     'PASSWORD': AUTH_LDAP_BIND_PASSWORD,
     'CONNECTION_OPTIONS': AUTH_LDAP_CONNECTION_OPTIONS,
     'TLS': AUTH_LDAP_START_TLS,
 }
 
-DATABASE_ROUTERS = ['ldapdb.router.Router']
+DATABASE_ROUTERS = ['okupy.common.ldap_backend.router.Router']
 
 TEST_RUNNER = 'discover_runner.DiscoverRunner'
 
@@ -3,8 +3,7 @@
 from Crypto import Random
 from unittest import TestCase, SkipTest
 
-from django.contrib.sessions.backends.cache import SessionStore
-
+from okupy.common.sessions import SessionStore
 from okupy.crypto.ciphers import cipher, sessionrefcipher
 
 
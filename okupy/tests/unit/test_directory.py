@@ -0,0 +1,77 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.test import TestCase
+
+from okupy.accounts.models import LDAPUser
+from okupy.common.auth import SSHKeyAuthBackend
+from okupy.common.test_helpers import synthetic_directory, synthetic_mockldap
+from okupy.tests import vars
+from okupy.tests.directory import generate_directory
+
+import base64
+import paramiko
+
+
+class SyntheticDirectoryUnitTests(TestCase):
+    def test_directory_has_requested_size(self):
+        self.assertEqual(len(generate_directory(100)), 100)
+
+    def test_same_seed_gives_same_directory(self):
+        self.assertEqual(generate_directory(50, seed=1),
+                         generate_directory(50, seed=1))
+
+    def test_different_seed_gives_different_directory(self):
+        self.assertNotEqual(generate_directory(50, seed=1),
+                            generate_directory(50, seed=2))
+
+    def test_directory_has_acl_mix(self):
+        acls = [attrs['gentooACL'] for attrs
+                in generate_directory(200).values()]
+        for group in ('developer.group', 'retired.group', 'foundation.group'):
+            self.assertTrue(any(group in acl for acl in acls))
+
+    def test_synthetic_directory_keeps_fake_users(self):
+        directory = synthetic_directory(10)
+        self.assertEqual(len(directory), len(vars.DIRECTORY) + 10)
+        for dn in vars.DIRECTORY:
+            self.assertIn(dn, directory)
+
+
+class SyntheticDirectoryLDAPUnitTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = synthetic_mockldap(100)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_users_are_loaded(self):
+        user = LDAPUser.objects.get(username='user000042')
+        self.assertEqual(user.uid, 2042)
+
+    def test_developers_can_be_listed(self):
+        expected = [attrs['uid'][0] for attrs
+                    in synthetic_directory(100).values()
+                    if 'developer.group' in attrs.get('gentooACL', [])]
+        developers = LDAPUser.objects.filter(is_developer=True)
+        self.assertEqual(sorted(u.username for u in developers),
+                         sorted(expected))
+
+    def test_ssh_key_authenticates_synthetic_user(self):
+        dn, attrs = sorted(
+            (dn, attrs) for dn, attrs in synthetic_directory(100).items()
+            if attrs.get('sshPublicKey'))[-1]
+        key = paramiko.RSAKey(
+            data=base64.b64decode(attrs['sshPublicKey'][0].split()[1]))
+        user = SSHKeyAuthBackend().authenticate(ssh_key=key)
+        self.assertEqual(user.username, attrs['uid'][0])
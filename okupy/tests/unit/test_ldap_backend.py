@@ -0,0 +1,295 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template import RequestContext
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mockldap import MockLdap
+
+from okupy.accounts.models import LDAPUser
+from okupy.accounts.views import signup
+from okupy.common.ldap_backend import base, stats
+from okupy.common.ldap_backend.breaker import CircuitBreaker
+from okupy.common.middleware import LDAPStatsMiddleware
+from okupy.common.test_helpers import ldap_users, set_request, OkupyTestCase
+from okupy.tests import vars
+
+import ldap
+import mock
+
+
+REPLICAS = ('ldap://replica1.example.com', 'ldap://replica2.example.com')
+
+
+class ReplicaRoutingUnitTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+        base._replica_pools.clear()
+        settings_dict = settings.DATABASES['ldap'].copy()
+        settings_dict['REPLICAS'] = REPLICAS
+        self.conn = base.DatabaseWrapper(settings_dict, 'ldap_replicas')
+
+    def tearDown(self):
+        self.conn.close()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def search(self, conn=None):
+        return (conn or self.conn).search_s(
+            settings.AUTH_LDAP_USER_BASE_DN, ldap.SCOPE_ONELEVEL,
+            '(uid=alice)')
+
+    def searched(self, uri):
+        return 'search_s' in self.mockldap[uri].methods_called()
+
+    def test_search_goes_to_replica(self):
+        self.search()
+        self.assertTrue(self.searched(REPLICAS[0]))
+        self.assertFalse(self.searched(settings.AUTH_LDAP_SERVER_URI))
+
+    def test_replicas_are_used_round_robin(self):
+        self.search()
+        self.search()
+        self.assertTrue(self.searched(REPLICAS[0]))
+        self.assertTrue(self.searched(REPLICAS[1]))
+
+    def test_search_after_write_goes_to_primary(self):
+        self.conn.modify_s(ldap_users('alice')[0],
+                           [(ldap.MOD_REPLACE, 'sn', ['Adams'])])
+        self.search()
+        self.assertFalse(self.searched(REPLICAS[0]))
+        self.assertTrue(self.searched(settings.AUTH_LDAP_SERVER_URI))
+
+    def test_user_bound_connection_uses_primary(self):
+        settings_dict = self.conn.settings_dict.copy()
+        settings_dict['USER'] = ldap_users('alice')[0]
+        settings_dict['PASSWORD'] = 'ldaptest'
+        conn = base.DatabaseWrapper(settings_dict, 'ldap_alice')
+        self.search(conn)
+        conn.close()
+        self.assertFalse(self.searched(REPLICAS[0]))
+        self.assertTrue(self.searched(settings.AUTH_LDAP_SERVER_URI))
+
+    @mock.patch('okupy.common.ldap_backend.base.connect',
+                mock.Mock(side_effect=ldap.SERVER_DOWN))
+    def test_failing_replicas_fall_back_to_primary(self):
+        result = self.search()
+        self.assertEqual(result[0][0], ldap_users('alice')[0])
+        self.assertTrue(self.searched(settings.AUTH_LDAP_SERVER_URI))
+
+    @mock.patch('okupy.common.ldap_backend.base.connect',
+                mock.Mock(side_effect=ldap.SERVER_DOWN))
+    def test_failing_replica_gets_ejected(self):
+        self.search()
+        pool = self.conn.replica_pool
+        self.assertIs(pool.choose(), None)
+
+    def test_health_check_restores_replica(self):
+        pool = self.conn.replica_pool
+        pool.eject(REPLICAS[0])
+        pool.check()
+        self.assertEqual(pool.choose(), REPLICAS[0])
+
+    @mock.patch('okupy.common.ldap_backend.base.connect',
+                mock.Mock(side_effect=ldap.SERVER_DOWN))
+    def test_health_check_ejects_replica(self):
+        pool = self.conn.replica_pool
+        pool.check()
+        self.assertIs(pool.choose(), None)
+
+
+@override_settings(AUTH_LDAP_BREAKER_THRESHOLD=2)
+class CircuitBreakerUnitTests(OkupyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+        self.breaker = CircuitBreaker(settings.AUTH_LDAP_SERVER_URI)
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def trip(self):
+        try:
+            with self.breaker.guard():
+                raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        except ldap.SERVER_DOWN:
+            pass
+
+    def test_breaker_opens_after_threshold(self):
+        self.trip()
+        self.assertFalse(self.breaker.is_open())
+        self.trip()
+        self.assertTrue(self.breaker.is_open())
+
+    def test_open_breaker_fails_fast(self):
+        self.trip()
+        self.trip()
+        called = []
+        with self.assertRaises(ldap.SERVER_DOWN):
+            with self.breaker.guard():
+                called.append(True)
+        self.assertEqual(called, [])
+
+    def test_other_errors_are_not_counted(self):
+        for i in range(3):
+            try:
+                with self.breaker.guard():
+                    raise ldap.INVALID_CREDENTIALS
+            except ldap.INVALID_CREDENTIALS:
+                pass
+        self.assertFalse(self.breaker.is_open())
+
+    @override_settings(AUTH_LDAP_BREAKER_LATENCY=-1)
+    def test_slow_operations_are_counted(self):
+        for i in range(2):
+            with self.breaker.guard():
+                pass
+        self.assertTrue(self.breaker.is_open())
+
+    def test_successful_trial_closes_breaker(self):
+        self.trip()
+        self.trip()
+        # pretend the reset time has passed
+        cache.set(self.breaker.open_key, 0)
+        with self.breaker.guard():
+            pass
+        self.assertFalse(self.breaker.is_open())
+        self.assertIs(cache.get(self.breaker.open_key), None)
+
+    def test_failed_trial_reopens_breaker(self):
+        self.trip()
+        self.trip()
+        cache.set(self.breaker.open_key, 0)
+        self.trip()
+        self.assertTrue(self.breaker.is_open())
+
+    def test_only_one_trial_when_half_open(self):
+        self.trip()
+        self.trip()
+        cache.set(self.breaker.open_key, 0)
+        with self.breaker.guard():
+            with self.assertRaises(ldap.SERVER_DOWN):
+                with self.breaker.guard():
+                    pass
+
+    def test_open_breaker_fails_signup_with_existing_message(self):
+        self.trip()
+        self.trip()
+        request = set_request(uri='/signup', post=vars.SIGNUP_TESTUSER,
+                              messages=True)
+        response = signup(request)
+        response.context = RequestContext(request)
+        self.assertMessage(response, "Can't contact LDAP server", 40)
+        self.assertNotIn('search_s', self.ldapobj.methods_called())
+
+
+class LDAPStatsUnitTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+        self.conn = base.DatabaseWrapper(settings.DATABASES['ldap'].copy(),
+                                         'ldap_stats')
+
+    def tearDown(self):
+        stats.stop()
+        self.conn.close()
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_nothing_recorded_without_collector(self):
+        self.conn.search_s(settings.AUTH_LDAP_USER_BASE_DN,
+                           ldap.SCOPE_ONELEVEL, '(uid=alice)')
+        self.assertIs(stats.current(), None)
+
+    def test_search_is_recorded(self):
+        collected = stats.start()
+        self.conn.search_s(settings.AUTH_LDAP_USER_BASE_DN,
+                           ldap.SCOPE_ONELEVEL, '(uid=alice)', ['uid', 'cn'])
+        op = collected.ops[-1]
+        self.assertEqual(op.op, 'search')
+        self.assertEqual(op.base, settings.AUTH_LDAP_USER_BASE_DN)
+        self.assertEqual(op.filterstr, '(uid=alice)')
+        self.assertEqual(op.attrs, 2)
+        self.assertEqual(op.results, 1)
+        self.assertGreater(op.size, len(ldap_users('alice')[0]))
+
+    def test_bind_is_recorded_as_nested(self):
+        collected = stats.start()
+        self.conn.search_s(settings.AUTH_LDAP_USER_BASE_DN,
+                           ldap.SCOPE_ONELEVEL, '(uid=alice)')
+        self.assertEqual(collected.counts().keys(), ['bind', 'search'])
+        self.assertTrue(collected.ops[0].nested)
+        self.assertEqual(collected.duration, collected.ops[1].duration)
+
+    def test_write_is_recorded(self):
+        collected = stats.start()
+        self.conn.modify_s(ldap_users('alice')[0],
+                           [(ldap.MOD_REPLACE, 'sn', ['Adams'])])
+        op = collected.ops[-1]
+        self.assertEqual(op.op, 'modify')
+        self.assertEqual(op.size, len(ldap_users('alice')[0]) + 7)
+
+    def test_error_is_recorded(self):
+        collected = stats.start()
+        with self.assertRaises(ldap.NO_SUCH_OBJECT):
+            self.conn.delete_s('uid=nobody,' + settings.AUTH_LDAP_USER_BASE_DN)
+        self.assertEqual(collected.ops[-1].error, 'NO_SUCH_OBJECT')
+
+    def test_middleware_collects_request_operations(self):
+        request = set_request('/')
+        middleware = LDAPStatsMiddleware()
+        middleware.process_request(request)
+        LDAPUser.objects.get(username='alice')
+        collected = stats.current()
+        middleware.process_response(request, HttpResponse())
+        self.assertIn('search', collected.counts())
+        self.assertIs(stats.current(), None)
+
+    def test_middleware_no_server_timing_by_default(self):
+        request = set_request('/')
+        middleware = LDAPStatsMiddleware()
+        middleware.process_request(request)
+        LDAPUser.objects.get(username='alice')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(AUTH_LDAP_SERVER_TIMING=True)
+    def test_middleware_sets_server_timing(self):
+        request = set_request('/')
+        middleware = LDAPStatsMiddleware()
+        middleware.process_request(request)
+        LDAPUser.objects.get(username='alice')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertRegexpMatches(response['Server-Timing'],
+                                 r'^ldap;dur=[0-9.]+;desc="[0-9]+ ops"$')
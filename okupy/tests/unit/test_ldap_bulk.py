@@ -0,0 +1,94 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.test import TestCase
+
+from ldap.controls import SimplePagedResultsControl
+from StringIO import StringIO
+
+from okupy.common.ldap_bulk import (paged_search, export_ldif, import_ldif,
+                                    BulkWriter, Progress)
+from okupy.common.test_helpers import ldap_users
+
+import itertools
+import ldap
+import mock
+
+
+def paged_connection(pages):
+    """ Mock connection returning the given pages of search results """
+    conn = mock.Mock()
+    results = []
+    for i, page in enumerate(pages):
+        control = SimplePagedResultsControl(
+            True, size=len(page),
+            cookie='page%d' % (i + 1) if i + 1 < len(pages) else '')
+        results.append((ldap.RES_SEARCH_RESULT, page, i, [control]))
+    conn.result3.side_effect = results
+    return conn
+
+
+class LDAPBulkUnitTests(TestCase):
+    def setUp(self):
+        self.alice = ldap_users('alice')
+        self.bob = ldap_users('bob')
+
+    def test_paged_search_follows_cookie(self):
+        conn = paged_connection([[self.alice], [self.bob]])
+        results = list(paged_search(conn, 'o=test', page_size=1))
+        self.assertEqual(results, [self.alice, self.bob])
+        self.assertEqual(conn.search_ext.call_count, 2)
+
+    def test_export_writes_ldif(self):
+        conn = paged_connection([[self.alice]])
+        out = StringIO()
+        export_ldif(conn, out, 'o=test')
+        self.assertTrue(out.getvalue().startswith('dn: %s' % self.alice[0]))
+
+    def test_writer_limits_operations_in_flight(self):
+        conn = mock.Mock()
+        conn.add_ext.side_effect = itertools.count()
+        writer = BulkWriter(conn, in_flight=2)
+        for i in range(5):
+            writer.add('uid=user%d,o=test' % i, {'uid': ['user%d' % i]})
+            self.assertLessEqual(len(writer.pending), 2)
+        writer.flush()
+        self.assertEqual(conn.result.call_count, 5)
+        self.assertEqual(conn.result.call_args_list[0], mock.call(0))
+
+    def test_writer_updates_existing_entries(self):
+        conn = mock.Mock()
+        conn.add_ext.return_value = 1
+        conn.modify_ext.return_value = 2
+        conn.result.side_effect = [ldap.ALREADY_EXISTS, None]
+        writer = BulkWriter(conn, update=True)
+        writer.add(self.alice[0], {'cn': ['Alicia Adams']})
+        writer.flush()
+        conn.modify_ext.assert_called_once_with(
+            self.alice[0], [(ldap.MOD_REPLACE, 'cn', ['Alicia Adams'])])
+        self.assertEqual(writer.errors, [])
+
+    def test_writer_collects_errors(self):
+        conn = mock.Mock()
+        conn.add_ext.return_value = 1
+        conn.result.side_effect = ldap.ALREADY_EXISTS
+        writer = BulkWriter(conn)
+        writer.add(self.alice[0], {'cn': ['Alicia Adams']})
+        writer.flush()
+        self.assertEqual(writer.errors[0][0], self.alice[0])
+
+    def test_import_adds_entries_of_ldif(self):
+        conn = mock.Mock()
+        conn.add_ext.side_effect = itertools.count()
+        progress = Progress(StringIO(), every=0)
+        ldif = ('dn: uid=carol,o=test\nuid: carol\n\n'
+                'dn: uid=dave,o=test\nuid: dave\n\n')
+        import_ldif(StringIO(ldif), BulkWriter(conn, progress=progress))
+        self.assertEqual(conn.add_ext.call_count, 2)
+        self.assertEqual(progress.count, 2)
+
+    def test_progress_reports_every_n_entries(self):
+        out = StringIO()
+        progress = Progress(out, every=2)
+        for i in range(5):
+            progress.step()
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
@@ -0,0 +1,114 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from okupy.common import ldap_sync, ldap_syncrepl
+from okupy.common.test_helpers import ldap_users
+
+import mock
+
+
+class LDAPSyncUnitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.changes = []
+        ldap_sync.directory_changed.connect(self.receive)
+
+    def tearDown(self):
+        ldap_sync.directory_changed.disconnect(self.receive)
+        cache.clear()
+
+    def receive(self, sender, change, dn, attrs, **kwargs):
+        self.changes.append((change, dn))
+
+    def test_publish_sends_signal(self):
+        ldap_sync.publish(None, 'modify', ldap_users('alice')[0])
+        self.assertEqual(self.changes, [('modify', ldap_users('alice')[0])])
+
+    def test_publish_bumps_generation(self):
+        generation = ldap_sync.directory_generation()
+        ldap_sync.publish(None, 'modify', ldap_users('alice')[0])
+        self.assertNotEqual(ldap_sync.directory_generation(), generation)
+
+    def test_syncrepl_initial_refresh_is_not_published(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        self.assertEqual(self.changes, [])
+        client.syncrepl_refreshdone()
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_entry(ldap_users('bob')[0], {}, 'uuid-bob')
+        self.assertEqual(self.changes, [('modify', ldap_users('alice')[0]),
+                                        ('add', ldap_users('bob')[0])])
+
+    def test_syncrepl_delete_is_published_with_dn(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_refreshdone()
+        client.syncrepl_delete(['uuid-alice'])
+        self.assertEqual(self.changes, [('delete', ldap_users('alice')[0])])
+
+    def test_syncrepl_delete_after_restart_is_published(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_set_cookie('rid=000,csn=1')
+        # resumes from the cookie, without the initial refresh
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_refreshdone()
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_delete(['uuid-alice'])
+        self.assertEqual(self.changes, [('modify', ldap_users('alice')[0]),
+                                        ('delete', ldap_users('alice')[0])])
+
+    def test_syncrepl_present_phase_publishes_deletes(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        # like run() without a cookie, all the entries are known
+        client.complete = True
+        client.uuids['uuid-bob'] = ldap_users('bob')[0]
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_present(['uuid-jack'], False)
+        client.syncrepl_present(None, False)
+        self.assertEqual(self.changes, [('delete', ldap_users('bob')[0])])
+
+    def test_syncrepl_present_phase_after_restart_publishes_refresh(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_set_cookie('rid=000,csn=1')
+        # resumes from the cookie, the server presents the entries left
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.publishing = True
+        with mock.patch('okupy.accounts.models.LDAPUserMirror.rebuild'):
+            client.syncrepl_present(['uuid-alice'], False)
+            client.syncrepl_present(None, False)
+        client.syncrepl_refreshdone()
+        self.assertEqual(self.changes, [('refresh', None)])
+
+    def test_syncrepl_present_phase_with_deletes_is_not_a_refresh(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_entry(ldap_users('alice')[0], {}, 'uuid-alice')
+        client.syncrepl_refreshdone()
+        client.syncrepl_present(None, True)
+        self.assertEqual(self.changes, [])
+
+    def test_syncrepl_cookie_is_kept_in_cache(self):
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        client.syncrepl_set_cookie('rid=000,csn=1')
+        client = ldap_syncrepl.SyncreplClient('ldap://localhost')
+        self.assertEqual(client.syncrepl_get_cookie(), 'rid=000,csn=1')
+
+    def test_poller_publishes_changes_once(self):
+        cache.set(ldap_sync.TIMESTAMP_KEY, '20130101000000Z')
+        poller = ldap_sync.TimestampPoller('ldap://localhost')
+        poller.conn = mock.Mock()
+        poller.conn.search_s.return_value = [
+            (ldap_users('bob')[0], {'modifyTimestamp': ['20130102000000Z']}),
+            (ldap_users('alice')[0], {'modifyTimestamp': ['20130101000000Z']}),
+        ]
+        self.assertEqual(poller.poll('ou=people,o=test'), 2)
+        self.assertEqual(self.changes, [('modify', ldap_users('alice')[0]),
+                                        ('modify', ldap_users('bob')[0])])
+        self.assertEqual(cache.get(ldap_sync.TIMESTAMP_KEY),
+                         '20130102000000Z')
+        self.assertEqual(poller.poll('ou=people,o=test'), 0)
+        self.assertIn('(modifyTimestamp>=20130102000000Z)',
+                      poller.conn.search_s.call_args[0][2])
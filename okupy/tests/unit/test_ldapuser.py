@@ -1,6 +1,7 @@
 # vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
 
 from django.conf import settings
+from django.db.models import Q
 from django.test import TestCase
 
 from base64 import b64encode
@@ -10,6 +11,7 @@ from passlib.hash import ldap_md5_crypt
 
 from okupy import OkupyError
 from okupy.accounts.models import LDAPUser
+from okupy.common.fields import ACLField
 from okupy.common.ldap_helpers import get_bound_ldapuser
 from okupy.common.test_helpers import ldap_users, set_request
 from okupy.crypto.ciphers import cipher
@@ -40,6 +42,73 @@ class LDAPUserUnitTests(TestCase):
         self.assertEqual(alice.__unicode__(), u'alice')
         self.assertTrue(isinstance(alice.__unicode__(), unicode))
 
+    def test_acl_fields_are_parsed_from_gentooacl(self):
+        alice = LDAPUser.objects.get(username='alice')
+        self.assertTrue(alice.is_user)
+        self.assertTrue(alice.is_developer)
+        self.assertFalse(alice.is_foundation)
+        self.assertFalse(alice.is_retired)
+
+    def test_acl_fields_are_parsed_separately_for_each_entry(self):
+        users = dict((u.username, u) for u in LDAPUser.objects.all())
+        self.assertTrue(users['alice'].is_developer)
+        self.assertFalse(users['alice'].is_retired)
+        self.assertFalse(users['john'].is_developer)
+        self.assertTrue(users['john'].is_retired)
+        self.assertTrue(users['bob'].is_foundation)
+        self.assertFalse(users['bob'].is_developer)
+
+    def test_negative_acl_lookup(self):
+        users = LDAPUser.objects.filter(is_developer=True, is_foundation=False)
+        self.assertEqual([u.username for u in users], ['alice'])
+
+    def test_acl_lookups_combined_with_q(self):
+        users = LDAPUser.objects.filter(
+            Q(is_developer=True) | Q(is_foundation=True))
+        self.assertEqual(sorted(u.username for u in users),
+                         ['alice', 'bob', 'jack'])
+
+    def test_negative_acl_lookup_inside_q(self):
+        users = LDAPUser.objects.filter(
+            Q(is_foundation=True) & Q(is_developer=False))
+        self.assertEqual([u.username for u in users], ['bob'])
+
+    def test_acl_in_lookup(self):
+        users = LDAPUser.objects.filter(
+            ACL__in=['developer.group', 'foundation.group'])
+        self.assertEqual(sorted(u.username for u in users),
+                         ['alice', 'bob', 'jack'])
+
+    def test_acl_in_lookup_with_no_groups(self):
+        self.assertEqual(list(LDAPUser.objects.filter(ACL__in=[])), [])
+
+    def test_acl_in_exclude_with_no_groups(self):
+        users = LDAPUser.objects.exclude(ACL__in=[])
+        self.assertEqual(sorted(u.username for u in users),
+                         sorted(u.username for u in LDAPUser.objects.all()))
+
+    def test_acl_fields_of_entries_loaded_together(self):
+        fields = [f for f in LDAPUser._meta.fields
+                  if isinstance(f, ACLField)]
+        alice = LDAPUser.__new__(LDAPUser)
+        bob = LDAPUser.__new__(LDAPUser)
+        alice_acl = ['user.group', 'developer.group']
+        bob_acl = ['user.group', 'foundation.group']
+        # interleaved, like concurrent loads
+        for f in reversed(fields):
+            setattr(alice, f.attname, f.from_ldap(alice_acl, None))
+            setattr(bob, f.attname, f.from_ldap(bob_acl, None))
+        self.assertTrue(alice.is_developer)
+        self.assertFalse(alice.is_foundation)
+        self.assertTrue(bob.is_foundation)
+        self.assertFalse(bob.is_developer)
+
+    def test_acl_field_can_be_set(self):
+        alice = LDAPUser.objects.get(username='alice')
+        alice.is_foundation = True
+        self.assertTrue(alice.is_foundation)
+        self.assertTrue(alice.is_developer)
+
     def test_get_bound_ldapuser_from_request(self):
         secondary_password = Random.get_random_bytes(48)
         secondary_password_crypt = ldap_md5_crypt.encrypt(b64encode(
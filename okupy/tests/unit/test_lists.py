@@ -2,13 +2,18 @@
 
 from django.conf import settings
 from django.core.urlresolvers import resolve
+from django.test.utils import override_settings
 
 from mockldap import MockLdap
 
+from okupy.accounts.models import LDAPUser, LDAPUserMirror
 from okupy.accounts.views import lists
-from okupy.common.test_helpers import OkupyTestCase, set_request
+from okupy.common.ldap_sync import publish
+from okupy.common.test_helpers import OkupyTestCase, set_request, ldap_users
 from okupy.tests import vars
 
+import mock
+
 
 class ListsUnitTests(OkupyTestCase):
     @classmethod
@@ -22,6 +27,7 @@ class ListsUnitTests(OkupyTestCase):
     def setUp(self):
         self.mockldap.start()
         self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+        LDAPUserMirror.rebuild()
 
     def tearDown(self):
         self.mockldap.stop()
@@ -72,3 +78,115 @@ class ListsUnitTests(OkupyTestCase):
         page_part = '<tr>\n                <td style="color:#5c4f85;"><b>bob</b></td>\n                <td>Robert Barker</td>\n                <td><a href="http://maps.google.com/maps?q=City2, Country2">City2, Country2</a></td>\n            </tr>'  # noqa
         page_part = '<tr>\n                    <td style="color:#5c4f85;"><b>bob</b></td>\n                    <td>Robert Barker</td>\n                    <td><a href="http://maps.google.com/maps?q=City2, Country2">City2, Country2</a></td>\n                </tr>'  # noqa
         self.assertIn(page_part, response.content)
+
+    def test_lists_do_not_search_ldap(self):
+        searches = self.ldapobj.methods_called().count('search_s')
+        for acc_list in ('devlist', 'former-devlist', 'foundation-members'):
+            lists(set_request(uri='/%s' % acc_list), acc_list)
+        self.assertEqual(self.ldapobj.methods_called().count('search_s'),
+                         searches)
+
+
+class LDAPUserMirrorUnitTests(OkupyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+
+    def test_rebuild_mirrors_all_users(self):
+        LDAPUserMirror.rebuild()
+        self.assertEqual(LDAPUserMirror.objects.count(),
+                         LDAPUser.objects.count())
+
+    def test_rebuild_mirrors_public_attributes(self):
+        LDAPUserMirror.rebuild()
+        alice = LDAPUserMirror.objects.get(username='alice')
+        self.assertEqual(alice.full_name, 'Alice Adams')
+        self.assertEqual(alice.location, 'City1, Country1')
+        self.assertTrue(alice.is_developer)
+        self.assertFalse(alice.is_retired)
+
+    def test_rebuild_stores_modify_timestamp_of_entries(self):
+        LDAPUserMirror.rebuild()
+        self.assertEqual(
+            LDAPUserMirror.objects.get(username='alice').modified,
+            '20130601120000Z')
+        self.assertEqual(
+            LDAPUserMirror.objects.get(username='john').modified,
+            '20130604120000Z')
+
+    def test_refresh_of_empty_mirror_rebuilds_it(self):
+        LDAPUserMirror.refresh()
+        self.assertEqual(LDAPUserMirror.objects.count(),
+                         LDAPUser.objects.count())
+
+    def test_refresh_updates_changed_users(self):
+        LDAPUserMirror.rebuild()
+        self.ldapobj.directory[ldap_users('alice')[0]]['cn'] = [
+            'Alicia Adams']
+        with mock.patch.object(LDAPUserMirror, '_changed_since',
+                               return_value={'alice': '20990101000000Z'}):
+            self.assertEqual(LDAPUserMirror.refresh(), 1)
+        alice = LDAPUserMirror.objects.get(username='alice')
+        self.assertEqual(alice.full_name, 'Alicia Adams')
+        self.assertEqual(alice.modified, '20990101000000Z')
+
+    @override_settings(LDAP_MIRROR_BATCH_SIZE=2)
+    def test_refresh_updates_changed_users_in_batches(self):
+        LDAPUserMirror.rebuild()
+        changed = dict((user.username, '20990101000000Z')
+                       for user in LDAPUser.objects.all())
+        with mock.patch.object(LDAPUserMirror, '_changed_since',
+                               return_value=changed):
+            with mock.patch.object(LDAPUser.objects, 'filter',
+                                   wraps=LDAPUser.objects.filter) as filter:
+                self.assertEqual(LDAPUserMirror.refresh(), len(changed))
+        for call in filter.call_args_list:
+            self.assertLessEqual(len(call[1]['username__in']), 2)
+        self.assertEqual(filter.call_count, (len(changed) + 1) / 2)
+        self.assertEqual(
+            LDAPUserMirror.objects.filter(modified='20990101000000Z').count(),
+            len(changed))
+
+    def test_refresh_asks_for_changes_since_newest_entry(self):
+        LDAPUserMirror.rebuild()
+        LDAPUserMirror.objects.filter(username='bob').update(
+            modified='20990101000000Z')
+        with mock.patch.object(LDAPUserMirror, '_changed_since',
+                               return_value={}) as changed_since:
+            LDAPUserMirror.refresh()
+        changed_since.assert_called_once_with('20990101000000Z')
+
+    def test_published_delete_removes_user(self):
+        LDAPUserMirror.rebuild()
+        publish(None, 'delete', ldap_users('alice')[0])
+        self.assertFalse(
+            LDAPUserMirror.objects.filter(username='alice').exists())
+
+    def test_published_refresh_rebuilds_mirror(self):
+        LDAPUserMirror.rebuild()
+        LDAPUserMirror.objects.create(username='gone')
+        publish(None, 'refresh', None)
+        self.assertFalse(
+            LDAPUserMirror.objects.filter(username='gone').exists())
+        self.assertTrue(
+            LDAPUserMirror.objects.filter(username='alice').exists())
+
+    def test_published_change_updates_user(self):
+        LDAPUserMirror.rebuild()
+        self.ldapobj.directory[ldap_users('alice')[0]]['cn'] = [
+            'Alicia Adams']
+        publish(None, 'modify', ldap_users('alice')[0], {})
+        alice = LDAPUserMirror.objects.get(username='alice')
+        self.assertEqual(alice.full_name, 'Alicia Adams')
@@ -1,9 +1,27 @@
 # vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
 
-from okupy.accounts.openid_store import DjangoDBOpenIDStore
+from openid.association import Association
+from openid.message import IDENTIFIER_SELECT, OPENID2_NS
+from openid.server.server import CheckIDRequest
+from openid.store import nonce
 
+from okupy.accounts import views
+from okupy.accounts.models import (OpenID_Association, OpenID_Attributes,
+                                   OpenID_Nonce)
+from okupy.accounts.openid_store import (DjangoDBOpenIDStore,
+                                         CacheOpenIDStore, get_openid_store,
+                                         NonceFilter, LocalNonceDBOpenIDStore)
+from okupy.common.sessions import SessionStore
+from StringIO import StringIO
+
+import datetime
+import threading
 import time
 
 
@@ -17,3 +35,309 @@ class OpenIDStoreTests(TestCase):
         # of reused nonce
         self.assertTrue(self.store.useNonce(*nonce))
         self.assertFalse(self.store.useNonce(*nonce))
+
+    def add_old_rows(self, count):
+        old = timezone.now() - datetime.timedelta(seconds=nonce.SKEW + 60)
+        for i in range(count):
+            OpenID_Nonce.objects.create(
+                server_uri='http://example.com', ts=old, salt='salt%d' % i)
+            OpenID_Association.objects.create(
+                server_uri='http://example.com', handle='handle%d' % i,
+                secret='c2VjcmV0', issued=old, expires=old,
+                assoc_type='HMAC-SHA1')
+
+    def test_remove_association_deletes_it(self):
+        assoc = Association.fromExpiresIn(600, 'handle', 'secret',
+                                          'HMAC-SHA1')
+        self.store.storeAssociation('http://example.com', assoc)
+        self.assertTrue(
+            self.store.removeAssociation('http://example.com', 'handle'))
+        self.assertFalse(OpenID_Association.objects.exists())
+        self.assertFalse(
+            self.store.removeAssociation('http://example.com', 'handle'))
+
+    def test_cleanup_nonces_removes_expired_ones(self):
+        self.add_old_rows(3)
+        self.store.useNonce('http://example.com', time.time(), 'fresh')
+        self.assertEqual(self.store.cleanupNonces(batch_size=2), 3)
+        self.assertEqual(OpenID_Nonce.objects.get().salt, 'fresh')
+
+    def test_cleanup_associations_removes_expired_ones(self):
+        self.add_old_rows(3)
+        self.assertEqual(self.store.cleanupAssociations(batch_size=2), 3)
+        self.assertFalse(OpenID_Association.objects.exists())
+
+    def test_purge_command_reports_removed_rows(self):
+        self.add_old_rows(3)
+        out = StringIO()
+        call_command('openid_purge', batch_size=2, stdout=out)
+        self.assertIn('Removed 3 nonces and 3 associations', out.getvalue())
+
+
+class CacheOpenIDStoreTests(TestCase):
+    server_uri = 'http://example.com'
+
+    def setUp(self):
+        cache.clear()
+        self.store = CacheOpenIDStore()
+
+    def tearDown(self):
+        cache.clear()
+
+    def association(self, handle, issued=None, lifetime=600):
+        if issued is None:
+            issued = int(time.time())
+        return Association(handle, 'secret', issued, lifetime, 'HMAC-SHA1')
+
+    def test_nonce_integrity(self):
+        nonce = (self.server_uri, time.time(), 'pepper')
+        self.assertTrue(self.store.useNonce(*nonce))
+        self.assertFalse(self.store.useNonce(*nonce))
+
+    def test_nonce_out_of_skew_is_rejected(self):
+        self.assertFalse(self.store.useNonce(
+            self.server_uri, time.time() - nonce.SKEW - 1, 'pepper'))
+
+    def test_nonces_differ_by_server_uri(self):
+        ts = time.time()
+        self.assertTrue(self.store.useNonce(self.server_uri, ts, 'pepper'))
+        self.assertTrue(self.store.useNonce('http://example.org', ts,
+                                            'pepper'))
+
+    def test_get_association_by_handle(self):
+        assoc = self.association('handle1')
+        self.store.storeAssociation(self.server_uri, assoc)
+        self.assertEqual(
+            self.store.getAssociation(self.server_uri, 'handle1'), assoc)
+
+    def test_get_latest_association(self):
+        now = int(time.time())
+        self.store.storeAssociation(self.server_uri,
+                                    self.association('old', now - 10))
+        self.store.storeAssociation(self.server_uri,
+                                    self.association('new', now))
+        self.assertEqual(
+            self.store.getAssociation(self.server_uri).handle, 'new')
+
+    def test_expired_association_is_not_returned(self):
+        assoc = self.association('handle1', int(time.time()) - 700)
+        self.store.storeAssociation(self.server_uri, assoc)
+        self.assertIs(self.store.getAssociation(self.server_uri), None)
+
+    def test_remove_association(self):
+        self.store.storeAssociation(self.server_uri,
+                                    self.association('handle1'))
+        self.assertTrue(
+            self.store.removeAssociation(self.server_uri, 'handle1'))
+        self.assertFalse(
+            self.store.removeAssociation(self.server_uri, 'handle1'))
+        self.assertIs(self.store.getAssociation(self.server_uri), None)
+
+
+class OpenIDStoreSettingTests(TestCase):
+    def test_default_store(self):
+        self.assertIsInstance(get_openid_store(), DjangoDBOpenIDStore)
+
+    @override_settings(
+        OPENID_STORE='okupy.accounts.openid_store.CacheOpenIDStore')
+    def test_cache_store(self):
+        self.assertIsInstance(get_openid_store(), CacheOpenIDStore)
+
+
+class NonceFilterTests(TestCase):
+    server_uri = 'http://example.com'
+    now = 1000000000.0
+
+    def setUp(self):
+        self.filter = NonceFilter()
+
+    def use(self, ts, salt='pepper', now=None):
+        return self.filter.use(self.server_uri, ts, salt, now or self.now)
+
+    def test_nonce_integrity(self):
+        self.assertTrue(self.use(self.now))
+        self.assertFalse(self.use(self.now))
+
+    def test_different_salts_are_different_nonces(self):
+        self.assertTrue(self.use(self.now, 'pepper'))
+        self.assertTrue(self.use(self.now, 'salt'))
+
+    def test_nonce_out_of_skew_is_rejected(self):
+        self.assertFalse(self.use(self.now - nonce.SKEW - 1))
+        self.assertFalse(self.use(self.now + nonce.SKEW + 1))
+
+    def test_nonce_is_kept_while_in_skew(self):
+        self.assertTrue(self.use(self.now))
+        self.assertFalse(self.use(self.now, now=self.now + nonce.SKEW))
+
+    def test_old_buckets_are_dropped(self):
+        for i in range(100):
+            self.use(self.now, 'salt%d' % i)
+        later = self.now + 3 * nonce.SKEW
+        self.assertTrue(self.use(later, now=later))
+        self.assertEqual(len(self.filter), 1)
+
+    def test_bloom_filter_front(self):
+        self.filter = NonceFilter(bloom_bits=1024)
+        for i in range(500):
+            self.assertTrue(self.use(self.now, 'salt%d' % i))
+        for i in range(500):
+            self.assertFalse(self.use(self.now, 'salt%d' % i))
+
+
+class LocalNonceOpenIDStoreTests(TestCase):
+    def test_nonce_integrity_without_database(self):
+        store = LocalNonceDBOpenIDStore()
+        nonce = ('http://example.com', time.time(), 'local pepper')
+        self.assertTrue(store.useNonce(*nonce))
+        self.assertFalse(store.useNonce(*nonce))
+        self.assertFalse(OpenID_Nonce.objects.exists())
+
+
+class OpenIDServerTests(TestCase):
+    def setUp(self):
+        views._openid_servers.clear()
+
+    def tearDown(self):
+        views._openid_servers.clear()
+
+    def request(self, host='testserver'):
+        return RequestFactory().get('/endpoint/', HTTP_HOST=host)
+
+    def test_server_is_shared_between_requests(self):
+        self.assertIs(views.get_openid_server(self.request()),
+                      views.get_openid_server(self.request()))
+
+    def test_server_per_endpoint_url(self):
+        srv = views.get_openid_server(self.request('a.example.com'))
+        other = views.get_openid_server(self.request('b.example.com'))
+        self.assertIsNot(srv, other)
+        self.assertTrue(srv.op_endpoint.startswith('http://a.example.com/'))
+
+    @override_settings(
+        OPENID_STORE='okupy.accounts.openid_store.CacheOpenIDStore')
+    def test_server_per_store_setting(self):
+        self.assertIsInstance(views.get_openid_server(self.request()).store,
+                              CacheOpenIDStore)
+
+    def test_servers_are_bounded(self):
+        for i in range(views.MAX_OPENID_SERVERS + 5):
+            views.get_openid_server(self.request('host%d.example.com' % i))
+        self.assertEqual(len(views._openid_servers), views.MAX_OPENID_SERVERS)
+
+    def test_threads_share_server(self):
+        servers = []
+
+        def get():
+            servers.append(views.get_openid_server(self.request()))
+        threads = [threading.Thread(target=get) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(map(id, servers))), 1)
+
+
+class OpenIDAttributesPrefsTests(TestCase):
+    trust_root = 'http://example.com/'
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def save_pref(self, **kwargs):
+        return OpenID_Attributes.objects.create(
+            uid=1000, trust_root=self.trust_root, **kwargs)
+
+    def test_no_prefs_ask_the_user(self):
+        self.assertIsNone(
+            OpenID_Attributes.auto_auth_prefs(1000, self.trust_root))
+
+    def test_always_auth_prefs_are_returned(self):
+        self.save_pref(email=False, which_email='alice@test.com')
+        prefs = OpenID_Attributes.auto_auth_prefs(1000, self.trust_root)
+        self.assertFalse(prefs['email'])
+        self.assertTrue(prefs['nickname'])
+        self.assertEqual(prefs['which_email'], 'alice@test.com')
+        self.assertNotIn('uid', prefs)
+
+    def test_prefs_are_cached(self):
+        self.save_pref()
+        OpenID_Attributes.auto_auth_prefs(1000, self.trust_root)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(
+                OpenID_Attributes.auto_auth_prefs(1000, self.trust_root))
+
+    def test_asking_prefs_are_cached(self):
+        self.save_pref(always_auth=False)
+        OpenID_Attributes.auto_auth_prefs(1000, self.trust_root)
+        with self.assertNumQueries(0):
+            self.assertIsNone(
+                OpenID_Attributes.auto_auth_prefs(1000, self.trust_root))
+
+    def test_saving_prefs_invalidates_cache(self):
+        pref = self.save_pref(always_auth=False)
+        OpenID_Attributes.auto_auth_prefs(1000, self.trust_root)
+        pref.always_auth = True
+        pref.save()
+        self.assertIsNotNone(
+            OpenID_Attributes.auto_auth_prefs(1000, self.trust_root))
+
+    def test_deleting_prefs_invalidates_cache(self):
+        pref = self.save_pref()
+        OpenID_Attributes.auto_auth_prefs(1000, self.trust_root)
+        pref.delete()
+        self.assertIsNone(
+            OpenID_Attributes.auto_auth_prefs(1000, self.trust_root))
+
+    def test_prefs_are_per_trust_root(self):
+        self.save_pref()
+        self.assertIsNone(
+            OpenID_Attributes.auto_auth_prefs(1000, 'http://example.org/'))
+
+
+class OpenIDSessionTests(TestCase):
+    query = {
+        'openid.ns': OPENID2_NS,
+        'openid.mode': 'checkid_setup',
+        'openid.identity': IDENTIFIER_SELECT,
+        'openid.claimed_id': IDENTIFIER_SELECT,
+        'openid.return_to': 'http://rp.example.com/return',
+        'openid.realm': 'http://rp.example.com/',
+        'openid.ns.sreg': 'http://openid.net/extensions/sreg/1.1',
+        'openid.sreg.required': 'nickname,email',
+    }
+
+    def setUp(self):
+        self.request = RequestFactory().get('/endpoint/')
+        self.request.session = SessionStore()
+        self.oreq = views.get_openid_server(self.request).decodeRequest(
+            self.query)
+
+    def test_request_is_rebuilt(self):
+        views.save_openid_request(self.request, self.oreq)
+        oreq = views.load_openid_request(self.request)
+        self.assertIsInstance(oreq, CheckIDRequest)
+        self.assertEqual(oreq.trust_root, self.oreq.trust_root)
+        self.assertEqual(oreq.return_to, self.oreq.return_to)
+        self.assertEqual(oreq.message.toPostArgs(), self.query)
+
+    def test_arguments_are_kept(self):
+        views.save_openid_request(self.request, self.oreq)
+        self.assertEqual(self.request.session['openid_request'], self.query)
+
+    def test_no_request(self):
+        self.assertIsNone(views.load_openid_request(self.request))
+
+    def test_pickled_request_is_loaded(self):
+        self.request.session['openid_request'] = self.oreq
+        self.assertIs(views.load_openid_request(self.request), self.oreq)
+
+    def test_session_is_smaller(self):
+        session = self.request.session
+        session['openid_request'] = self.oreq
+        pickled = len(session.encode(session._session))
+        views.save_openid_request(self.request, self.oreq)
+        self.assertLess(len(session.encode(session._session)), pickled)
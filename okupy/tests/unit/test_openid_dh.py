@@ -0,0 +1,94 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.test import TestCase
+
+from openid import cryptutil
+from openid.dh import DiffieHellman
+from openid.message import Message, OPENID2_NS
+from openid.server.server import ProtocolError
+from openid.store.memstore import MemoryStore
+
+from okupy.accounts.openid_dh import (DHKeyPool, PooledDHMixin,
+                                      PooledDHServer,
+                                      PooledDHSHA1ServerSession,
+                                      PooledDHSHA256ServerSession)
+from okupy.common.test_helpers import associate_query
+
+import mock
+
+
+class DHKeyPoolTests(TestCase):
+    def test_pairs_are_taken_from_the_pool(self):
+        pool = DHKeyPool(2)
+        pool.fill()
+        with mock.patch.object(pool, '_start'):
+            first, second = pool.get(), pool.get()
+        self.assertEqual(pool.hits, 2)
+        self.assertNotEqual(first.private, second.private)
+        self.assertTrue(first.usingDefaultValues())
+
+    def test_empty_pool_generates_pairs(self):
+        pool = DHKeyPool(2)
+        with mock.patch.object(pool, '_start'):
+            self.assertIsInstance(pool.get(), DiffieHellman)
+        self.assertEqual(pool.misses, 1)
+
+    def test_pool_size_0_generates_pairs(self):
+        pool = DHKeyPool(0)
+        self.assertIsInstance(pool.get(), DiffieHellman)
+        self.assertFalse(pool._started)
+
+    def test_pairs_are_used_once(self):
+        pool = DHKeyPool(3)
+        pool.fill()
+        with mock.patch.object(pool, '_start'):
+            privates = set(pool.get().private for i in range(3))
+        self.assertEqual(len(privates), 3)
+
+
+class PooledAssociateTests(TestCase):
+    def setUp(self):
+        self.srv = PooledDHServer(MemoryStore(), 'http://example.com/')
+        self.pool = DHKeyPool(2)
+        self.pool.fill()
+        patcher = mock.patch.object(PooledDHMixin, 'pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def associate(self, session_type='DH-SHA1', **extra):
+        query, session = associate_query(session_type)
+        query.update(extra)
+        oreq = self.srv.decodeRequest(query)
+        resp = self.srv.encodeResponse(self.srv.handleRequest(oreq))
+        return oreq, session, Message.fromKVForm(resp.body)
+
+    def test_associate_uses_pool(self):
+        oreq, session, message = self.associate()
+        self.assertIsInstance(oreq.session, PooledDHSHA1ServerSession)
+        self.assertEqual(self.pool.hits, 1)
+
+    def test_consumer_gets_association_secret(self):
+        for session_type in ('DH-SHA1', 'DH-SHA256'):
+            oreq, session, message = self.associate(session_type)
+            assoc = self.srv.signatory.getAssociation(
+                message.getArg(OPENID2_NS, 'assoc_handle'), dumb=False)
+            self.assertEqual(session.extractSecret(message), assoc.secret)
+
+    def test_sha256_session_is_pooled(self):
+        oreq, session, message = self.associate('DH-SHA256')
+        self.assertIsInstance(oreq.session, PooledDHSHA256ServerSession)
+        self.assertEqual(self.pool.hits, 1)
+
+    def test_custom_modulus_is_not_pooled(self):
+        dh = DiffieHellman(DiffieHellman.DEFAULT_MOD, 5)
+        oreq, session, message = self.associate(**{
+            'openid.dh_modulus': cryptutil.longToBase64(dh.modulus),
+            'openid.dh_gen': cryptutil.longToBase64(dh.generator),
+        })
+        self.assertEqual(oreq.session.dh.generator, 5)
+        self.assertEqual(self.pool.hits, 0)
+
+    def test_missing_consumer_public_key_is_error(self):
+        query, session = associate_query()
+        del query['openid.dh_consumer_public']
+        self.assertRaises(ProtocolError, self.srv.decodeRequest, query)
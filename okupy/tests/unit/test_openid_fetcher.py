@@ -0,0 +1,171 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from openid.fetchers import ExceptionWrappingFetcher, HTTPFetchingError
+
+from okupy.accounts import openid_fetcher
+from okupy.accounts.openid_fetcher import PooledHTTPFetcher, install
+from okupy.common.middleware import LDAPStatsMiddleware
+from okupy.common.test_helpers import StubRelyingParty, set_request
+
+import mock
+import openid.fetchers
+import socket
+import time
+
+
+class PooledHTTPFetcherTests(TestCase):
+    def setUp(self):
+        self.rp = StubRelyingParty()
+        self.rp.start()
+        self.fetcher = PooledHTTPFetcher(read_timeout=0.5)
+        self.collected = openid_fetcher.start()
+
+    def tearDown(self):
+        openid_fetcher.stop()
+        self.fetcher.close()
+        self.rp.stop()
+
+    def test_fetch_returns_document(self):
+        resp = self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.final_url, self.rp.trust_root)
+        self.assertEqual(resp.headers['content-type'], 'application/xrds+xml')
+        self.assertIn(self.rp.return_to, resp.body)
+
+    def test_connection_is_reused(self):
+        for i in range(3):
+            self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(self.rp.requests, 3)
+        self.assertEqual(self.rp.connections, 1)
+        self.assertEqual(self.collected.reused, 2)
+
+    def test_pool_size_0_keeps_no_connections(self):
+        self.fetcher.pool_size = 0
+        for i in range(2):
+            self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(self.rp.connections, 2)
+
+    def test_least_recently_used_host_is_closed_first(self):
+        other = StubRelyingParty()
+        other.start()
+        try:
+            self.fetcher.max_idle = 1
+            self.fetcher.fetch(self.rp.trust_root)
+            self.fetcher.fetch(other.trust_root)
+            self.fetcher.fetch(other.trust_root)
+            self.fetcher.fetch(self.rp.trust_root)
+            self.assertEqual(self.rp.connections, 2)
+            self.assertEqual(other.connections, 1)
+            self.assertEqual(self.fetcher._idle_count, 1)
+        finally:
+            other.stop()
+
+    def test_expired_connection_is_not_reused(self):
+        self.fetcher.idle_timeout = 60
+        self.fetcher.fetch(self.rp.trust_root)
+        later = time.time() + 61
+        with mock.patch('time.time', return_value=later):
+            self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(self.rp.connections, 2)
+        self.assertEqual(self.collected.reused, 0)
+        self.assertEqual(self.fetcher._idle_count, 1)
+
+    def test_closed_connection_is_replaced(self):
+        self.fetcher.fetch(self.rp.trust_root)
+        for conns in self.fetcher._idle.values():
+            for released, conn in conns:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        resp = self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.rp.connections, 2)
+
+    def test_body_is_cut_after_max_bytes(self):
+        self.fetcher.max_bytes = 10
+        resp = self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(len(resp.body), 10)
+        self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(self.rp.connections, 2)
+
+    def test_error_status_is_returned(self):
+        self.rp.status = 404
+        self.assertEqual(self.fetcher.fetch(self.rp.trust_root).status, 404)
+
+    def test_slow_server_times_out(self):
+        self.rp.delay = 1
+        self.assertRaises(socket.timeout, self.fetcher.fetch,
+                          self.rp.trust_root)
+        self.assertEqual(self.collected.errors, 1)
+
+    def test_bad_scheme_is_refused(self):
+        self.assertRaises(ValueError, self.fetcher.fetch, 'ftp://example.com/')
+
+    def test_stats_count_fetches(self):
+        self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(self.collected.fetches, 1)
+        self.assertEqual(self.collected.errors, 0)
+        self.assertTrue(self.collected.summary().startswith(
+            '1 OpenID fetches, 0 errors'))
+
+    def test_fetches_are_not_recorded_without_collector(self):
+        openid_fetcher.stop()
+        self.fetcher.fetch(self.rp.trust_root)
+        self.assertEqual(self.collected.fetches, 0)
+
+    def test_middleware_collects_request_fetches(self):
+        request = set_request('/')
+        middleware = LDAPStatsMiddleware()
+        middleware.process_request(request)
+        self.fetcher.fetch(self.rp.trust_root)
+        collected = openid_fetcher.current()
+        response = middleware.process_response(request, HttpResponse())
+        self.assertEqual(collected.fetches, 1)
+        self.assertIs(openid_fetcher.current(), None)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(OPENID_FETCH_SERVER_TIMING=True)
+    def test_middleware_sets_server_timing(self):
+        request = set_request('/')
+        middleware = LDAPStatsMiddleware()
+        middleware.process_request(request)
+        self.fetcher.fetch(self.rp.trust_root)
+        response = middleware.process_response(request, HttpResponse())
+        self.assertRegexpMatches(response['Server-Timing'],
+                                 r'^openid;dur=[0-9.]+;desc="1 fetches"$')
+
+
+class InstallTests(TestCase):
+    def setUp(self):
+        self.default = openid.fetchers.getDefaultFetcher()
+
+    def tearDown(self):
+        openid.fetchers.setDefaultFetcher(self.default, wrap_exceptions=False)
+
+    @override_settings(OPENID_FETCH_POOL_SIZE=2, OPENID_FETCH_READ_TIMEOUT=0.5)
+    def test_install_sets_default_fetcher(self):
+        fetcher = install()
+        default = openid.fetchers.getDefaultFetcher()
+        self.assertIsInstance(default, ExceptionWrappingFetcher)
+        self.assertIs(default.fetcher, fetcher)
+        self.assertEqual(fetcher.pool_size, 2)
+        self.assertEqual(fetcher.max_idle, settings.OPENID_FETCH_MAX_IDLE)
+
+    @override_settings(OPENID_FETCH_POOL_SIZE=2, OPENID_FETCH_READ_TIMEOUT=0.5)
+    def test_installed_fetcher_errors_are_wrapped(self):
+        rp = StubRelyingParty(delay=1)
+        rp.start()
+        try:
+            install()
+            self.assertRaises(HTTPFetchingError, openid.fetchers.fetch,
+                              rp.trust_root)
+        finally:
+            rp.stop()
+
+    @override_settings(OPENID_FETCH_POOL_SIZE=0)
+    def test_install_can_be_disabled(self):
+        self.assertIsNone(install())
+        self.assertIs(openid.fetchers.getDefaultFetcher(), self.default)
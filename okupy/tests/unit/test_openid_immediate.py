@@ -0,0 +1,115 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import TestCase
+
+from mockldap import MockLdap
+from openid.message import IDENTIFIER_SELECT, OPENID2_NS
+from urllib import urlencode
+
+from okupy.accounts.models import OpenID_Attributes
+from okupy.accounts.views import openid_endpoint
+from okupy.common.test_helpers import set_request
+from okupy.tests import vars
+
+import urlparse
+
+
+class OpenIDImmediateTests(TestCase):
+    trust_root = 'http://rp.example.com/'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        cache.clear()
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+        cache.clear()
+
+    def immediate(self, user=vars.USER_ALICE, verified=True, **extra):
+        query = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'checkid_immediate',
+            'openid.identity': IDENTIFIER_SELECT,
+            'openid.claimed_id': IDENTIFIER_SELECT,
+            'openid.return_to': self.trust_root + 'return',
+            'openid.realm': self.trust_root,
+        }
+        query.update(extra)
+        request = set_request('/endpoint/?' + urlencode(query), user=user)
+        request.user.is_verified = lambda: verified
+        response = openid_endpoint(request)
+        self.assertEqual(response.status_code, 302)
+        location = urlparse.urlsplit(response['Location'])
+        return dict(urlparse.parse_qsl(location.query))
+
+    def save_pref(self, **kwargs):
+        return OpenID_Attributes.objects.create(
+            uid=1000, trust_root=self.trust_root, **kwargs)
+
+    def test_always_auth_site_is_answered_positively(self):
+        self.save_pref()
+        answer = self.immediate()
+        self.assertEqual(answer['openid.mode'], 'id_res')
+        self.assertTrue(answer['openid.identity'].endswith('/alice/'))
+
+    def test_saved_attributes_are_sent(self):
+        self.save_pref(fullname=False, which_email='alice@test.com')
+        answer = self.immediate(**{
+            'openid.ns.sreg': 'http://openid.net/extensions/sreg/1.1',
+            'openid.sreg.required': 'email,fullname',
+        })
+        self.assertEqual(answer['openid.sreg.email'], 'alice@test.com')
+        self.assertNotIn('openid.sreg.fullname', answer)
+
+    def test_site_without_prefs_needs_setup(self):
+        self.assertEqual(self.immediate()['openid.mode'], 'setup_needed')
+
+    def test_asking_site_needs_setup(self):
+        self.save_pref(always_auth=False)
+        self.assertEqual(self.immediate()['openid.mode'], 'setup_needed')
+
+    def test_anonymous_user_needs_setup(self):
+        self.save_pref()
+        answer = self.immediate(user=AnonymousUser())
+        self.assertEqual(answer['openid.mode'], 'setup_needed')
+
+    def test_unverified_user_needs_setup(self):
+        self.save_pref()
+        answer = self.immediate(verified=False)
+        self.assertEqual(answer['openid.mode'], 'setup_needed')
+
+    def test_own_identity_is_answered_positively(self):
+        self.save_pref()
+        identity = 'http://testserver/id/alice/'
+        answer = self.immediate(**{'openid.identity': identity,
+                                   'openid.claimed_id': identity})
+        self.assertEqual(answer['openid.mode'], 'id_res')
+        self.assertEqual(answer['openid.identity'], identity)
+
+    def test_other_identity_needs_setup(self):
+        self.save_pref()
+        identity = 'http://testserver/id/bob/'
+        answer = self.immediate(**{'openid.identity': identity,
+                                   'openid.claimed_id': identity})
+        self.assertEqual(answer['openid.mode'], 'setup_needed')
+
+    def test_changed_email_choice_needs_setup(self):
+        self.save_pref(which_email='gone@test.com')
+        answer = self.immediate(**{
+            'openid.ns.sreg': 'http://openid.net/extensions/sreg/1.1',
+            'openid.sreg.required': 'email',
+        })
+        self.assertEqual(answer['openid.mode'], 'setup_needed')
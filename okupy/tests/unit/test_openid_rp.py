@@ -0,0 +1,194 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mockldap import MockLdap
+from openid.message import IDENTIFIER_SELECT, OPENID2_NS
+from openid.server.server import CheckIDRequest
+from urllib import urlencode
+
+from okupy.accounts import openid_rp
+from okupy.accounts.views import login, openid_endpoint
+from okupy.common.test_helpers import StubRelyingParty, set_request
+from okupy.tests import vars
+
+import mock
+
+
+class ReturnToVerificationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.rp = StubRelyingParty()
+        self.rp.start()
+
+    def tearDown(self):
+        self.rp.stop()
+        cache.clear()
+
+    def checkid(self, return_to=None):
+        return CheckIDRequest('http://example.com/id',
+                              return_to or self.rp.return_to,
+                              self.rp.trust_root)
+
+    def test_return_to_is_verified(self):
+        self.assertEqual(openid_rp.verify_return_to(self.checkid()),
+                         openid_rp.VERIFIED)
+
+    def test_unlisted_return_to_is_untrusted(self):
+        oreq = self.checkid(self.rp.trust_root + 'elsewhere')
+        self.assertEqual(openid_rp.verify_return_to(oreq),
+                         openid_rp.UNTRUSTED)
+
+    def test_verified_outcome_is_cached(self):
+        openid_rp.verify_return_to(self.checkid())
+        requests = self.rp.requests
+        self.assertEqual(openid_rp.verify_return_to(self.checkid()),
+                         openid_rp.VERIFIED)
+        self.assertEqual(self.rp.requests, requests)
+
+    def test_cache_is_keyed_by_return_to(self):
+        openid_rp.verify_return_to(self.checkid())
+        requests = self.rp.requests
+        openid_rp.verify_return_to(
+            self.checkid(self.rp.trust_root + 'elsewhere'))
+        self.assertGreater(self.rp.requests, requests)
+
+    def test_non_ascii_return_to(self):
+        oreq = self.checkid(self.rp.trust_root + u'zażółć')
+        self.assertEqual(openid_rp.verify_return_to(oreq),
+                         openid_rp.UNTRUSTED)
+        requests = self.rp.requests
+        self.assertEqual(openid_rp.verify_return_to(oreq),
+                         openid_rp.UNTRUSTED)
+        self.assertEqual(self.rp.requests, requests)
+
+    def test_discovery_failure_is_cached(self):
+        self.rp.status = 404
+        self.assertEqual(openid_rp.verify_return_to(self.checkid()),
+                         openid_rp.DISCOVERY_FAILURE)
+        self.rp.status = 200
+        self.assertEqual(openid_rp.verify_return_to(self.checkid()),
+                         openid_rp.DISCOVERY_FAILURE)
+
+    @override_settings(OPENID_RETURN_TO_TTL={
+        'verified': 3600, 'untrusted': 600, 'discovery_failure': -1,
+        'http_failure': 60})
+    def test_outcomes_have_own_ttl(self):
+        self.rp.status = 404
+        openid_rp.verify_return_to(self.checkid())
+        self.rp.status = 200
+        self.assertEqual(openid_rp.verify_return_to(self.checkid()),
+                         openid_rp.VERIFIED)
+
+    def test_http_failure(self):
+        oreq = self.checkid()
+        self.rp.stop()
+        self.assertEqual(openid_rp.verify_return_to(oreq),
+                         openid_rp.HTTP_FAILURE)
+
+
+@override_settings(OPENID_PREFETCH_WORKERS=2)
+class DiscoveryPrefetchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.rp = StubRelyingParty()
+        self.rp.start()
+        self.prefetcher = openid_rp.DiscoveryPrefetcher()
+
+    def tearDown(self):
+        self.rp.stop()
+        cache.clear()
+
+    def test_prefetch_fills_cache(self):
+        self.prefetcher.submit(self.rp.trust_root, self.rp.return_to)
+        self.prefetcher.wait(self.rp.trust_root, self.rp.return_to)
+        requests = self.rp.requests
+        self.assertGreater(requests, 0)
+        oreq = CheckIDRequest('http://example.com/id', self.rp.return_to,
+                              self.rp.trust_root)
+        self.assertEqual(openid_rp.verify_return_to(oreq),
+                         openid_rp.VERIFIED)
+        self.assertEqual(self.rp.requests, requests)
+
+    def test_verification_waits_for_running_prefetch(self):
+        self.rp.delay = 0.5
+        with mock.patch.object(openid_rp, 'prefetcher', self.prefetcher):
+            self.prefetcher.submit(self.rp.trust_root, self.rp.return_to)
+            oreq = CheckIDRequest('http://example.com/id', self.rp.return_to,
+                                  self.rp.trust_root)
+            self.assertEqual(openid_rp.verify_return_to(oreq),
+                             openid_rp.VERIFIED)
+        self.assertEqual(self.rp.requests, 1)
+
+    def test_known_outcome_is_not_prefetched(self):
+        self.prefetcher.submit(self.rp.trust_root, self.rp.return_to)
+        self.prefetcher.wait(self.rp.trust_root, self.rp.return_to)
+        requests = self.rp.requests
+        self.prefetcher.submit(self.rp.trust_root, self.rp.return_to)
+        self.prefetcher.wait(self.rp.trust_root, self.rp.return_to)
+        self.assertEqual(self.rp.requests, requests)
+
+    @override_settings(OPENID_PREFETCH_WORKERS=0)
+    def test_prefetch_can_be_disabled(self):
+        self.prefetcher.submit(self.rp.trust_root, self.rp.return_to)
+        self.assertEqual(self.rp.requests, 0)
+
+
+class EndpointPrefetchTests(TestCase):
+    trust_root = 'http://rp.example.com/'
+    return_to = 'http://rp.example.com/return'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(vars.DIRECTORY)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def setUp(self):
+        cache.clear()
+        self.mockldap.start()
+        self.ldapobj = self.mockldap[settings.AUTH_LDAP_SERVER_URI]
+        patcher = mock.patch.object(openid_rp, 'prefetcher')
+        self.prefetcher = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.ldapobj
+        cache.clear()
+
+    def checkid_setup(self, user=False):
+        query = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'checkid_setup',
+            'openid.identity': IDENTIFIER_SELECT,
+            'openid.claimed_id': IDENTIFIER_SELECT,
+            'openid.return_to': self.return_to,
+            'openid.realm': self.trust_root,
+        }
+        request = set_request('/endpoint/?' + urlencode(query), user=user)
+        self.assertEqual(openid_endpoint(request).status_code, 302)
+        return request
+
+    def test_anonymous_request_is_not_prefetched(self):
+        self.checkid_setup()
+        self.assertFalse(self.prefetcher.submit.called)
+
+    def test_authenticated_request_is_prefetched(self):
+        self.checkid_setup(user=vars.USER_ALICE)
+        self.prefetcher.submit.assert_called_once_with(self.trust_root,
+                                                       self.return_to)
+
+    def test_pending_request_is_prefetched_after_login(self):
+        oreq = self.checkid_setup().session['openid_request']
+        request = set_request('/login/', post=vars.LOGIN_ALICE,
+                              messages=True)
+        request.session['openid_request'] = oreq
+        login(request)
+        self.prefetcher.submit.assert_called_once_with(self.trust_root,
+                                                       self.return_to)
@@ -0,0 +1,161 @@
+# vim:fileencoding=utf8:et:ts=4:sts=4:sw=4:ft=python
+
+from django.contrib.messages.storage.base import Message
+from django.core.cache import cache
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.safestring import SafeText, mark_safe
+
+from openid.message import IDENTIFIER_SELECT, OPENID2_NS
+
+from okupy.accounts.views import get_openid_server, load_openid_request
+from okupy.common import sessions
+from okupy.common.sessions import SessionStore, dumps, loads
+
+import datetime
+import mock
+import pickle
+
+
+class SessionSerializerTests(TestCase):
+    def test_round_trip(self):
+        value = {
+            'none': None,
+            'bool': True,
+            'int': 12,
+            'long': 2 ** 70,
+            'float': 0.5,
+            'str': 'abc',
+            'unicode': u'zażółć',
+            'list': [1, [2, 'x']],
+            'tuple': (1, (2, 3)),
+            'set': set([1, 2]),
+            'frozenset': frozenset(['a']),
+            'dict': {'a': {u'b': [1]}},
+            'safe': mark_safe(u'<b>bold</b>'),
+            'aware': datetime.datetime(2013, 6, 1, 12, 30, 15, 1000,
+                                       tzinfo=timezone.utc),
+            'naive': datetime.datetime(2013, 6, 1),
+        }
+        self.assertEqual(loads(dumps(value)), value)
+
+    def test_types_are_kept(self):
+        value = loads(dumps({'tuple': (1,), 'safe': mark_safe(u'x')}))
+        self.assertIsInstance(value['tuple'], tuple)
+        self.assertIsInstance(value['safe'], SafeText)
+
+    def test_messages_round_trip(self):
+        message = Message(20, mark_safe(u'Logged out'), 'extra')
+        message._prepare()
+        loaded = loads(dumps([message]))[0]
+        self.assertEqual(loaded, message)
+        self.assertEqual(loaded.extra_tags, 'extra')
+
+    def test_unsupported_value_fails(self):
+        self.assertRaises(TypeError, dumps, {'user': object()})
+
+    def test_unsupported_key_fails(self):
+        self.assertRaises(TypeError, dumps, {(1, 2): 'x'})
+
+    def test_unknown_format_fails(self):
+        self.assertRaises(ValueError, loads, pickle.dumps({}))
+
+    def test_truncated_data_fails(self):
+        self.assertRaises(ValueError, loads, dumps({'a': 'b' * 10})[:-3])
+
+    def test_smaller_than_pickle(self):
+        value = {
+            '_auth_user_id': 12,
+            '_auth_user_backend': 'okupy.common.auth.LDAPAuthBackend',
+            'secondary_password': 'x' * 48,
+        }
+        self.assertLess(len(dumps(value)), len(pickle.dumps(value, 2)))
+
+
+class SessionStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_session_is_stored_serialized(self):
+        session = SessionStore()
+        session['a'] = 'b'
+        session.save()
+        self.assertEqual(loads(cache.get(session.cache_key)), {'a': 'b'})
+        self.assertEqual(SessionStore(session.session_key)['a'], 'b')
+
+    def test_legacy_session_is_loaded(self):
+        session = SessionStore()
+        session.create()
+        cache.set(session.cache_key, {'a': 'b'})
+        self.assertEqual(SessionStore(session.session_key)['a'], 'b')
+
+    def test_legacy_openid_request_is_upgraded(self):
+        request = RequestFactory().get('/endpoint/')
+        oreq = get_openid_server(request).decodeRequest({
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'checkid_setup',
+            'openid.identity': IDENTIFIER_SELECT,
+            'openid.claimed_id': IDENTIFIER_SELECT,
+            'openid.return_to': 'http://rp.example.com/return',
+            'openid.realm': 'http://rp.example.com/',
+        })
+        session = SessionStore()
+        session.create()
+        cache.set(session.cache_key, {'openid_request': oreq,
+                                      'user': object()})
+        request.session = SessionStore(session.session_key)
+        loaded = load_openid_request(request)
+        self.assertEqual(loaded.return_to, oreq.return_to)
+        self.assertNotIn('user', request.session)
+        # saving no longer fails on the pickled request
+        request.session.save()
+        self.assertEqual(
+            loads(cache.get(session.cache_key))['openid_request'],
+            oreq.message.toPostArgs())
+
+    def test_invalid_session_is_dropped(self):
+        session = SessionStore()
+        session.create()
+        cache.set(session.cache_key, 'garbage')
+        loaded = SessionStore(session.session_key)
+        self.assertNotIn('a', loaded)
+        self.assertNotEqual(loaded.session_key, session.session_key)
+
+    def test_new_session_is_not_saved_when_read(self):
+        session = SessionStore()
+        self.assertNotIn('a', session)
+        self.assertIsNone(session.session_key)
+
+    def test_missing_session_is_not_saved_when_read(self):
+        session = SessionStore('a' * 32)
+        self.assertNotIn('a', session)
+        self.assertIsNone(session.session_key)
+        self.assertFalse(session.exists('a' * 32))
+
+    def test_missing_session_is_saved_with_new_key(self):
+        session = SessionStore('a' * 32)
+        session['a'] = 'b'
+        session.save()
+        self.assertNotEqual(session.session_key, 'a' * 32)
+        self.assertEqual(SessionStore(session.session_key)['a'], 'b')
+
+    def test_unsupported_value_is_not_saved(self):
+        session = SessionStore()
+        session['user'] = object()
+        self.assertRaises(TypeError, session.save)
+
+    @override_settings(SESSION_SIZE_STATS=True)
+    def test_sizes_are_recorded(self):
+        sizes = sessions.SessionSizes()
+        session = SessionStore()
+        session['a'] = 'b' * 100
+        with mock.patch.object(sessions, 'session_sizes', sizes):
+            session.save()
+        self.assertEqual(sizes.saves, 1)
+        self.assertEqual(sizes.size, len(cache.get(session.cache_key)))
+        self.assertGreaterEqual(sizes.keys['a'][1], 100)
+        self.assertIn('a: 1 saves', sizes.summary())
@@ -9,7 +9,7 @@ from mockldap import MockLdap
 from passlib.hash import ldap_md5_crypt
 
 from okupy.accounts.forms import SignupForm
-from okupy.accounts.models import Queue
+from okupy.accounts.models import Queue, UIDNumberCounter
 from okupy.accounts.views import signup, activate
 from okupy.common.test_helpers import (OkupyTestCase, set_request, ldap_users,
                                        no_database)
@@ -195,6 +195,26 @@ class SignupUnitTests(OkupyTestCase):
             vars.QUEUEDUSER.username,
             directory=self.ldapobj.directory)[1]['uidNumber'][0], '1')
 
+    def test_activation_uses_uidnumber_counter(self):
+        UIDNumberCounter.objects.create(pk=1, next_uid=5000)
+        vars.QUEUEDUSER.save()
+        activate_url = '/activate/%s/' % vars.QUEUEDUSER.encrypted_id
+        request = set_request(activate_url, messages=True)
+        activate(request, vars.QUEUEDUSER.encrypted_id)
+        self.assertEqual(ldap_users(
+            vars.QUEUEDUSER.username,
+            directory=self.ldapobj.directory)[1]['uidNumber'][0], '5000')
+        self.assertEqual(UIDNumberCounter.objects.get(pk=1).next_uid, 5001)
+
+    def test_uidnumber_counter_gets_seeded_from_ldap(self):
+        self.assertEqual(UIDNumberCounter.reserve(), 1002)
+        self.assertEqual(UIDNumberCounter.objects.get(pk=1).next_uid, 1003)
+
+    def test_uidnumber_counter_blocks_do_not_overlap(self):
+        first = UIDNumberCounter.reserve(10)
+        second = UIDNumberCounter.reserve(10)
+        self.assertEqual(second, first + 10)
+
 
 class SignupunitTestsNoLDAP(OkupyTestCase):
     def test_signup_url_resolves_to_signup_view(self):
@@ -32,6 +32,7 @@ DIRECTORY = {
         "gentooRoles": ["kde, qt, cluster"],
         "gentooLocation": ["City1, Country1"],
         "gentooACL": ["user.group", "developer.group"],
+        "modifyTimestamp": ["20130601120000Z"],
         "sshPublicKey": ["ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQCbtxfr9vRO4xkD"
                          "uUnsu02rL7BtBiABADkWdugnMxRAV6nKokitytgLGDhjY6iB8C87"
                          "K8mCxz/ksMO+uct/lUEHMf1M2P1rPEStrJoXQuTXQbtVl7iF5cyS"
@@ -55,6 +56,7 @@ DIRECTORY = {
         "gentoRoles": ["nothing"],
         "gentooLocation": ["City2, Country2"],
         "gentooACL": ["user.group", "foundation.group"],
+        "modifyTimestamp": ["20130602120000Z"],
         "sshPublicKey": ["ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDUSOgwQ6uljefD"
                          "9BiwhiGzRGn+sg7D3AKcqU8PWrB+p74n9GBIccc/iSuG458iid08"
                          "FvUqHjY0RLwMQADND7NOGaEEW0NXbyblA6xZhZu6BgnFC4LZBHy5"
@@ -82,6 +84,7 @@ DIRECTORY = {
         "objectClass": settings.AUTH_LDAP_USER_OBJECTCLASS +
         settings.AUTH_LDAP_DEV_OBJECTCLASS,
         "gentooACL": ["user.group", "developer.group", "foundation.group"],
+        "modifyTimestamp": ["20130603120000Z"],
     },
     "uid=john,ou=people,o=test": {
         "uid": ["john"],
@@ -90,6 +93,7 @@ DIRECTORY = {
         "gentooLocation": ["City3, Country3"],
         "gentooRoles": ["kernel, security"],
         "gentooACL": ["user.group", "retired.group"],
+        "modifyTimestamp": ["20130604120000Z"],
     },
     "uid=matt,ou=people,o=test": {
         "objectClass": settings.AUTH_LDAP_USER_OBJECTCLASS,